@@ -0,0 +1,397 @@
+"""
+Flujo de citas como tabla de estados.
+
+Cada etapa del flujo es una fila de `FLOW_TABLE`:
+
+    etapa -> extractor -> mensaje si no es válido -> campo -> siguiente etapa -> pregunta
+
+Las etapas que hacen algo más que guardar un campo (ofrecer fechas, retener
+un horario, enviar la cita) tienen su propio manejador. Cada turno es una
+búsqueda en el diccionario por la etapa actual, sin recorrer los campos.
+
+El estado de una conversación (`AppointmentState`) es la etapa, los datos
+del formulario, las fechas ofrecidas y la clave de envío. Se convierte en un
+diccionario JSON con `to_dict()` y se reconstruye con `from_dict()`, así que
+puede guardarse en una instantánea o en un almacén de sesiones compartido.
+
+Lo que depende del servidor (horarios libres, retenciones, envío al backend)
+se inyecta en `AppointmentFlow`; sin ello el flujo funciona solo, con los
+valores por defecto, y se puede probar entero en memoria.
+"""
+
+import re
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+# Campos del formulario de cita, en el orden del backend
+FIELDS = (
+    "fullName", "age", "phone", "email", "consultationReason", "preferredDate",
+    "alternativeDate", "consultationType", "notes", "location",
+)
+
+START_PROMPT = "¡Perfecto! Te ayudo a agendar tu cita. Para comenzar, necesito algunos datos:\n\n¿Cuál es tu nombre completo?"
+APPOINTMENT_WORDS = ("cita", "agendar", "programar", "consulta", "reunión", "visita")
+
+# Etapa final: la conversación de cita se cierra
+COMPLETED = "completed"
+
+
+def is_affirmative_response(text: str) -> bool:
+    """Verifica si la respuesta es afirmativa"""
+    # Palabras específicamente afirmativas (siempre indican afirmación)
+    affirmative_words = ["sí", "si", "yes", "ok", "okay", "claro", "correcto", "exacto", "afirmativo"]
+    # Palabras que pueden ser afirmativas pero también descriptivas
+    context_dependent_words = ["perfecto", "excelente", "genial", "bueno", "vale"]
+
+    text_lower = text.lower().strip()
+
+    # Si contiene palabras específicamente afirmativas
+    if any(word in text_lower for word in affirmative_words):
+        return True
+
+    # Para palabras dependientes del contexto, verificar que sea una respuesta muy específica
+    for word in context_dependent_words:
+        if word in text_lower:
+            # Solo considerar afirmativa si es una respuesta muy corta y directa
+            words = text_lower.split()
+            if len(words) == 1 and words[0] == word:
+                return True
+            # O si es una respuesta muy corta con una palabra adicional
+            if len(words) == 2 and words[0] == word and words[1] in ["gracias", "ok", "vale"]:
+                return True
+
+    return False
+
+
+def is_negative_response(text: str) -> bool:
+    """Verifica si la respuesta es negativa"""
+    negative_words = ["no", "nop", "nope", "negativo", "incorrecto", "mal", "error", "no me interesa", "no por ahora"]
+    return any(word in text.lower() for word in negative_words)
+
+
+def extract_age(text: str) -> Optional[int]:
+    """Extrae edad del texto con validación estricta"""
+    try:
+        # Buscar números que estén solos (no parte de otros números)
+        numbers = re.findall(r'\b(\d{1,3})\b', text.strip())
+
+        # Si hay múltiples números, tomar el primero que sea válido
+        for num in numbers:
+            age = int(num)
+            # Validación estricta: solo edades entre 18 y 100
+            if 18 <= age <= 100:
+                return age
+
+        # Si no se encontró una edad válida, verificar si el texto es solo un número
+        text_clean = text.strip()
+        if text_clean.isdigit():
+            age = int(text_clean)
+            if 18 <= age <= 100:
+                return age
+            else:
+                return None  # Edad fuera del rango válido
+
+    except (ValueError, TypeError):
+        pass
+
+    return None
+
+
+def extract_phone(text: str) -> Optional[str]:
+    """Extrae número de teléfono del texto"""
+    # Patrones para teléfonos españoles
+    patterns = [
+        r'\+34\s*\d{9}',  # +34 612345678
+        r'\+34\s*\d{3}\s*\d{3}\s*\d{3}',  # +34 612 345 678
+        r'\d{9}',  # 612345678
+        r'\d{3}\s*\d{3}\s*\d{3}'  # 612 345 678
+    ]
+
+    for pattern in patterns:
+        match = re.search(pattern, text)
+        if match:
+            phone = match.group()
+            # Limpiar espacios
+            phone = re.sub(r'\s+', '', phone)
+            return phone
+    return None
+
+
+def extract_email(text: str) -> Optional[str]:
+    """Extrae email del texto"""
+    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+    match = re.search(email_pattern, text)
+    return match.group() if match else None
+
+
+def classify_consultation(reason: str) -> str:
+    """Área de la consulta según el motivo"""
+    reason_lower = reason.lower()
+    if any(word in reason_lower for word in ["despido", "trabajo", "laboral", "empleo", "contrato", "salario", "horario"]):
+        return "Derecho Laboral"
+    if any(word in reason_lower for word in ["divorcio", "familia", "hijos", "custodia", "pensión"]):
+        return "Derecho Familiar"
+    if any(word in reason_lower for word in ["herencia", "testamento", "sucesión"]):
+        return "Derecho Civil"
+    if any(word in reason_lower for word in ["empresa", "comercial", "mercantil", "sociedad"]):
+        return "Derecho Mercantil"
+    if any(word in reason_lower for word in ["multa", "sanción", "administrativo"]):
+        return "Derecho Administrativo"
+    return "Derecho Civil"  # Por defecto
+
+
+def create_confirmation_message(data: Dict[str, Any]) -> str:
+    """Crea mensaje de confirmación con los datos recopilados"""
+    preferred_date = data['preferredDate']
+    if isinstance(preferred_date, str):
+        date_str = preferred_date[:10]
+    else:
+        date_str = "Fecha no especificada"
+
+    return f"""📋 **Resumen de tu cita:**
+
+👤 **Datos personales:**
+• Nombre: {data['fullName']}
+• Edad: {data['age']} años
+• Teléfono: {data['phone']}
+• Email: {data['email']}
+
+⚖️ **Consulta:**
+• Motivo: {data['consultationReason']}
+• Área: {data['consultationType']}
+• Fecha preferida: {date_str}
+
+¿Está todo correcto? Responde 'sí' para confirmar o 'no' para empezar de nuevo."""
+
+
+def appointment_summary(data: Dict[str, Any], heading: str) -> str:
+    """Detalles de la cita enviada, con el encabezado según su estado"""
+    preferred_date = data['preferredDate']
+    if isinstance(preferred_date, str):
+        date_str = preferred_date[:10]
+    else:
+        date_str = "Fecha no especificada"
+    return f"{heading}\n\n📅 **Detalles de tu cita:**\n• Nombre: {data['fullName']}\n• Fecha: {date_str}\n• Motivo: {data['consultationReason']}\n\nRecibirás un email de confirmación en {data['email']}.\n\nUn abogado se pondrá en contacto contigo pronto para confirmar los detalles. ¡Gracias por confiar en nosotros!"
+
+
+def date_options(dates: List[datetime]) -> str:
+    return "\n".join(f"• {i}. {date.strftime('%A %d de %B a las %H:%M')}" for i, date in enumerate(dates, 1))
+
+
+class AppointmentState:
+    """Estado serializable de una conversación de cita"""
+    __slots__ = ("stage", "data", "offered", "key")
+
+    def __init__(self, stage: str = "initial"):
+        self.stage = stage
+        self.data: Dict[str, Any] = dict.fromkeys(FIELDS)
+        # Fechas ofrecidas en ISO, en el orden mostrado
+        self.offered: List[str] = []
+        # Clave de envío mientras la cita está en el outbox
+        self.key: Optional[str] = None
+
+    @property
+    def offered_dates(self) -> List[datetime]:
+        return [datetime.fromisoformat(date) for date in self.offered]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Forma compacta (solo tipos JSON, sin campos vacíos)"""
+        state: Dict[str, Any] = {"stage": self.stage}
+        data = {name: value for name, value in self.data.items() if value is not None}
+        if data:
+            state["data"] = data
+        if self.offered:
+            state["offered"] = list(self.offered)
+        if self.key:
+            state["key"] = self.key
+        return state
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "AppointmentState":
+        restored = cls(state.get("stage", "initial"))
+        restored.data.update(state.get("data") or {})
+        restored.offered = list(state.get("offered") or [])
+        restored.key = state.get("key")
+        # Instantáneas anteriores a la tabla: etapa genérica y fechas en el contexto
+        context = state.get("context") or {}
+        if context.get("available_dates"):
+            restored.offered = [date.isoformat() for date in context["available_dates"]]
+        restored.key = restored.key or context.get("outbox_key")
+        if restored.stage == "collecting_info":
+            missing = [step for step, field in _FIELD_STAGES if restored.data.get(field) is None]
+            restored.stage = missing[0] if missing else "confirmation"
+        return restored
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, AppointmentState) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"AppointmentState({self.to_dict()!r})"
+
+
+class Step:
+    """Fila de la tabla: cómo se procesa la respuesta en una etapa"""
+    __slots__ = ("field", "extract", "invalid", "next", "prompt", "handler")
+
+    def __init__(self, field=None, extract=None, invalid=None, next=None, prompt=None, handler=None):
+        self.field = field
+        self.extract = extract
+        self.invalid = invalid
+        self.next = next
+        self.prompt = prompt
+        self.handler = handler
+
+
+# Mensajes de error de cada campo (reciben el texto del usuario)
+def _age_error(text: str) -> str:
+    text_clean = text.strip()
+    if text_clean.isdigit():
+        age_value = int(text_clean)
+        if age_value < 18:
+            return "Debes ser mayor de edad (18 años o más) para agendar una cita. Por favor, proporciona tu edad real."
+        return "Por favor, proporciona una edad válida (entre 18 y 100 años)."
+    return "Por favor, proporciona tu edad (solo el número, entre 18 y 100 años)."
+
+
+def _longer_than(length: int) -> Callable[[str], Optional[str]]:
+    def extract(text: str) -> Optional[str]:
+        text = text.strip()
+        return text if len(text) > length else None
+    return extract
+
+
+def _message(text: str) -> Callable[..., str]:
+    return lambda *args: text
+
+
+# Manejadores de las etapas con efectos (reciben el flujo, el usuario, el estado y el texto)
+def _start(flow: "AppointmentFlow", user_id: str, state: AppointmentState, text: str) -> str:
+    text_lower = text.lower().strip()
+    if any(word in text_lower for word in APPOINTMENT_WORDS) or is_affirmative_response(text_lower):
+        flow.enter(user_id, state, "name")
+        return START_PROMPT
+    return "Entiendo. ¿Te gustaría agendar una cita para que nuestros abogados puedan ayudarte mejor?"
+
+
+def _offer_dates(flow: "AppointmentFlow", user_id: str, state: AppointmentState) -> str:
+    """Pregunta de la etapa de fecha: ofrece los huecos libres o cierra si no hay"""
+    state.data["consultationType"] = classify_consultation(state.data["consultationReason"])
+    dates = flow.available_dates(user_id)
+    if not dates:
+        flow.enter(user_id, state, COMPLETED)
+        return flow.no_dates(user_id)
+    state.offered = [date.isoformat() for date in dates]
+    return ("Perfecto. ¿Qué fecha prefieres para tu consulta?\n\nOpciones disponibles:\n" + date_options(dates)
+            + f"\n\nResponde con el número de la opción que prefieras (1-{len(dates)}).")
+
+
+def _choose_date(flow: "AppointmentFlow", user_id: str, state: AppointmentState, text: str) -> str:
+    dates = state.offered_dates
+    try:
+        index = int(text.strip()) - 1
+    except ValueError:
+        return f"Por favor, responde con el número de la opción (1-{len(dates)}):\n\n" + date_options(dates)
+    if not 0 <= index < len(dates):
+        return f"Por favor, selecciona una opción válida (1-{len(dates)}):\n\n" + date_options(dates)
+    selected = dates[index]
+    if not flow.hold(user_id, selected):
+        # Otra sesión lo ha elegido entre medias: se ofrecen las opciones actuales
+        dates = flow.available_dates(user_id)
+        if not dates:
+            flow.enter(user_id, state, COMPLETED)
+            return flow.no_dates(user_id)
+        state.offered = [date.isoformat() for date in dates]
+        return ("Lo siento, ese horario acaba de ser reservado. Estas son las opciones disponibles ahora:\n\n"
+                + date_options(dates) + f"\n\nResponde con el número de la opción que prefieras (1-{len(dates)}).")
+    state.data["preferredDate"] = selected.isoformat() + "Z"
+    flow.enter(user_id, state, "confirmation")
+    return create_confirmation_message(state.data)
+
+
+def _confirm(flow: "AppointmentFlow", user_id: str, state: AppointmentState, text: str) -> str:
+    if is_affirmative_response(text):
+        return flow.submit(user_id, state)
+    if is_negative_response(text):
+        flow.release(user_id)
+        state.data = dict.fromkeys(FIELDS)
+        state.offered = []
+        flow.enter(user_id, state, "name")
+        return "Entiendo. Empecemos de nuevo. ¿Cuál es tu nombre completo?"
+    return "Por favor, responde 'sí' para confirmar o 'no' para empezar de nuevo."
+
+
+def _pending(flow: "AppointmentFlow", user_id: str, state: AppointmentState, text: str) -> Optional[str]:
+    # Un segundo «sí» no la vuelve a enviar; el resto de mensajes sigue el flujo normal
+    if is_affirmative_response(text) or "cita" in text.lower():
+        return flow.pending_message
+    return None
+
+
+FLOW_TABLE: Dict[str, Step] = {
+    "initial": Step(handler=_start),
+    "name": Step("fullName", _longer_than(2), _message("Por favor, proporciona tu nombre completo."), "age",
+                 lambda flow, user_id, state: f"Gracias {state.data['fullName']}. ¿Cuál es tu edad?"),
+    "age": Step("age", extract_age, _age_error, "phone",
+                _message("Perfecto. ¿Cuál es tu número de teléfono de contacto?")),
+    "phone": Step("phone", extract_phone,
+                  _message("Por favor, proporciona un número de teléfono válido (ejemplo: 612345678 o +34 612345678)."),
+                  "email", _message("Excelente. ¿Cuál es tu correo electrónico?")),
+    "email": Step("email", extract_email, _message("Por favor, proporciona un email válido."), "reason",
+                  _message("Muy bien. ¿Cuál es el motivo de tu consulta? (Por ejemplo: despido, acoso laboral, impago de salarios, etc.)")),
+    "reason": Step("consultationReason", _longer_than(3),
+                   _message("Por favor, describe el motivo de tu consulta con más detalle."), "date", _offer_dates),
+    "date": Step(handler=_choose_date),
+    "confirmation": Step(handler=_confirm),
+    "submitting": Step(handler=_pending),
+}
+
+# Etapas que piden un campo del formulario, en orden
+_FIELD_STAGES = tuple((stage, step.field) for stage, step in FLOW_TABLE.items() if step.field)
+
+
+class AppointmentFlow:
+    """Ejecuta la tabla de estados sobre un `AppointmentState`"""
+
+    def __init__(
+        self,
+        available_dates: Callable[[str], List[datetime]] = lambda user_id: [],
+        hold: Callable[[str, datetime], bool] = lambda user_id, slot: True,
+        release: Callable[[str], Any] = lambda user_id: None,
+        submit: Callable[[str, AppointmentState], str] = None,
+        no_dates: Callable[[str], str] = None,
+        on_enter: Callable[[str, AppointmentState], Any] = lambda user_id, state: None,
+        pending_message: str = "⏳ Tu cita se sigue procesando.",
+        table: Dict[str, Step] = FLOW_TABLE,
+    ):
+        self.available_dates = available_dates
+        self.hold = hold
+        self.release = release
+        self.submit = submit or self._complete
+        self.no_dates = no_dates or _message(
+            "Lo siento, no quedan horarios libres en las próximas semanas. Por favor, contacta directamente al despacho por teléfono o email.")
+        self.on_enter = on_enter
+        self.pending_message = pending_message
+        self.table = table
+
+    @staticmethod
+    def _complete(user_id: str, state: AppointmentState) -> str:
+        state.stage = COMPLETED
+        return appointment_summary(state.data, "¡Perfecto! Hemos registrado tu solicitud de cita.")
+
+    def enter(self, user_id: str, state: AppointmentState, stage: str):
+        state.stage = stage
+        self.on_enter(user_id, state)
+
+    def handle(self, user_id: str, state: AppointmentState, text: str) -> Optional[str]:
+        """Procesa un mensaje; None si la etapa no lo atiende y debe seguir el flujo general"""
+        step = self.table.get(state.stage)
+        if step is None:
+            return "No entiendo. ¿Podrías repetir?"
+        if step.handler is not None:
+            return step.handler(self, user_id, state, text)
+        value = step.extract(text)
+        if value is None:
+            return step.invalid(text)
+        state.data[step.field] = value
+        self.enter(user_id, state, step.next)
+        return step.prompt(self, user_id, state)
@@ -0,0 +1,283 @@
+"""
+Disponibilidad real de horarios para las citas.
+
+Las citas reservadas se guardan por día en un índice de intervalos ordenado
+por hora de inicio. Como todas las citas duran como mucho `max_duration`
+minutos, las que pueden solaparse con un hueco [inicio, fin) empiezan en
+(inicio - max_duration, fin): dos búsquedas binarias bastan para comprobar
+un hueco en O(log n).
+
+Las citas se cargan del backend en segundo plano. Cada recarga compara con
+lo ya conocido y solo toca los días que han cambiado; los huecos libres de
+cada día se cachean hasta que ese día cambia. Las citas enviadas desde el
+chatbot se anotan al momento (provisionales) sin esperar a la recarga.
+"""
+
+import asyncio
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+# Estados de cita que no ocupan horario
+FREE_STATUSES = {"CANCELADA"}
+
+
+def parse_backend_datetime(value: Any) -> Optional[datetime]:
+    """Fecha del backend ('2026-01-05T09:00:00.000Z') como datetime sin zona, igual que se envía"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+class DayIndex:
+    """Intervalos reservados de un día en minutos desde medianoche, ordenados por inicio"""
+
+    def __init__(self):
+        self._intervals: List[Tuple[int, int, str]] = []
+        self.max_duration = 0
+
+    def __len__(self) -> int:
+        return len(self._intervals)
+
+    def add(self, start: int, end: int, booking_id: str):
+        insort(self._intervals, (start, end, booking_id))
+        self.max_duration = max(self.max_duration, end - start)
+
+    def remove(self, start: int, end: int, booking_id: str) -> bool:
+        index = bisect_left(self._intervals, (start, end, booking_id))
+        if index < len(self._intervals) and self._intervals[index] == (start, end, booking_id):
+            del self._intervals[index]
+            return True
+        return False
+
+    def overlapping(self, start: int, end: int) -> int:
+        """Número de reservas que se solapan con [start, end)"""
+        low = bisect_right(self._intervals, (start - self.max_duration, float("inf"), ""))
+        high = bisect_left(self._intervals, (end, -1, ""))
+        return sum(1 for index in range(low, high) if self._intervals[index][1] > start)
+
+
+class AvailabilityEngine:
+    """Calcula los huecos libres a partir de las citas reservadas"""
+
+    def __init__(
+        self,
+        fetch: Optional[Callable[[], Iterable[Dict[str, Any]]]] = None,
+        slot_hours: Sequence[int] = (9, 11, 14, 16, 18),
+        slot_minutes: int = 60,
+        horizon_days: int = 15,
+        capacity: int = 1,
+        refresh_interval: float = 60.0,
+        now: Callable[[], datetime] = datetime.now,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.fetch = fetch
+        self.slot_hours = tuple(slot_hours)
+        self.slot_minutes = slot_minutes
+        self.horizon_days = horizon_days
+        self.capacity = capacity
+        self.refresh_interval = refresh_interval
+        self.now = now
+        self._days: Dict[date, DayIndex] = {}
+        # id -> (día, inicio, fin, marca de cambio); las provisionales no vienen del backend
+        self._bookings: Dict[str, Tuple[date, int, int, Any]] = {}
+        self._provisional: Dict[str, Tuple[date, int, int, Any]] = {}
+        self._free_cache: Dict[date, List[Tuple[datetime, int]]] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.loaded = False
+        self.registry = registry
+        self.refresh_seconds = registry.histogram("availability_refresh_seconds")
+        self.bookings_gauge = registry.gauge("availability_bookings")
+
+    # ------------------------------------------------------------------
+    # Índice
+    # ------------------------------------------------------------------
+
+    def _place(self, start: datetime) -> Tuple[date, int, int]:
+        minute = start.hour * 60 + start.minute
+        return start.date(), minute, minute + self.slot_minutes
+
+    def _insert(self, booking_id: str, entry: Tuple[date, int, int, Any]):
+        day, start, end, _ = entry
+        self._days.setdefault(day, DayIndex()).add(start, end, booking_id)
+        self._free_cache.pop(day, None)
+
+    def _delete(self, booking_id: str, entry: Tuple[date, int, int, Any]):
+        day, start, end, _ = entry
+        index = self._days.get(day)
+        if index is not None and index.remove(start, end, booking_id):
+            if not len(index):
+                del self._days[day]
+            self._free_cache.pop(day, None)
+
+    def apply(self, appointments: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+        """Sincroniza con la lista completa del backend tocando solo lo que ha cambiado"""
+        seen = set()
+        added = removed = 0
+        today = self.now().date()
+        with self._lock:
+            for appointment in appointments:
+                booking_id = str(appointment.get("id") or "")
+                start = parse_backend_datetime(appointment.get("confirmedDate") or appointment.get("preferredDate"))
+                if not booking_id or start is None or start.date() < today or appointment.get("status") in FREE_STATUSES:
+                    continue
+                seen.add(booking_id)
+                entry = (*self._place(start), appointment.get("updatedAt"))
+                current = self._bookings.get(booking_id)
+                if current == entry:
+                    continue
+                if current is not None:
+                    self._delete(booking_id, current)
+                    removed += 1
+                self._bookings[booking_id] = entry
+                self._insert(booking_id, entry)
+                added += 1
+            for booking_id in [b for b in self._bookings if b not in seen]:
+                self._delete(booking_id, self._bookings.pop(booking_id))
+                removed += 1
+            self.loaded = True
+            self.bookings_gauge.set(len(self._bookings) + len(self._provisional))
+        return {"added": added, "removed": removed}
+
+    def book(self, booking_id: str, start: datetime):
+        """Anota una cita enviada desde el chatbot antes de que el backend la confirme"""
+        with self._lock:
+            if booking_id in self._provisional:
+                return
+            entry = (*self._place(start), None)
+            self._provisional[booking_id] = entry
+            self._insert(booking_id, entry)
+            self.bookings_gauge.set(len(self._bookings) + len(self._provisional))
+
+    def release(self, booking_id: str):
+        """Quita una cita provisional (ya confirmada por el backend o rechazada)"""
+        with self._lock:
+            entry = self._provisional.pop(booking_id, None)
+            if entry is not None:
+                self._delete(booking_id, entry)
+            self.bookings_gauge.set(len(self._bookings) + len(self._provisional))
+
+    def confirm(self, booking_id: str, appointment: Dict[str, Any]):
+        """La cita provisional ya existe en el backend: pasa a su id real"""
+        with self._lock:
+            entry = self._provisional.pop(booking_id, None)
+            if entry is not None:
+                self._delete(booking_id, entry)
+            real_id = str(appointment.get("id") or booking_id)
+            start = parse_backend_datetime(appointment.get("preferredDate"))
+            if start is not None and real_id not in self._bookings:
+                entry = (*self._place(start), appointment.get("updatedAt"))
+                self._bookings[real_id] = entry
+                self._insert(real_id, entry)
+            self.bookings_gauge.set(len(self._bookings) + len(self._provisional))
+
+    # ------------------------------------------------------------------
+    # Consulta
+    # ------------------------------------------------------------------
+
+    def remaining(self, start: datetime) -> int:
+        """Citas que aún caben en el horario"""
+        day, begin, end = self._place(start)
+        with self._lock:
+            index = self._days.get(day)
+            return self.capacity - (index.overlapping(begin, end) if index is not None else 0)
+
+    def is_free(self, start: datetime) -> bool:
+        return self.remaining(start) > 0
+
+    def _free_slots(self, day: date) -> List[Tuple[datetime, int]]:
+        cached = self._free_cache.get(day)
+        if cached is not None:
+            self.registry.counter("availability_cache_hits_total").inc()
+            return cached
+        self.registry.counter("availability_cache_misses_total").inc()
+        index = self._days.get(day)
+        slots = []
+        for hour in self.slot_hours:
+            begin = hour * 60
+            remaining = self.capacity - (index.overlapping(begin, begin + self.slot_minutes) if index is not None else 0)
+            if remaining > 0:
+                slots.append((datetime(day.year, day.month, day.day, hour), remaining))
+        self._free_cache[day] = slots
+        return slots
+
+    def available(self, limit: int = 8, exclude: Callable[[datetime, int], bool] = lambda slot, remaining: False) -> List[datetime]:
+        """Próximos huecos libres en días laborables a partir de mañana.
+
+        `exclude` recibe cada hueco y las citas que aún caben en él.
+        """
+        today = self.now().date()
+        result: List[datetime] = []
+        with self._lock:
+            # Los días pasados ya no se consultan
+            for day in [d for d in self._free_cache if d <= today]:
+                del self._free_cache[day]
+            for offset in range(1, self.horizon_days + 1):
+                day = today + timedelta(days=offset)
+                if day.weekday() >= 5:  # Lunes a Viernes (0-4)
+                    continue
+                for slot, remaining in self._free_slots(day):
+                    if not exclude(slot, remaining):
+                        result.append(slot)
+                        if len(result) >= limit:
+                            return result
+        return result
+
+    # ------------------------------------------------------------------
+    # Recarga en segundo plano
+    # ------------------------------------------------------------------
+
+    def prune(self) -> int:
+        """Olvida las citas de días ya pasados"""
+        today = self.now().date()
+        with self._lock:
+            past = [(bookings, booking_id) for bookings in (self._bookings, self._provisional)
+                    for booking_id, entry in bookings.items() if entry[0] < today]
+            for bookings, booking_id in past:
+                self._delete(booking_id, bookings.pop(booking_id))
+        return len(past)
+
+    def refresh_sync(self) -> Dict[str, int]:
+        self.prune()
+        if self.fetch is None:
+            return {"added": 0, "removed": 0}
+        start = time.perf_counter()
+        changes = self.apply(self.fetch())
+        self.refresh_seconds.observe(time.perf_counter() - start)
+        if changes["added"] or changes["removed"]:
+            print(f"[Availability] {changes['added']} citas nuevas o cambiadas, {changes['removed']} eliminadas")
+        return changes
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.refresh_sync)
+            except Exception as e:
+                self.registry.counter("availability_refresh_errors_total").inc()
+                print(f"[Availability] Error cargando citas del backend: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,394 @@
+"""
+Cola write-behind para el registro de conversaciones en el backend.
+
+Crear la conversación, añadir mensajes, completarla y registrar emails ya no
+bloquea el turno: los eventos se encolan (desde el event loop o desde los
+hilos del pool NLP) y una tarea de fondo los envía agrupados por
+conversación, cuando se acumulan `batch_size` eventos o cada
+`flush_interval` segundos. Lo que no se consigue entregar tras varios
+intentos, o sigue en cola al parar, se entrega a `spill` (el outbox en disco).
+Un rechazo definitivo del backend (`PermanentDeliveryError`, p. ej. un 401)
+no se reintenta ni se vuelca: se descarta y se cuenta.
+
+Primero se intenta un único POST con todo el lote; si el backend no tiene
+endpoint de lotes (404/405/501) se recuerda durante `batch_retry_after`
+segundos y se usan las llamadas individuales de siempre. La memoria está
+acotada: con `max_pending` eventos en cola los nuevos se descartan y se
+cuentan.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from metrics import MetricsRegistry, metrics as default_metrics
+from outbox import PermanentDeliveryError
+
+
+class BatchUnsupported(Exception):
+    """El backend no ofrece endpoint de lotes"""
+
+
+class _Conversation:
+    """Conversación abierta: id en el backend y eventos pendientes de enviar"""
+
+    __slots__ = ("session_id", "backend_id", "create", "messages", "complete", "attempts")
+
+    def __init__(self, session_id: str, create: Dict[str, Any]):
+        self.session_id = session_id
+        self.backend_id: Optional[str] = None
+        self.create: Optional[Dict[str, Any]] = create
+        self.messages: List[Dict[str, Any]] = []
+        self.complete: Optional[Dict[str, Any]] = None
+        self.attempts = 0
+
+
+def _record_size(record: Dict[str, Any]) -> int:
+    return (record.get("create") is not None) + len(record.get("messages") or ()) + (record.get("complete") is not None)
+
+
+class _Work:
+    """Eventos de una conversación tomados para un flush"""
+
+    __slots__ = ("conversation", "record")
+
+    def __init__(self, conversation: _Conversation):
+        self.conversation = conversation
+        self.record = {
+            "session_id": conversation.session_id,
+            "conversation_id": conversation.backend_id,
+            "create": conversation.create,
+            "messages": conversation.messages,
+            "complete": conversation.complete,
+        }
+        conversation.create, conversation.messages, conversation.complete = None, [], None
+
+    def size(self) -> int:
+        return _record_size(self.record)
+
+
+class BackendWriteBehind:
+    """Agrupa y envía en segundo plano las escrituras de registro al backend"""
+
+    def __init__(
+        self,
+        create: Callable[..., Optional[Dict[str, Any]]],
+        add_message: Callable[..., Optional[Dict[str, Any]]],
+        complete: Callable[..., Optional[Dict[str, Any]]],
+        log_email: Callable[..., Optional[Dict[str, Any]]],
+        send_batch: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        batch_size: int = 50,
+        flush_interval: float = 2.0,
+        max_pending: int = 5000,
+        max_conversations: int = 10000,
+        max_attempts: int = 3,
+        batch_retry_after: float = 300.0,
+        paused: Callable[[], bool] = lambda: False,
+        spill: Optional[Callable[[Dict[str, Any]], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self._create = create
+        self._add_message = add_message
+        self._complete = complete
+        self._log_email = log_email
+        self._send_batch = send_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_conversations = max_conversations
+        self.max_attempts = max_attempts
+        self.batch_retry_after = batch_retry_after
+        self.paused = paused
+        self.spill = spill
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._open: "OrderedDict[str, _Conversation]" = OrderedDict()
+        self._dirty: "OrderedDict[int, _Conversation]" = OrderedDict()
+        self._emails: Deque[Dict[str, Any]] = deque()
+        self._pending = 0
+        self._batch_disabled_until = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Un solo hilo: los flushes no se solapan y conservan el orden por conversación
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backend-writes")
+        self.registry = registry
+        self.depth = registry.gauge("backend_write_queue_depth")
+        self.flush_seconds = registry.histogram("backend_write_flush_seconds")
+        self.batch_events = registry.histogram("backend_write_batch_events", (1, 5, 10, 25, 50, 100, 250, 500))
+
+    # ------------------------------------------------------------------
+    # Encolado (thread-safe, nunca bloquea por red)
+    # ------------------------------------------------------------------
+
+    def _admit(self) -> bool:
+        if self._pending >= self.max_pending:
+            self.registry.counter("backend_writes_dropped_total").inc()
+            return False
+        self._pending += 1
+        self.depth.set(self._pending)
+        return True
+
+    def _conversation(self, session_id: str, **create_fields) -> _Conversation:
+        conversation = self._open.get(session_id)
+        if conversation is None:
+            conversation = _Conversation(session_id, dict(create_fields, session_id=session_id))
+            self._pending += 1
+            self._open[session_id] = conversation
+            while len(self._open) > self.max_conversations:
+                self._open.popitem(last=False)
+        else:
+            self._open.move_to_end(session_id)
+        return conversation
+
+    def _mark_dirty(self, conversation: _Conversation):
+        self._dirty[id(conversation)] = conversation
+        self.depth.set(self._pending)
+        if self._pending >= self.batch_size:
+            self._wakeup()
+
+    def start_conversation(self, session_id: str, **create_fields) -> bool:
+        with self._lock:
+            if session_id in self._open or not self._admit():
+                return False
+            self._pending -= 1  # _conversation cuenta el evento de creación
+            self._mark_dirty(self._conversation(session_id, **create_fields))
+            return True
+
+    def add_message(self, session_id: str, **message_fields) -> bool:
+        """Añade un mensaje; abre la conversación si aún no existe"""
+        with self._lock:
+            if not self._admit():
+                return False
+            conversation = self._conversation(session_id)
+            conversation.messages.append(message_fields)
+            self._mark_dirty(conversation)
+            return True
+
+    def complete_conversation(self, session_id: str, appointment_id: Optional[str] = None) -> bool:
+        with self._lock:
+            conversation = self._open.get(session_id)
+            if conversation is None or not self._admit():
+                return False
+            conversation.complete = {"appointment_id": appointment_id}
+            self._mark_dirty(conversation)
+            return True
+
+    def log_email(self, **email_fields) -> bool:
+        with self._lock:
+            if not self._admit():
+                return False
+            self._emails.append(email_fields)
+            self.depth.set(self._pending)
+            if self._pending >= self.batch_size:
+                self._wakeup()
+            return True
+
+    def end_session(self, session_id: str):
+        """Los próximos mensajes de este usuario abrirán una conversación nueva"""
+        with self._lock:
+            self._open.pop(session_id, None)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    # ------------------------------------------------------------------
+    # Envío (en el hilo del executor)
+    # ------------------------------------------------------------------
+
+    def _take(self):
+        with self._lock:
+            work = [_Work(conversation) for conversation in self._dirty.values()]
+            emails = list(self._emails)
+            self._dirty.clear()
+            self._emails.clear()
+        return [item for item in work if item.size()], emails
+
+    def _give_up(self, record: Dict[str, Any], count: int):
+        """Sin más reintentos: se vuelca a `spill` (p. ej. el outbox en disco) o se descarta"""
+        with self._lock:
+            self._pending -= count
+        if self.spill is not None:
+            try:
+                self.spill(record)
+                self.registry.counter("backend_writes_spilled_total").inc(count)
+                return
+            except Exception as e:
+                print(f"[BackendWrites] No se pudo volcar al outbox: {e}")
+        self.registry.counter("backend_writes_dropped_total").inc(count)
+
+    def _reject(self, record: Dict[str, Any], count: int, error: Exception):
+        """El backend rechazó el registro: reintentarlo no serviría de nada"""
+        with self._lock:
+            self._pending -= count
+        self.registry.counter("backend_writes_rejected_total").inc(count)
+        print(f"[BackendWrites] Registro rechazado por el backend ({count} eventos), se descarta: {error}")
+
+    def _requeue(self, item: _Work):
+        """Devuelve a la cola lo que no se pudo enviar, con un número máximo de intentos"""
+        conversation = item.conversation
+        conversation.attempts += 1
+        if conversation.attempts >= self.max_attempts:
+            conversation.attempts = 0
+            self._give_up(item.record, item.size())
+            return
+        with self._lock:
+            if item.record["create"] is not None:
+                conversation.create = item.record["create"]
+            conversation.messages[:0] = item.record["messages"]
+            if item.record["complete"] is not None and conversation.complete is None:
+                conversation.complete = item.record["complete"]
+            self._dirty[id(conversation)] = conversation
+
+    def _done(self, count: int):
+        with self._lock:
+            self._pending -= count
+            self.depth.set(self._pending)
+        self.registry.counter("backend_writes_flushed_total").inc(count)
+
+    def _flush_batch(self, work: List[_Work], emails: List[Dict[str, Any]]) -> bool:
+        if self._send_batch is None or self.clock() < self._batch_disabled_until:
+            return False
+        payload = {"conversations": [item.record for item in work], "email_logs": emails}
+        try:
+            result = self._send_batch(payload) or {}
+        except BatchUnsupported:
+            self._batch_disabled_until = self.clock() + self.batch_retry_after
+            print(f"[BackendWrites] El backend no acepta lotes; llamadas individuales durante {self.batch_retry_after:.0f} s")
+            return False
+        ids = result.get("conversation_ids", {})
+        for item in work:
+            if ids.get(item.conversation.session_id):
+                item.conversation.backend_id = ids[item.conversation.session_id]
+        self._done(sum(item.size() for item in work) + len(emails))
+        return True
+
+    def replay(self, record: Dict[str, Any]):
+        """Entrega un registro con llamadas individuales, anotando en él lo ya enviado.
+
+        Si falla a medias, el registro queda con lo pendiente y se puede reintentar.
+        """
+        if record.get("email") is not None:
+            if self._log_email(**record["email"]) is None:
+                raise RuntimeError("no se pudo registrar el email")
+            record["email"] = None
+            return
+        if not record.get("conversation_id"):
+            created = self._create(**(record.get("create") or {"session_id": record["session_id"]}))
+            if not created or not created.get("id"):
+                raise RuntimeError("no se pudo crear la conversación")
+            record["conversation_id"] = created["id"]
+        record["create"] = None
+        messages = record.get("messages") or []
+        while messages:
+            if self._add_message(record["conversation_id"], **messages[0]) is None:
+                raise RuntimeError("no se pudo añadir el mensaje")
+            messages.pop(0)
+        if record.get("complete") is not None:
+            if self._complete(record["conversation_id"], **record["complete"]) is None:
+                raise RuntimeError("no se pudo completar la conversación")
+            record["complete"] = None
+
+    def _flush_item(self, item: _Work):
+        before = item.size()
+        try:
+            self.replay(item.record)
+            item.conversation.attempts = 0
+        except PermanentDeliveryError as e:
+            item.conversation.attempts = 0
+            self._reject(item.record, item.size(), e)
+        except Exception:
+            self._requeue(item)
+        finally:
+            if item.record["conversation_id"]:
+                item.conversation.backend_id = item.record["conversation_id"]
+            self._done(before - item.size())
+
+    def flush_sync(self) -> Dict[str, int]:
+        """Envía todo lo pendiente; devuelve eventos enviados y descartados"""
+        flushed_before = self.registry.counter("backend_writes_flushed_total").value
+        dropped_before = self.registry.counter("backend_writes_dropped_total").value
+        work, emails = self._take()
+        if not work and not emails:
+            return {"backend_writes_flushed": 0, "backend_writes_dropped": 0}
+        start = time.perf_counter()
+        self.batch_events.observe(sum(item.size() for item in work) + len(emails))
+        try:
+            batched = self._flush_batch(work, emails)
+        except Exception as e:
+            print(f"[BackendWrites] Error enviando lote, se usan llamadas individuales: {e}")
+            batched = False
+        if not batched:
+            self.registry.counter("backend_write_fallback_total").inc()
+            for item in work:
+                self._flush_item(item)
+            for email in emails:
+                record = {"email": email}
+                try:
+                    self.replay(record)
+                    self._done(1)
+                except PermanentDeliveryError as e:
+                    self._reject(record, 1, e)
+                except Exception:
+                    self._give_up(record, 1)
+        self.depth.set(self._pending)
+        self.flush_seconds.observe(time.perf_counter() - start)
+        return {
+            "backend_writes_flushed": int(self.registry.counter("backend_writes_flushed_total").value - flushed_before),
+            "backend_writes_dropped": int(self.registry.counter("backend_writes_dropped_total").value - dropped_before),
+        }
+
+    def spill_pending(self) -> Dict[str, int]:
+        """Vuelca a `spill` todo lo que sigue en cola (al parar, tras el último flush)"""
+        work, emails = self._take()
+        records = [(item.record, item.size()) for item in work] + [({"email": email}, 1) for email in emails]
+        spilled_before = self.registry.counter("backend_writes_spilled_total").value
+        for record, count in records:
+            self._give_up(record, count)
+        self.depth.set(self._pending)
+        return {"backend_writes_spilled": int(self.registry.counter("backend_writes_spilled_total").value - spilled_before)}
+
+    # ------------------------------------------------------------------
+    # Tarea de fondo
+    # ------------------------------------------------------------------
+
+    def _wakeup(self):
+        if self._loop is not None and self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def flush(self) -> Dict[str, int]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.flush_sync)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._pending and not self.paused():
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print(f"[BackendWrites] Error en el flush: {e}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = self._loop.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,150 @@
+"""
+Procesamiento por lotes de turnos de conversación.
+
+Pensado para los trabajos de QA y analítica que reproducen miles de
+conversaciones grabadas: recibe muchos turnos (user_id, text), conserva el
+orden dentro de cada usuario, procesa usuarios distintos en paralelo con un
+número acotado de workers y devuelve los resultados a medida que terminan
+(el endpoint HTTP los emite como NDJSON).
+
+Cada lote usa un espacio de nombres propio para las sesiones (`namespace`):
+el handler recibe `<namespace><user_id>`, así que un lote no puede tocar ni
+liberar la sesión de un usuario real con el mismo user_id, ni la de otro lote.
+Los resultados llevan el user_id original.
+
+Uso desde Python, sin HTTP:
+
+    from batch import run_batch_sync
+    from main_improved_fixed import run_turn
+
+    results = run_batch_sync([("qa-1", "hola"), ("qa-1", "1"), ("qa-2", "honorarios")], run_turn)
+"""
+
+import asyncio
+import secrets
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+from metrics import MetricsRegistry, metrics as default_metrics
+from worker_pool import PoolBusyError
+
+TurnHandler = Callable[[str, str, str], Awaitable[Tuple[str, str]]]
+
+_DONE = object()
+
+
+def normalize_turn(turn: Any) -> Tuple[str, str, str]:
+    """Acepta tuplas (user_id, text[, language]), dicts o modelos con esos campos"""
+    if isinstance(turn, (tuple, list)):
+        user_id, text = turn[0], turn[1]
+        language = turn[2] if len(turn) > 2 else "es"
+    elif isinstance(turn, dict):
+        user_id, text, language = turn["user_id"], turn["text"], turn.get("language") or "es"
+    else:
+        user_id, text, language = turn.user_id, turn.text, getattr(turn, "language", None) or "es"
+    return str(user_id), str(text), str(language)
+
+
+def group_by_user(turns: Iterable[Any]) -> "OrderedDict[str, List[Tuple[int, str, str]]]":
+    """Agrupa los turnos por usuario conservando su posición original"""
+    groups: "OrderedDict[str, List[Tuple[int, str, str]]]" = OrderedDict()
+    for index, turn in enumerate(turns):
+        user_id, text, language = normalize_turn(turn)
+        groups.setdefault(user_id, []).append((index, text, language))
+    return groups
+
+
+def new_namespace() -> str:
+    """Prefijo de sesión único para un lote"""
+    return f"batch-{secrets.token_hex(6)}:"
+
+
+async def run_batch(
+    turns: Iterable[Any],
+    handler: TurnHandler,
+    concurrency: int = 4,
+    retries: int = 3,
+    retry_delay: float = 0.5,
+    retry_on: Tuple[Type[BaseException], ...] = (PoolBusyError,),
+    give_up_on: Tuple[Type[BaseException], ...] = (),
+    on_user_done: Optional[Callable[[str], Any]] = None,
+    namespace: str = "",
+    registry: MetricsRegistry = default_metrics,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Procesa los turnos y genera un resultado por turno en orden de finalización.
+
+    Los turnos de un mismo usuario se ejecutan en orden y nunca en paralelo;
+    `concurrency` usuarios se atienden a la vez. Si el pool está saturado el
+    turno se reintenta con espera creciente antes de darlo por fallido; las
+    excepciones de `give_up_on` no se reintentan. `handler` y `on_user_done`
+    reciben el user_id con el prefijo `namespace`.
+    """
+    groups = group_by_user(turns)
+    pending: asyncio.Queue = asyncio.Queue()
+    for item in groups.items():
+        pending.put_nowait(item)
+    # Acotada: si el consumidor lee despacio los workers esperan
+    results: asyncio.Queue = asyncio.Queue(maxsize=max(1, concurrency) * 4)
+    registry.counter("batch_requests_total").inc()
+
+    async def run_one(user_id: str, index: int, text: str, language: str) -> Dict[str, Any]:
+        start = time.perf_counter()
+        for attempt in range(retries + 1):
+            try:
+                response, timestamp = await handler(namespace + user_id, text, language)
+                registry.histogram("batch_turn_seconds").observe(time.perf_counter() - start)
+                registry.counter("batch_turns_total").inc()
+                return {"index": index, "user_id": user_id, "response": response, "timestamp": timestamp}
+            except give_up_on as e:
+                error = e
+                break
+            except retry_on as e:
+                error = e
+                if attempt < retries:
+                    await asyncio.sleep(retry_delay * (2 ** attempt))
+            except Exception as e:
+                error = e
+                break
+        registry.counter("batch_turn_errors_total").inc()
+        return {"index": index, "user_id": user_id, "error": type(error).__name__, "detail": str(error)}
+
+    async def worker():
+        while True:
+            try:
+                user_id, items = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                for index, text, language in items:
+                    await results.put(await run_one(user_id, index, text, language))
+            finally:
+                if on_user_done is not None:
+                    on_user_done(namespace + user_id)
+
+    async def supervise(workers: List[asyncio.Task]):
+        await asyncio.gather(*workers, return_exceptions=True)
+        await results.put(_DONE)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, min(concurrency, len(groups))))]
+    supervisor = asyncio.ensure_future(supervise(workers))
+    try:
+        while True:
+            result = await results.get()
+            if result is _DONE:
+                return
+            yield result
+    finally:
+        # El consumidor puede abandonar (cliente desconectado): se cancela lo pendiente
+        for task in workers + [supervisor]:
+            if not task.done():
+                task.cancel()
+
+
+def run_batch_sync(turns: Iterable[Any], handler: TurnHandler, **kwargs) -> List[Dict[str, Any]]:
+    """Versión síncrona para scripts: devuelve los resultados en el orden de entrada"""
+
+    async def collect():
+        return [result async for result in run_batch(turns, handler, **kwargs)]
+
+    return sorted(asyncio.run(collect()), key=lambda result: result["index"])
@@ -0,0 +1,124 @@
+"""
+Historial de conversación en buffer circular, compartido por /chat y /ws.
+
+Cada sesión guarda como máximo `capacity` mensajes y `max_bytes` bytes de
+texto; al añadir un mensaje se descartan los más antiguos en O(1) sin crear
+listas nuevas. Cada mensaje se clasifica al añadirlo y `features`
+(ver session_features.py) resume los últimos sin recorrer el historial.
+"""
+
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from session_features import SessionFeatures, message_topics, prompt_type
+
+
+def _message_size(message: Dict[str, Any]) -> int:
+    return len(str(message.get("text", "")).encode("utf-8"))
+
+
+class ConversationHistory:
+    """Buffer circular de mensajes de una sesión"""
+
+    def __init__(self, capacity: int = 10, max_bytes: int = 8192, feature_window: int = 3):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self._messages: Deque[Dict[str, Any]] = deque(maxlen=capacity)
+        self._sizes: Deque[int] = deque(maxlen=capacity)
+        self._topics: Deque[int] = deque(maxlen=capacity)
+        self._bytes = 0
+        self.features = SessionFeatures(feature_window)
+        self._last_assistant: Optional[Dict[str, Any]] = None
+
+    def _drop_oldest(self):
+        # El más antiguo sale de la ventana de rasgos solo si estaba dentro
+        if len(self._messages) <= self.features.window:
+            self.features.leave(self._topics[0])
+        if self._messages[0] is self._last_assistant:
+            self._last_assistant = None
+            self.features.last_prompt = None
+        self._messages.popleft()
+        self._topics.popleft()
+        self._bytes -= self._sizes.popleft()
+
+    def append(self, message: Dict[str, Any]):
+        size = _message_size(message)
+        topics = message_topics(message)
+        if len(self._messages) == self.capacity:
+            self._drop_oldest()
+        if len(self._messages) >= self.features.window:
+            self.features.leave(self._topics[-self.features.window])
+        self._messages.append(message)
+        self._sizes.append(size)
+        self._topics.append(topics)
+        self._bytes += size
+        self.features.enter(topics)
+        if not message.get("isUser"):
+            self._last_assistant = message
+            self.features.last_prompt = prompt_type(message)
+        # Respetar el límite de bytes conservando siempre el último mensaje
+        while self._bytes > self.max_bytes and len(self._messages) > 1:
+            self._drop_oldest()
+
+    def recent(self, n: int) -> List[Dict[str, Any]]:
+        """Devuelve los últimos n mensajes en orden cronológico"""
+        last = list(islice(reversed(self._messages), n))
+        last.reverse()
+        return last
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def clear(self):
+        self._messages.clear()
+        self._sizes.clear()
+        self._topics.clear()
+        self._bytes = 0
+        self.features.reset()
+        self._last_assistant = None
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self._messages)
+
+    def __reversed__(self) -> Iterator[Dict[str, Any]]:
+        return reversed(self._messages)
+
+
+class HistoryStore:
+    """Historiales por sesión con la misma capacidad para todos los transportes"""
+
+    def __init__(self, capacity: int = 10, max_bytes: int = 8192):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self._histories: Dict[str, ConversationHistory] = {}
+
+    def get(self, user_id: str) -> ConversationHistory:
+        """Obtiene o crea el historial de un usuario"""
+        history = self._histories.get(user_id)
+        if history is None:
+            history = ConversationHistory(self.capacity, self.max_bytes)
+            self._histories[user_id] = history
+        return history
+
+    def pop(self, user_id: str, default: Optional[ConversationHistory] = None) -> Optional[ConversationHistory]:
+        return self._histories.pop(user_id, default)
+
+    def total_bytes(self) -> int:
+        return sum(history.size_bytes for history in self._histories.values())
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._histories
+
+    def __getitem__(self, user_id: str) -> ConversationHistory:
+        return self._histories[user_id]
+
+    def __len__(self) -> int:
+        return len(self._histories)
+
+    def keys(self):
+        return self._histories.keys()
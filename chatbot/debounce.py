@@ -0,0 +1,127 @@
+"""
+Agrupación de mensajes seguidos de una misma sesión.
+
+Muchos usuarios escriben una idea en varios mensajes rápidos ("hola" /
+"quería" / "una cita para despido"). Con una ventana de N ms por transporte,
+los mensajes que llegan dentro de la ventana se unen en un solo turno:
+
+- cada mensaje nuevo alarga la espera (sin pasar de `max_wait` desde el primero);
+- el último mensaje es el que ejecuta el turno, con el texto de todos;
+- los anteriores terminan al llegar el siguiente y devuelven None (su texto
+  va en el turno del último);
+- si el último se cancela (el cliente se desconecta), su texto se descarta
+  pero el de los anteriores, que ya devolvieron None, pasa al siguiente
+  mensaje de la sesión.
+
+Con ventana 0 el mensaje pasa tal cual, sin esperar. Por cada transporte se
+cuentan mensajes y turnos: su cociente es la tasa de agrupación.
+"""
+
+import asyncio
+import time
+from typing import Callable, Dict, List, Optional
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+
+class _Batch:
+    __slots__ = ("parts", "first_at", "version", "wake")
+
+    def __init__(self, first_at: float):
+        self.parts: List[str] = []
+        self.first_at = first_at
+        self.version = 0
+        self.wake: Optional[asyncio.Event] = None
+
+
+class MessageCoalescer:
+    """Ventana de agrupación por sesión, configurable por transporte"""
+
+    def __init__(
+        self,
+        windows: Dict[str, float],
+        max_wait: float = 3.0,
+        default_transport: str = "chat",
+        separator: str = " ",
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        # Segundos por transporte; los transportes desconocidos cuentan como `default_transport`
+        self.windows = dict(windows)
+        self.windows.setdefault(default_transport, 0.0)
+        self.max_wait = max_wait
+        self.default_transport = default_transport
+        self.separator = separator
+        self.clock = clock
+        self._batches: Dict[str, _Batch] = {}
+        self.registry = registry
+        self.batch_size = registry.histogram("coalesce_batch_size", buckets=(1, 2, 3, 5, 8, 13))
+
+    def transport(self, name: Optional[str]) -> str:
+        return name if name in self.windows else self.default_transport
+
+    def _count(self, transport: str, messages: int):
+        self.registry.counter(f"coalesce_{transport}_messages_total").inc(messages)
+        self.registry.counter(f"coalesce_{transport}_turns_total").inc()
+        self.batch_size.observe(messages)
+
+    async def submit(self, session_id: str, text: str, transport: Optional[str] = None) -> Optional[str]:
+        """Texto del turno a ejecutar, o None si este mensaje se une al turno de uno posterior"""
+        transport = self.transport(transport)
+        window = self.windows[transport]
+        if window <= 0:
+            self._count(transport, 1)
+            return text
+        now = self.clock()
+        batch = self._batches.get(session_id)
+        if batch is None:
+            batch = self._batches[session_id] = _Batch(now)
+        batch.parts.append(text)
+        batch.version += 1
+        version = batch.version
+        if batch.wake is not None:
+            # El que esperaba deja de ser el último
+            batch.wake.set()
+        wake = batch.wake = asyncio.Event()
+        timeout = max(0.0, min(window, batch.first_at + self.max_wait - now))
+        try:
+            await asyncio.wait_for(wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Si el último se cancela, los anteriores quedan para el próximo mensaje
+            if batch.version == version and self._batches.get(session_id) is batch:
+                batch.parts.pop()
+                batch.wake = None
+                if not batch.parts:
+                    del self._batches[session_id]
+            raise
+        if batch.version != version:
+            self.registry.counter(f"coalesce_{transport}_merged_total").inc()
+            return None
+        if self._batches.get(session_id) is batch:
+            del self._batches[session_id]
+        self._count(transport, len(batch.parts))
+        return self.separator.join(batch.parts)
+
+    def discard(self, session_id: str):
+        """Olvida los mensajes pendientes de una sesión liberada"""
+        self._batches.pop(session_id, None)
+
+    def pending(self) -> int:
+        """Sesiones con mensajes esperando a que cierre su ventana"""
+        return len(self._batches)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Mensajes, turnos y mensajes por turno de cada transporte"""
+        stats = {}
+        for transport, window in self.windows.items():
+            messages = self.registry.counter(f"coalesce_{transport}_messages_total").value
+            turns = self.registry.counter(f"coalesce_{transport}_turns_total").value
+            stats[transport] = {
+                "window_ms": round(window * 1000),
+                "messages": messages,
+                "turns": turns,
+                "ratio": round(messages / turns, 2) if turns else 1.0,
+            }
+        return stats
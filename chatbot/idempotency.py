@@ -0,0 +1,89 @@
+"""
+Claves de idempotencia y caché de resultados para los envíos al backend.
+
+La clave de una cita se calcula a partir de la sesión y de los datos del
+formulario: el mismo usuario confirmando la misma cita (un «sí» repetido, un
+reinicio del flujo con los mismos datos, un reintento de red) produce siempre
+la misma clave. El outbox no guarda dos envíos con la misma clave y la clave
+viaja al backend en la cabecera `Idempotency-Key`.
+
+La caché recuerda el resultado de las claves recientes (pendiente, entregada
+con su respuesta o rechazada) para contestar a una repetición sin volver a
+llamar al backend.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+
+def _normalize(value: Any) -> Any:
+    # Mayúsculas y espacios sobrantes no hacen distinta una cita
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    return value
+
+
+def idempotency_key(scope: str, fields: Dict[str, Any]) -> str:
+    """Clave estable para (scope, fields): SHA-256 del JSON canónico"""
+    canonical = json.dumps(
+        {"scope": scope, "fields": {name: _normalize(value) for name, value in fields.items()}},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class IdempotencyCache:
+    """Resultados recientes por clave, acotados en número y con caducidad"""
+
+    def __init__(
+        self,
+        ttl: float = 86400.0,
+        max_entries: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.registry = registry
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Resultado guardado para la clave ({"status", "result"}) o None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+        if entry is None:
+            self.registry.counter("idempotency_misses_total").inc()
+            return None
+        self.registry.counter("idempotency_hits_total").inc()
+        return entry[1]
+
+    def record(self, key: str, status: str, result: Any = None) -> Dict[str, Any]:
+        outcome = {"status": status, "result": result}
+        with self._lock:
+            self._entries[key] = (self.clock(), outcome)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return outcome
+
+    def discard(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
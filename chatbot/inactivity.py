@@ -0,0 +1,130 @@
+"""
+Monitor de inactividad que se ejecuta dentro del event loop del servidor.
+
+Sustituye al hilo de limpieza: al correr en el mismo loop que uvicorn puede
+enviar la advertencia y el cierre por el WebSocket abierto y liberar la
+sesión en el mismo momento. `InactivitySessionHandlers` contiene lo que hace
+el servidor en cada caso (avisar por el flujo de la sesión, cerrar conexiones
+y liberar el estado) con sus dependencias inyectadas.
+"""
+
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, MutableMapping, Optional
+
+
+class InactivityMonitor:
+    """Advierte y cierra sesiones inactivas desde el event loop"""
+
+    def __init__(
+        self,
+        last_activity: Dict[str, float],
+        warned_inactive: Dict[str, bool],
+        on_warning: Callable[[str], Awaitable[None]],
+        on_timeout: Callable[[str], Awaitable[None]],
+        warning_after: float = 50,
+        close_after: float = 60,
+        interval: float = 5,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.last_activity = last_activity
+        self.warned_inactive = warned_inactive
+        self.on_warning = on_warning
+        self.on_timeout = on_timeout
+        self.warning_after = warning_after
+        self.close_after = close_after
+        self.interval = interval
+        self.clock = clock
+        self._task: Optional[asyncio.Task] = None
+
+    async def check(self):
+        """Revisa todas las sesiones una vez"""
+        now = self.clock()
+        for user_id in list(self.last_activity.keys()):
+            last = self.last_activity.get(user_id)
+            if last is None:
+                continue
+            inactivity = now - last
+            if inactivity > self.close_after:
+                # Liberar primero para que un nuevo mensaje cree una sesión limpia
+                self.last_activity.pop(user_id, None)
+                self.warned_inactive.pop(user_id, None)
+                await self._notify(self.on_timeout, user_id)
+            elif inactivity > self.warning_after and not self.warned_inactive.get(user_id, False):
+                self.warned_inactive[user_id] = True
+                await self._notify(self.on_warning, user_id)
+
+    async def _notify(self, callback: Callable[[str], Awaitable[None]], user_id: str):
+        try:
+            await callback(user_id)
+        except Exception as e:
+            print(f"[Inactividad] Error notificando a {user_id}: {e}")
+
+    async def run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Lanza el monitor en el event loop actual"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class InactivitySessionHandlers:
+    """Advertencia y cierre por inactividad de una sesión del servidor"""
+
+    def __init__(
+        self,
+        histories: Any,
+        deliver: Callable[[str, Dict[str, Any]], bool],
+        release_session: Callable[[str], None],
+        websockets: MutableMapping[str, Any],
+        event_streams: MutableMapping[str, Any],
+        warning_after: float = 50,
+        close_after: float = 60,
+        now: Callable[[], datetime] = datetime.now,
+    ):
+        self.histories = histories
+        self.deliver = deliver
+        self.release_session = release_session
+        self.websockets = websockets
+        self.event_streams = event_streams
+        self.warning_after = warning_after
+        self.close_after = close_after
+        self.now = now
+
+    async def warn(self, user_id: str):
+        """Envía la advertencia de inactividad por el socket abierto y la guarda en el historial"""
+        warning_msg = f"⚠️ No hay actividad. El chat se cerrará automáticamente en {int(self.close_after - self.warning_after)} segundos si no respondes."
+        timestamp = self.now().isoformat()
+        if user_id in self.histories:
+            self.histories[user_id].append({
+                "text": warning_msg,
+                "isUser": False,
+                "timestamp": timestamp
+            })
+        self.deliver(user_id, {"type": "warning", "message": warning_msg, "timestamp": timestamp})
+
+    async def close(self, user_id: str):
+        """Envía el aviso de cierre, cierra el socket con un close frame y libera la sesión"""
+        # Mensaje especial para el frontend; el escritor envía después el close frame
+        self.deliver(user_id, {"type": "close", "message": "El chat se ha cerrado por inactividad."})
+        connection = self.websockets.pop(user_id, None)
+        event_stream = self.event_streams.pop(user_id, None)
+        self.release_session(user_id)
+        if connection:
+            connection.close(1000, "inactivity")
+        if event_stream:
+            event_stream.close()
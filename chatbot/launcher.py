@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Lanzador multi-proceso del chatbot con modelos precargados.
+
+El proceso padre importa la aplicación (spaCy, NLTK y SentenceTransformer),
+congela el heap con gc.freeze() y después hace fork de N workers uvicorn que
+comparten el socket de escucha. Los pesos de los modelos quedan compartidos
+copy-on-write entre workers; el padre informa PSS/USS por worker para
+comprobarlo, vigila un heartbeat por worker y coordina los reinicios.
+
+Las sesiones (citas a medias, historial, flujos SSE) viven en la memoria de
+cada worker y el kernel reparte las conexiones entre workers sin afinidad:
+dos peticiones del mismo usuario pueden llegar a workers distintos. Por eso
+más de un worker exige `--allow-split-sessions`, solo para despliegues donde
+cada petición es independiente (p. ej. pruebas de carga o `/chat/batch`).
+
+Uso:
+    python launcher.py --port 8000
+    python launcher.py --workers 4 --allow-split-sessions --port 8000
+
+Señales:
+    SIGHUP           reinicio escalonado de los workers (uno a uno)
+    SIGTERM/SIGINT   parada ordenada de todos los workers
+"""
+
+import argparse
+import asyncio
+import gc
+import mmap
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+from typing import Dict, Optional
+
+HEARTBEAT_FORMAT = "d"
+HEARTBEAT_SIZE = struct.calcsize(HEARTBEAT_FORMAT)
+
+
+def read_memory_usage(pid: int) -> Optional[Dict[str, int]]:
+    """Lee RSS, PSS, USS y memoria compartida (kB) de /proc/<pid>/smaps_rollup"""
+    fields: Dict[str, int] = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1])
+    except OSError:
+        return None
+    return {
+        "rss_kb": fields.get("Rss", 0),
+        "pss_kb": fields.get("Pss", 0),
+        "uss_kb": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        "shared_kb": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+    }
+
+
+class Heartbeats:
+    """Marcas de tiempo por worker en memoria compartida (sobrevive al fork)"""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self._mem = mmap.mmap(-1, HEARTBEAT_SIZE * slots)
+
+    def beat(self, slot: int, now: Optional[float] = None):
+        struct.pack_into(HEARTBEAT_FORMAT, self._mem, slot * HEARTBEAT_SIZE, now if now is not None else time.time())
+
+    def last(self, slot: int) -> float:
+        return struct.unpack_from(HEARTBEAT_FORMAT, self._mem, slot * HEARTBEAT_SIZE)[0]
+
+    def reset(self, slot: int):
+        self.beat(slot, 0.0)
+
+
+class Launcher:
+    def __init__(self, args):
+        self.args = args
+        self.workers: Dict[int, int] = {}  # slot -> pid
+        self.heartbeats = Heartbeats(args.workers)
+        self.sock: Optional[socket.socket] = None
+        self.app = None
+        self.stopping = False
+        self.restart_requested = False
+
+    # ------------------------------------------------------------------
+    # Proceso padre
+    # ------------------------------------------------------------------
+
+    def preload(self):
+        """Carga la aplicación y los modelos una sola vez en el padre"""
+        start = time.time()
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        module = __import__(self.args.app_module)
+        self.app = getattr(module, "app")
+        # Mover todo lo cargado a la generación permanente: el GC no tocará
+        # esos objetos en los workers y sus páginas seguirán compartidas
+        gc.collect()
+        gc.freeze()
+        print(f"[Launcher] Aplicación precargada en {time.time() - start:.1f}s "
+              f"({gc.get_freeze_count()} objetos congelados)")
+
+    def bind(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.args.host, self.args.port))
+        self.sock.listen(2048)
+        self.sock.set_inheritable(True)
+        print(f"[Launcher] Escuchando en {self.args.host}:{self.args.port} con {self.args.workers} workers")
+
+    def spawn(self, slot: int) -> int:
+        self.heartbeats.reset(slot)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.run_worker(slot)
+            finally:
+                os._exit(0)
+        self.workers[slot] = pid
+        print(f"[Launcher] Worker {slot} iniciado (pid {pid})")
+        return pid
+
+    def wait_healthy(self, slot: int, timeout: float) -> bool:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.heartbeats.last(slot) > 0:
+                return True
+            time.sleep(0.1)
+        return False
+
+    def stop_worker(self, pid: int, timeout: float):
+        """SIGTERM y espera ordenada; SIGKILL si no termina a tiempo"""
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            done, _ = os.waitpid(pid, os.WNOHANG)
+            if done:
+                return
+            time.sleep(0.1)
+        print(f"[Launcher] Worker pid {pid} no terminó en {timeout}s, forzando SIGKILL")
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+    def rolling_restart(self):
+        """Reinicia los workers de uno en uno sin dejar de atender"""
+        print("[Launcher] Reinicio escalonado solicitado")
+        for slot in sorted(self.workers):
+            old_pid = self.workers[slot]
+            self.stop_worker(old_pid, self.args.graceful_timeout)
+            self.spawn(slot)
+            if not self.wait_healthy(slot, self.args.health_timeout):
+                print(f"[Launcher] Worker {slot} no reportó heartbeat tras reiniciar")
+        print("[Launcher] Reinicio escalonado completado")
+
+    def reap(self):
+        """Recoge workers terminados y los vuelve a lanzar"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = next((s for s, p in self.workers.items() if p == pid), None)
+            if slot is None:
+                continue
+            del self.workers[slot]
+            if not self.stopping:
+                print(f"[Launcher] Worker {slot} (pid {pid}) terminó con estado {status}, relanzando")
+                self.spawn(slot)
+
+    def check_health(self):
+        """Reinicia los workers cuyo event loop lleva demasiado sin heartbeat"""
+        now = time.time()
+        for slot, pid in list(self.workers.items()):
+            last = self.heartbeats.last(slot)
+            if last and now - last > self.args.health_timeout:
+                print(f"[Launcher] Worker {slot} (pid {pid}) sin heartbeat desde hace {now - last:.0f}s, reiniciando")
+                self.stop_worker(pid, self.args.graceful_timeout)
+                self.workers.pop(slot, None)
+                self.spawn(slot)
+
+    def report_memory(self):
+        total_pss = 0
+        for slot, pid in sorted(self.workers.items()):
+            usage = read_memory_usage(pid)
+            if not usage:
+                continue
+            total_pss += usage["pss_kb"]
+            print(f"[Launcher] Worker {slot} (pid {pid}): RSS {usage['rss_kb'] / 1024:.0f} MB, "
+                  f"PSS {usage['pss_kb'] / 1024:.0f} MB, USS {usage['uss_kb'] / 1024:.0f} MB, "
+                  f"compartida {usage['shared_kb'] / 1024:.0f} MB")
+        parent = read_memory_usage(os.getpid())
+        if parent:
+            total_pss += parent["pss_kb"]
+            print(f"[Launcher] Padre: PSS {parent['pss_kb'] / 1024:.0f} MB. PSS total: {total_pss / 1024:.0f} MB")
+
+    def _on_term(self, signum, frame):
+        self.stopping = True
+
+    def _on_hup(self, signum, frame):
+        self.restart_requested = True
+
+    def run(self):
+        self.preload()
+        self.bind()
+        signal.signal(signal.SIGTERM, self._on_term)
+        signal.signal(signal.SIGINT, self._on_term)
+        signal.signal(signal.SIGHUP, self._on_hup)
+        for slot in range(self.args.workers):
+            self.spawn(slot)
+        for slot in range(self.args.workers):
+            if not self.wait_healthy(slot, self.args.health_timeout):
+                print(f"[Launcher] Worker {slot} no reportó heartbeat al arrancar")
+        self.report_memory()
+
+        last_report = time.time()
+        while not self.stopping:
+            self.reap()
+            if self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+                self.report_memory()
+            self.check_health()
+            if self.args.memory_report_interval and time.time() - last_report > self.args.memory_report_interval:
+                self.report_memory()
+                last_report = time.time()
+            time.sleep(0.5)
+
+        print("[Launcher] Deteniendo workers...")
+        for pid in list(self.workers.values()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.workers.values()):
+            self.stop_worker(pid, self.args.graceful_timeout)
+        self.workers.clear()
+        print("[Launcher] Todos los workers detenidos")
+
+    # ------------------------------------------------------------------
+    # Proceso worker
+    # ------------------------------------------------------------------
+
+    def run_worker(self, slot: int):
+        import uvicorn
+
+        from shutdown import DrainingServer
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        # SIGHUP es para el padre (reinicio escalonado); un HUP al grupo no debe matar workers
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        os.environ["CHATBOT_WORKER_SLOT"] = str(slot)
+
+        config = uvicorn.Config(self.app, log_level=self.args.log_level, timeout_graceful_shutdown=self.args.graceful_timeout)
+        # Drena los turnos en curso de la aplicación antes de cerrar las conexiones
+        server = DrainingServer(config)
+
+        async def heartbeat():
+            while True:
+                self.heartbeats.beat(slot)
+                await asyncio.sleep(self.args.heartbeat_interval)
+
+        async def serve():
+            task = asyncio.get_running_loop().create_task(heartbeat())
+            try:
+                await server.serve(sockets=[self.sock])
+            finally:
+                task.cancel()
+
+        asyncio.run(serve())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Lanzador multi-proceso del chatbot")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("CHATBOT_WORKERS", "1")),
+                        help="Número de workers (CHATBOT_WORKERS)")
+    parser.add_argument("--allow-split-sessions", action="store_true",
+                        default=os.getenv("CHATBOT_ALLOW_SPLIT_SESSIONS", "false").lower() == "true",
+                        help="Permite varios workers aunque cada uno tenga sus propias sesiones "
+                             "(CHATBOT_ALLOW_SPLIT_SESSIONS)")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--app-module", default="main_improved_fixed")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0,
+                        help="Segundos de espera al detener un worker")
+    parser.add_argument("--heartbeat-interval", type=float, default=2.0)
+    parser.add_argument("--health-timeout", type=float, default=30.0,
+                        help="Segundos sin heartbeat antes de reiniciar un worker")
+    parser.add_argument("--memory-report-interval", type=float, default=300.0,
+                        help="Cada cuántos segundos informar PSS/USS (0 = solo al arrancar)")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers debe ser al menos 1")
+    if args.workers > 1 and not args.allow_split_sessions:
+        parser.error("las sesiones se guardan en la memoria de cada worker y no hay afinidad por usuario: "
+                     "una cita o un flujo SSE se rompe si sus peticiones llegan a workers distintos. "
+                     "Usa --workers 1 o, si cada petición es independiente, --allow-split-sessions")
+    return args
+
+
+if __name__ == "__main__":
+    Launcher(parse_args()).run()
@@ -0,0 +1,213 @@
+"""
+Control adaptativo de carga (load shedding).
+
+Mide el retraso del event loop y la latencia reciente de las dependencias
+externas y, cuando se degradan, desactiva las consultas en vivo al backend:
+
+    0 normal        todo activo
+    1 sin backend   se responde con la información por defecto sin llamar al backend
+
+Es la única etapa cara que corre en cada turno: el pipeline de
+process_message no usa los LLM ni la similitud semántica, así que no hay
+niveles para ellos. Las respuestas por palabras clave y el menú siguen
+funcionando siempre.
+
+Cada dependencia tiene sus propios umbrales de latencia y solo cuentan las
+que los tienen: una llamada normal de varios segundos a un LLM no apaga el
+backend. Sube de nivel en cuanto se supera un umbral y baja de uno en uno
+tras `recovery_seconds` por debajo. Las muestras de latencia caducan tras
+`latency_horizon` segundos, de modo que una dependencia que se ha dejado de
+llamar por estar degradada vuelve a probarse pasado ese tiempo.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+LEVEL_NAMES = ("normal", "sin_backend")
+
+# Nivel a partir del cual se desactiva cada etapa
+TIER_DISABLED_AT = {
+    "backend": 1,
+}
+
+# Latencia media (s) de cada dependencia a partir de la cual se sube a cada nivel
+DEFAULT_LATENCY_THRESHOLDS: Dict[str, Sequence[float]] = {
+    "backend": (5.0,),
+}
+
+
+def _level_for(value: float, thresholds: Sequence[float]) -> int:
+    level = 0
+    for threshold in thresholds:
+        if value >= threshold:
+            level += 1
+    return level
+
+
+class LoadShedder:
+    """Calcula el nivel de degradación a partir de lag y latencia"""
+
+    def __init__(
+        self,
+        lag_thresholds: Sequence[float] = (0.5,),
+        latency_thresholds: Optional[Dict[str, Sequence[float]]] = None,
+        window: int = 50,
+        recovery_seconds: float = 15.0,
+        latency_horizon: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.lag_thresholds = tuple(lag_thresholds)
+        self.latency_thresholds = {
+            name: tuple(thresholds)
+            for name, thresholds in (latency_thresholds if latency_thresholds is not None else DEFAULT_LATENCY_THRESHOLDS).items()
+        }
+        self.recovery_seconds = recovery_seconds
+        self.latency_horizon = latency_horizon
+        self.clock = clock
+        self._lags: Deque[float] = deque(maxlen=window)
+        self._latencies: Dict[str, Deque[Tuple[float, float]]] = {}
+        self._window = window
+        self.level = 0
+        self._below_since: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        # Las latencias se registran desde los hilos del pool NLP
+        self._lock = threading.RLock()
+        self.level_gauge = registry.gauge("load_shedding_level")
+        self.lag_histogram = registry.histogram("event_loop_lag_seconds")
+        self.registry = registry
+
+    # ------------------------------------------------------------------
+    # Señales
+    # ------------------------------------------------------------------
+
+    def record_lag(self, seconds: float):
+        self.lag_histogram.observe(seconds)
+        with self._lock:
+            self._lags.append(seconds)
+            self._update()
+
+    def record_latency(self, dependency: str, seconds: float):
+        self.registry.histogram(f"downstream_{dependency}_latency_seconds").observe(seconds)
+        with self._lock:
+            samples = self._latencies.get(dependency)
+            if samples is None:
+                samples = self._latencies[dependency] = deque(maxlen=self._window)
+            samples.append((self.clock(), seconds))
+            self._update()
+
+    @contextmanager
+    def track(self, dependency: str):
+        """Mide la duración de una llamada a una dependencia externa"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_latency(dependency, time.perf_counter() - start)
+
+    def current_lag(self) -> float:
+        if not self._lags:
+            return 0.0
+        # Media de las últimas muestras para no reaccionar a un pico aislado
+        recent = list(self._lags)[-5:]
+        return sum(recent) / len(recent)
+
+    def _recent_latencies(self, dependency: str) -> List[float]:
+        samples = self._latencies.get(dependency)
+        if not samples:
+            return []
+        oldest = self.clock() - self.latency_horizon
+        while samples and samples[0][0] < oldest:
+            samples.popleft()
+        return [value for _, value in samples]
+
+    def latency(self, dependency: str) -> float:
+        recent = self._recent_latencies(dependency)
+        return sum(recent) / len(recent) if recent else 0.0
+
+    def latency_level(self) -> int:
+        """Nivel que piden las dependencias, cada una con sus umbrales"""
+        return max(
+            (_level_for(self.latency(name), thresholds) for name, thresholds in self.latency_thresholds.items()),
+            default=0,
+        )
+
+    # ------------------------------------------------------------------
+    # Nivel
+    # ------------------------------------------------------------------
+
+    def _update(self):
+        target = max(
+            _level_for(self.current_lag(), self.lag_thresholds),
+            self.latency_level(),
+        )
+        now = self.clock()
+        if target > self.level:
+            self._set_level(target)
+            self._below_since = None
+        elif target < self.level:
+            if self._below_since is None:
+                self._below_since = now
+            elif now - self._below_since >= self.recovery_seconds:
+                self._set_level(self.level - 1)
+                self._below_since = now
+        else:
+            self._below_since = None
+
+    def _set_level(self, level: int):
+        if level != self.level:
+            print(f"[LoadShedding] Nivel {self.level} ({LEVEL_NAMES[self.level]}) -> {level} ({LEVEL_NAMES[level]})")
+            self.registry.counter(f"load_shedding_transitions_to_{LEVEL_NAMES[level]}_total").inc()
+        self.level = level
+        self.level_gauge.set(level)
+
+    def allows(self, tier: str) -> bool:
+        """Indica si una etapa (backend) está activa"""
+        with self._lock:
+            self._update()
+            return self.level < TIER_DISABLED_AT[tier]
+
+    def status(self) -> Dict[str, object]:
+        with self._lock:
+            return self._status()
+
+    def _status(self) -> Dict[str, object]:
+        return {
+            "level": self.level,
+            "mode": LEVEL_NAMES[self.level],
+            "disabled": [tier for tier, at in TIER_DISABLED_AT.items() if self.level >= at],
+            "event_loop_lag_ms": round(self.current_lag() * 1000, 1),
+            "downstream_latency_ms": {
+                name: round(self.latency(name) * 1000, 1) for name in list(self._latencies)
+            },
+        }
+
+    # ------------------------------------------------------------------
+    # Medición del event loop
+    # ------------------------------------------------------------------
+
+    async def monitor_event_loop(self, interval: float = 0.5):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.record_lag(max(0.0, time.perf_counter() - start - interval))
+
+    def start(self, interval: float = 0.5):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.monitor_event_loop(interval))
+        return self._task
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -4,15 +4,44 @@ from pydantic import BaseModel
 import spacy
 import nltk
 import requests
-import json
 import os
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime
 import random
-from typing import Optional, Dict, Any
+import secrets
+import copy
+import asyncio
+from typing import Optional, Dict, Any, List, Set, Tuple
 import time
-import threading
 from fastapi import Request
+from inactivity import InactivityMonitor, InactivitySessionHandlers
+from conversation_history import ConversationHistory, HistoryStore
+from session_features import APPOINTMENT_OFFER
+from metrics import metrics
+from session_locks import SessionLocks
+from worker_pool import BoundedWorkerPool, PoolBusyError, io_bound_workers
+from rate_limit import ChatRateLimits, RateLimiter, forwarded_client_ip
+from load_shedding import LoadShedder
+from ws_codec import ChatJSONResponse, codec_for, dumps, negotiate
+from ws_connection import WebSocketConnection
+from session_stream import SessionStream, SessionStreamRegistry
+from sse import SSE_HEADERS, SSEConnection, parse_last_event_id
+from batch import new_namespace, run_batch
+from shutdown import ShutdownCoordinator, ShuttingDownError, serve
+from session_snapshot import SessionSnapshotter, SnapshotStore
+from backend_writes import BackendWriteBehind, BatchUnsupported
+from resilience import Dependencies
+from availability import AvailabilityEngine, parse_backend_datetime
+from slot_holds import SlotHoldRegistry
+from prefetch import SessionPrefetcher
+from notices import NoticeBox
+from appointment_flow import (
+    COMPLETED, START_PROMPT, AppointmentFlow, AppointmentState, appointment_summary, is_affirmative_response,
+)
+from outbox import DELIVERED, FAILED, PENDING, OutboxDispatcher, OutboxEntry, OutboxStore, PermanentDeliveryError
+from idempotency import IdempotencyCache, idempotency_key
+from debounce import MessageCoalescer
+from fastapi.responses import StreamingResponse
 
 # ============================================================================
 # MEJORAS NLP SIMPLES (COMPATIBLE CON WINDOWS)
@@ -78,6 +107,30 @@ HF_API_URL = "https://api-inference.huggingface.co/models/HuggingFaceH4/zephyr-7
 # Configuración del backend
 BACKEND_URL = os.getenv("BACKEND_URL", "https://experimento2-production-54c0.up.railway.app")
 
+# Sin consultas en vivo al backend si el event loop va con retraso o el propio backend está lento.
+# La latencia de los LLM no cuenta: solo se comparan con su umbral las dependencias listadas
+load_shedder = LoadShedder(
+    lag_thresholds=(float(os.getenv("LOAD_SHEDDING_LAG_SECONDS", "0.5")),),
+    latency_thresholds={"backend": (float(os.getenv("LOAD_SHEDDING_BACKEND_LATENCY_SECONDS", "5")),)},
+    recovery_seconds=float(os.getenv("LOAD_SHEDDING_RECOVERY_SECONDS", "15")),
+)
+
+# Plazos, reintentos y circuit breaker por dependencia externa (ver resilience.py)
+dependencies = Dependencies(
+    failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("BREAKER_RESET_SECONDS", "30")),
+    on_latency=load_shedder.record_latency,
+)
+backend_dependency = dependencies.add(
+    "backend",
+    timeout=float(os.getenv("BACKEND_TIMEOUT_SECONDS", "5")),
+    retries=int(os.getenv("BACKEND_RETRIES", "1")),
+)
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "15"))
+# Los modelos de lenguaje ya son el último recurso: sin reintentos para no alargar el turno
+for provider in ("huggingface", "openai", "cohere", "anthropic"):
+    dependencies.add(provider, timeout=LLM_TIMEOUT_SECONDS, retries=0)
+
 # Descargar recursos necesarios de NLTK
 nltk.download('punkt', quiet=True)
 nltk.download('stopwords', quiet=True)
@@ -93,7 +146,7 @@ except OSError:
     subprocess.run(["python", "-m", "spacy", "download", "es_core_news_sm"])
     subprocess.run(["python", "-m", "spacy", "download", "en_core_web_sm"])
 
-app = FastAPI(title="Despacho Legal Chatbot", version="1.0.0")
+app = FastAPI(title="Despacho Legal Chatbot", version="1.0.0", default_response_class=ChatJSONResponse)
 
 # Configurar CORS
 cors_origins = os.getenv("CORS_ORIGIN")
@@ -152,25 +205,8 @@ class Message(BaseModel):
     text: str
     language: str = "es"
     user_id: Optional[str] = None
-
-# Estructura para manejar conversaciones de citas
-class AppointmentConversation:
-    def __init__(self):
-        self.stage: str = "initial"  # initial, collecting_info, confirmation, completed
-        self.data: Dict[str, Optional[str | int]] = {
-            "fullName": None,
-            "age": None,
-            "phone": None,
-            "email": None,
-            "consultationReason": None,
-            "preferredDate": None,
-            "alternativeDate": None,
-            "consultationType": None,
-            "notes": None,
-            "location": None
-        }
-        self.current_question: Optional[str] = None
-        self.context: Dict[str, Any] = {}  # Para mantener contexto de la conversación
+    # Canal de origen ("telegram", ...); decide la ventana de agrupación de mensajes
+    transport: Optional[str] = None
 
 # Estructura para manejar el contexto general de la conversación
 class ConversationContext:
@@ -185,10 +221,12 @@ class ConversationContext:
         self.interaction_count: int = 0
 
 # Almacenar conversaciones activas
-active_conversations: Dict[str, AppointmentConversation] = {}
+active_conversations: Dict[str, AppointmentState] = {}
 
-# Almacenar historial de conversaciones
-conversation_histories: Dict[str, list] = {}
+# Almacenar historial de conversaciones (buffer circular compartido por /chat y /ws)
+CHAT_HISTORY_CAPACITY = int(os.getenv("CHAT_HISTORY_CAPACITY", "10"))
+CHAT_HISTORY_MAX_BYTES = int(os.getenv("CHAT_HISTORY_MAX_BYTES", "8192"))
+conversation_histories = HistoryStore(capacity=CHAT_HISTORY_CAPACITY, max_bytes=CHAT_HISTORY_MAX_BYTES)
 
 # Almacenar contexto de conversación por usuario
 conversation_contexts: Dict[str, ConversationContext] = {}
@@ -198,13 +236,40 @@ last_activity: Dict[str, float] = {}
 # Almacenar advertencia enviada
 warned_inactive: Dict[str, bool] = {}
 
+# Sesiones de lotes en modo prueba (ver /chat/batch): no envían citas ni retienen
+# horarios, no se registran en el backend y no se guardan en las instantáneas
+dry_run_sessions: Set[str] = set()
+
 # Almacenar conexiones WebSocket activas por usuario
-active_websockets: Dict[str, WebSocket] = {}
+active_websockets: Dict[str, WebSocketConnection] = {}
+
+# Cola de salida por conexión y heartbeat (ver ws_connection.py)
+WS_MAX_QUEUE = int(os.getenv("WS_MAX_QUEUE", "32"))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "close")  # close | drop_oldest
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "45"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+# Clientes Server-Sent Events activos por usuario (ver sse.py)
+active_event_streams: Dict[str, SSEConnection] = {}
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "3000"))
+
+# Mensajes numerados con búfer de repetición para reanudar sesiones (ver session_stream.py).
+# La repetición se encola entera al reconectar, así que debe caber en la cola de salida.
+session_streams = SessionStreamRegistry(
+    capacity=min(int(os.getenv("SESSION_REPLAY_BUFFER", "16")), WS_MAX_QUEUE - 1),
+    max_sessions=int(os.getenv("SESSION_STREAMS_MAX", "10000")),
+)
 
 def get_backend_info():
     """Obtiene información del backend"""
+    if not load_shedder.allows("backend"):
+        return {}
     try:
-        contact_response = requests.get(f"{BACKEND_URL}/api/parametros/contact", timeout=5)
+        contact_response = backend_dependency.call(
+            lambda timeout: requests.get(f"{BACKEND_URL}/api/parametros/contact", timeout=timeout)
+        )
         if contact_response.status_code == 200:
             contact_params = contact_response.json()
             contact_info = {}
@@ -217,8 +282,12 @@ def get_backend_info():
 
 def get_services_info():
     """Obtiene información de servicios del backend"""
+    if not load_shedder.allows("backend"):
+        return ['Derecho Civil', 'Derecho Mercantil', 'Derecho Laboral', 'Derecho Familiar', 'Derecho Penal', 'Derecho Administrativo']
     try:
-        cases_response = requests.get(f"{BACKEND_URL}/api/cases", timeout=5)
+        cases_response = backend_dependency.call(
+            lambda timeout: requests.get(f"{BACKEND_URL}/api/cases", timeout=timeout)
+        )
         if cases_response.status_code == 200:
             cases = cases_response.json()
             services = set()
@@ -248,8 +317,16 @@ def get_services_info():
 
 def get_honorarios_info():
     """Obtiene información de honorarios"""
+    if not load_shedder.allows("backend"):
+        return {
+            'promedio': 150.0,
+            'rango': '€50.00 - €300.00',
+            'consulta_inicial': 'Gratuita'
+        }
     try:
-        invoices_response = requests.get(f"{BACKEND_URL}/api/invoices", timeout=5)
+        invoices_response = backend_dependency.call(
+            lambda timeout: requests.get(f"{BACKEND_URL}/api/invoices", timeout=timeout)
+        )
         if invoices_response.status_code == 200:
             invoices = invoices_response.json()
             if invoices:
@@ -269,38 +346,7 @@ def get_honorarios_info():
         'consulta_inicial': 'Gratuita'
     }
 
-def is_affirmative_response(text: str) -> bool:
-    """Verifica si la respuesta es afirmativa"""
-    # Palabras específicamente afirmativas (siempre indican afirmación)
-    affirmative_words = ["sí", "si", "yes", "ok", "okay", "claro", "correcto", "exacto", "afirmativo"]
-    # Palabras que pueden ser afirmativas pero también descriptivas
-    context_dependent_words = ["perfecto", "excelente", "genial", "bueno", "vale"]
-    
-    text_lower = text.lower().strip()
-    
-    # Si contiene palabras específicamente afirmativas
-    if any(word in text_lower for word in affirmative_words):
-        return True
-    
-    # Para palabras dependientes del contexto, verificar que sea una respuesta muy específica
-    for word in context_dependent_words:
-        if word in text_lower:
-            # Solo considerar afirmativa si es una respuesta muy corta y directa
-            words = text_lower.split()
-            if len(words) == 1 and words[0] == word:
-                return True
-            # O si es una respuesta muy corta con una palabra adicional
-            if len(words) == 2 and words[0] == word and words[1] in ["gracias", "ok", "vale"]:
-                return True
-    
-    return False
-
-def is_negative_response(text: str) -> bool:
-    """Verifica si la respuesta es negativa"""
-    negative_words = ["no", "nop", "nope", "negativo", "incorrecto", "mal", "error", "no me interesa", "no por ahora"]
-    return any(word in text.lower() for word in negative_words)
-
-def detect_intent(text: str, conversation_history: list = []) -> Dict[str, float]:
+def detect_intent(text: str, conversation_history: Optional[ConversationHistory] = None) -> Dict[str, float]:
     """Detecta múltiples intenciones con puntuaciones de confianza"""
     text_lower = text.lower().strip()
     
@@ -344,18 +390,12 @@ def detect_intent(text: str, conversation_history: list = []) -> Dict[str, float
             # Aumentar el umbral para evitar detecciones falsas
             intents[intent] = min(1.0, matches / len(pattern_list) + 0.5)
     
-    # Análisis contextual basado en el historial
+    # Análisis contextual basado en los últimos mensajes (rasgos ya calculados al añadirlos)
     if conversation_history:
-        last_messages = conversation_history[-3:]
-        for msg in last_messages:
-            if msg.get("isUser"):
-                msg_text = msg.get("text", "").lower()
-                # Si el usuario mencionó citas antes, aumentar probabilidad
-                if any(word in msg_text for word in ["agendar cita", "programar cita", "cita con abogado", "quiero agendar", "necesito agendar", "cita", "quiero cita", "necesito una cita"]):
-                    intents["appointment"] += 0.3
-                # Si mencionó precios, aumentar probabilidad
-                if any(word in msg_text for word in ["costo", "precio", "honorarios"]):
-                    intents["pricing"] += 0.3
+        features = conversation_history.features
+        # Si el usuario mencionó citas o precios antes, aumentar probabilidad
+        intents["appointment"] += 0.3 * features.count("appointment")
+        intents["pricing"] += 0.3 * features.count("pricing")
     
     return intents
 
@@ -440,258 +480,162 @@ def get_appointment_links():
         "email": "citas@despacholegal.com"
     }
 
-def extract_age(text: str) -> Optional[int]:
-    """Extrae edad del texto con validación estricta"""
-    try:
-        # Limpiar el texto y buscar solo números
-        import re
-        # Buscar números que estén solos (no parte de otros números)
-        numbers = re.findall(r'\b(\d{1,3})\b', text.strip())
-        
-        # Si hay múltiples números, tomar el primero que sea válido
-        for num in numbers:
-            age = int(num)
-            # Validación estricta: solo edades entre 18 y 100
-            if 18 <= age <= 100:
-                return age
-        
-        # Si no se encontró una edad válida, verificar si el texto es solo un número
-        text_clean = text.strip()
-        if text_clean.isdigit():
-            age = int(text_clean)
-            if 18 <= age <= 100:
-                return age
-            else:
-                return None  # Edad fuera del rango válido
-                
-    except (ValueError, TypeError):
-        pass
-    
-    return None
+# Disponibilidad real: descuenta las citas ya reservadas (ver availability.py).
+# El listado de citas del backend requiere un token; sin él solo se conocen las enviadas desde aquí.
+BACKEND_API_TOKEN = os.getenv("BACKEND_API_TOKEN")
+
+def fetch_booked_appointments() -> List[Dict[str, Any]]:
+    response = backend_dependency.call(lambda timeout: requests.get(
+        f"{BACKEND_URL}/api/appointments/visitor",
+        headers={"Authorization": f"Bearer {BACKEND_API_TOKEN}"},
+        timeout=timeout,
+    ))
+    if response.status_code != 200:
+        raise RuntimeError(f"respuesta {response.status_code}")
+    return response.json()
+
+availability = AvailabilityEngine(
+    fetch=fetch_booked_appointments if BACKEND_API_TOKEN else None,
+    slot_hours=[int(hour) for hour in os.getenv("APPOINTMENT_HOURS", "9,11,14,16,18").split(",")],
+    slot_minutes=int(os.getenv("APPOINTMENT_MINUTES", "60")),
+    capacity=int(os.getenv("APPOINTMENT_SLOT_CAPACITY", "1")),
+    refresh_interval=float(os.getenv("AVAILABILITY_REFRESH_SECONDS", "60")),
+)
 
-def extract_phone(text: str) -> Optional[str]:
-    """Extrae número de teléfono del texto"""
-    import re
-    # Patrones para teléfonos españoles
-    patterns = [
-        r'\+34\s*\d{9}',  # +34 612345678
-        r'\+34\s*\d{3}\s*\d{3}\s*\d{3}',  # +34 612 345 678
-        r'\d{9}',  # 612345678
-        r'\d{3}\s*\d{3}\s*\d{3}'  # 612 345 678
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            phone = match.group()
-            # Limpiar espacios
-            phone = re.sub(r'\s+', '', phone)
-            return phone
-    return None
+# Retenciones de horario entre la elección de fecha y la confirmación (ver slot_holds.py).
+# El fichero lo comparten todos los workers, así que no lleva sufijo por worker.
+slot_holds = SlotHoldRegistry(
+    os.getenv("SLOT_HOLDS_PATH", "slot_holds.db"),
+    ttl=float(os.getenv("SLOT_HOLD_SECONDS", "600")),
+)
 
-def extract_email(text: str) -> Optional[str]:
-    """Extrae email del texto"""
-    import re
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    match = re.search(email_pattern, text)
-    return match.group() if match else None
-
-def get_available_dates():
-    """Genera fechas disponibles para citas"""
-    dates = []
-    base_date = datetime.now()
-    
-    # Generar fechas para los próximos 15 días, solo días laborables
-    for i in range(1, 16):
-        date = base_date + timedelta(days=i)
-        if date.weekday() < 5:  # Lunes a Viernes (0-4)
-            # Generar horarios diferentes para cada día
-            hours = [9, 11, 14, 16, 18]  # Horarios disponibles
-            for hour in hours:
-                appointment_date = date.replace(hour=hour, minute=0, second=0, microsecond=0)
-                dates.append(appointment_date)
-    
-    return dates[:8]  # Limitar a 8 opciones (más manejable)
+def get_available_dates(user_id: Optional[str] = None):
+    """Genera fechas disponibles para citas (sin los horarios retenidos por otras sesiones)"""
+    held = slot_holds.held(exclude_holder=user_id)
+    return availability.available(  # Limitar a 8 opciones (más manejable)
+        limit=8, exclude=lambda slot, remaining: held.get(slot, 0) >= remaining
+    )
 
-def handle_appointment_conversation(user_id: str, message: str) -> str:
-    """Maneja la conversación de agendar citas"""
-    conv = active_conversations[user_id]
-    text_lower = message.lower().strip()
-    
-    print(f"[DEBUG] Appointment conversation - Stage: {conv.stage}, Message: '{message}', Data: {conv.data}")
-    
-    # Etapa inicial - detectar si quiere agendar cita
-    if conv.stage == "initial":
-        if any(word in text_lower for word in ["cita", "agendar", "programar", "consulta", "reunión", "visita"]):
-            conv.stage = "collecting_info"
-            return "¡Perfecto! Te ayudo a agendar tu cita. Para comenzar, necesito algunos datos:\n\n¿Cuál es tu nombre completo?"
-        elif is_affirmative_response(text_lower):
-            conv.stage = "collecting_info"
-            return "¡Perfecto! Te ayudo a agendar tu cita. Para comenzar, necesito algunos datos:\n\n¿Cuál es tu nombre completo?"
-        else:
-            return "Entiendo. ¿Te gustaría agendar una cita para que nuestros abogados puedan ayudarte mejor?"
-    
-    # Etapa de recopilación de información
-    elif conv.stage == "collecting_info":
-        # Pregunta actual basada en qué datos faltan
-        if conv.data['fullName'] is None:
-            if len(message.strip()) > 2:  # Validar que no sea muy corto
-                conv.data['fullName'] = message.strip()
-                return f"Gracias {conv.data['fullName']}. ¿Cuál es tu edad?"
-            else:
-                return "Por favor, proporciona tu nombre completo."
-        
-        elif conv.data['age'] is None:
-            age = extract_age(message)
-            print(f"[DEBUG] Age extraction - Input: '{message}', Extracted age: {age}")
-            if age:
-                conv.data['age'] = age
-                return "Perfecto. ¿Cuál es tu número de teléfono de contacto?"
-            else:
-                # Mensaje más específico según el tipo de error
-                text_clean = message.strip()
-                if text_clean.isdigit():
-                    age_value = int(text_clean)
-                    if age_value < 18:
-                        return "Debes ser mayor de edad (18 años o más) para agendar una cita. Por favor, proporciona tu edad real."
-                    elif age_value > 100:
-                        return "Por favor, proporciona una edad válida (entre 18 y 100 años)."
-                else:
-                    return "Por favor, proporciona tu edad (solo el número, entre 18 y 100 años)."
-        
-        elif conv.data['phone'] is None:
-            phone = extract_phone(message)
-            if phone:
-                conv.data['phone'] = phone
-                return "Excelente. ¿Cuál es tu correo electrónico?"
-            else:
-                return "Por favor, proporciona un número de teléfono válido (ejemplo: 612345678 o +34 612345678)."
-        
-        elif conv.data['email'] is None:
-            email = extract_email(message)
-            if email:
-                conv.data['email'] = email
-                return "Muy bien. ¿Cuál es el motivo de tu consulta? (Por ejemplo: despido, acoso laboral, impago de salarios, etc.)"
-            else:
-                return "Por favor, proporciona un email válido."
-        
-        elif conv.data['consultationReason'] is None:
-            if len(message.strip()) > 3:  # Validar que no sea muy corto
-                conv.data['consultationReason'] = message.strip()
-                # Determinar automáticamente el tipo de consulta basado en el motivo
-                reason_lower = message.lower()
-                if any(word in reason_lower for word in ["despido", "trabajo", "laboral", "empleo", "contrato", "salario", "horario"]):
-                    conv.data['consultationType'] = "Derecho Laboral"
-                elif any(word in reason_lower for word in ["divorcio", "familia", "hijos", "custodia", "pensión"]):
-                    conv.data['consultationType'] = "Derecho Familiar"
-                elif any(word in reason_lower for word in ["herencia", "testamento", "sucesión"]):
-                    conv.data['consultationType'] = "Derecho Civil"
-                elif any(word in reason_lower for word in ["empresa", "comercial", "mercantil", "sociedad"]):
-                    conv.data['consultationType'] = "Derecho Mercantil"
-                elif any(word in reason_lower for word in ["multa", "sanción", "administrativo"]):
-                    conv.data['consultationType'] = "Derecho Administrativo"
-                else:
-                    conv.data['consultationType'] = "Derecho Civil"  # Por defecto
-                
-                # Generar fechas disponibles
-                available_dates = get_available_dates()
-                conv.context['available_dates'] = available_dates
-                
-                date_options = []
-                for i, date in enumerate(available_dates, 1):
-                    date_str = date.strftime("%A %d de %B a las %H:%M")
-                    date_options.append(f"• {i}. {date_str}")
-                
-                return f"Perfecto. ¿Qué fecha prefieres para tu consulta?\n\nOpciones disponibles:\n" + "\n".join(date_options) + f"\n\nResponde con el número de la opción que prefieras (1-{len(available_dates)})."
-            else:
-                return "Por favor, describe el motivo de tu consulta con más detalle."
-        
-        elif conv.data['preferredDate'] is None:
-            try:
-                date_index = int(message.strip()) - 1
-                available_dates = conv.context.get('available_dates', [])
-                print(f"[DEBUG] Date selection - Input: '{message}', Parsed index: {date_index}, Available dates count: {len(available_dates)}")
-                
-                if 0 <= date_index < len(available_dates):
-                    selected_date = available_dates[date_index]
-                    conv.data['preferredDate'] = selected_date.isoformat() + "Z"
-                    conv.stage = "confirmation"
-                    return create_confirmation_message(conv.data)
-                else:
-                    # Mostrar las opciones disponibles nuevamente
-                    date_options = []
-                    for i, date in enumerate(available_dates, 1):
-                        date_str = date.strftime("%A %d de %B a las %H:%M")
-                        date_options.append(f"• {i}. {date_str}")
-                    
-                    return f"Por favor, selecciona una opción válida (1-{len(available_dates)}):\n\n" + "\n".join(date_options)
-            except ValueError:
-                print(f"[DEBUG] Date selection - Invalid input: '{message}'")
-                # Mostrar las opciones disponibles nuevamente
-                available_dates = conv.context.get('available_dates', [])
-                date_options = []
-                for i, date in enumerate(available_dates, 1):
-                    date_str = date.strftime("%A %d de %B a las %H:%M")
-                    date_options.append(f"• {i}. {date_str}")
-                
-                return f"Por favor, responde con el número de la opción (1-{len(available_dates)}):\n\n" + "\n".join(date_options)
-    
-    # Confirmación
-    elif conv.stage == "confirmation":
-        if is_affirmative_response(message):
-            # Guardar cita en backend
-            try:
-                print(f"[DEBUG] Intentando crear cita con datos: {conv.data}")
-                response = requests.post(f"{BACKEND_URL}/api/appointments/visitor", json=conv.data, timeout=10)
-                print(f"[DEBUG] Respuesta del backend: {response.status_code} - {response.text}")
-                
-                if response.status_code == 201:
-                    conv.stage = "completed"
-                    del active_conversations[user_id]  # Limpiar conversación
-                    preferred_date = conv.data['preferredDate']
-                    if isinstance(preferred_date, str):
-                        date_str = preferred_date[:10]
-                    else:
-                        date_str = "Fecha no especificada"
-                    return f"¡Perfecto! Tu cita ha sido agendada exitosamente.\n\n📅 **Detalles de tu cita:**\n• Nombre: {conv.data['fullName']}\n• Fecha: {date_str}\n• Motivo: {conv.data['consultationReason']}\n\nTe hemos enviado un email de confirmación a {conv.data['email']}.\n\nUn abogado se pondrá en contacto contigo pronto para confirmar los detalles. ¡Gracias por confiar en nosotros!"
-                else:
-                    print(f"[DEBUG] Error del backend: {response.status_code} - {response.text}")
-                    return f"Lo siento, hubo un problema al agendar tu cita (Error {response.status_code}). Por favor, contacta directamente al despacho por teléfono o email."
-            except Exception as e:
-                print(f"[DEBUG] Error saving appointment: {e}")
-                return f"Lo siento, hubo un problema al agendar tu cita (Error: {str(e)}). Por favor, contacta directamente al despacho por teléfono o email."
-        elif is_negative_response(message):
-            conv.stage = "collecting_info"
-            conv.data = {key: None for key in conv.data}
-            conv.current_question = None
-            return "Entiendo. Empecemos de nuevo. ¿Cuál es tu nombre completo?"
-        else:
-            return "Por favor, responde 'sí' para confirmar o 'no' para empezar de nuevo."
-    
-    return "No entiendo. ¿Podrías repetir?"
+# Precarga especulativa: al entrar en el flujo de citas se cargan en segundo plano
+# los huecos libres y el contacto del despacho (ver prefetch.py)
+prefetcher = SessionPrefetcher(
+    max_age=float(os.getenv("PREFETCH_MAX_AGE_SECONDS", "120")),
+    wait=float(os.getenv("PREFETCH_WAIT_SECONDS", "0.5")),
+    workers=int(os.getenv("PREFETCH_WORKERS", "2")),
+)
 
-def create_confirmation_message(data: Dict[str, Any]) -> str:
-    """Crea mensaje de confirmación con los datos recopilados"""
-    preferred_date = data['preferredDate']
-    if isinstance(preferred_date, str):
-        date_str = preferred_date[:10]
-    else:
-        date_str = "Fecha no especificada"
-    
-    return f"""📋 **Resumen de tu cita:**
+def prefetch_available_dates(user_id: str):
+    prefetcher.start(user_id, {"available_dates": lambda: get_available_dates(user_id)})
+
+def start_appointment(user_id: str, stage: str = "initial") -> AppointmentState:
+    """Abre el flujo de citas y empieza a precargar lo que se mostrará en los próximos turnos"""
+    state = AppointmentState(stage)
+    active_conversations[user_id] = state
+    prefetcher.start(user_id, {
+        "available_dates": lambda: get_available_dates(user_id),
+        "contact_info": get_backend_info,
+    })
+    return state
 
-👤 **Datos personales:**
-• Nombre: {data['fullName']}
-• Edad: {data['age']} años
-• Teléfono: {data['phone']}
-• Email: {data['email']}
+def offer_available_dates(user_id: str):
+    """Huecos para ofrecer: los precargados la primera vez, recalculados después"""
+    available_dates = prefetcher.get(user_id, "available_dates", lambda: get_available_dates(user_id))
+    prefetcher.discard(user_id, "available_dates")
+    return available_dates
 
-⚖️ **Consulta:**
-• Motivo: {data['consultationReason']}
-• Área: {data['consultationType']}
-• Fecha preferida: {date_str}
+def hold_slot(user_id: str, slot: datetime) -> bool:
+    if user_id in dry_run_sessions:
+        return True
+    return slot_holds.acquire(slot, user_id, capacity=availability.remaining(slot))
+
+def no_dates_message(user_id: str) -> str:
+    contact_info = prefetcher.get(user_id, "contact_info", get_backend_info)
+    return f"Lo siento, no quedan horarios libres en las próximas semanas. Por favor, contacta directamente al despacho en el {contact_info.get('CONTACT_PHONE', '(555) 123-4567')} o en {contact_info.get('CONTACT_EMAIL', 'info@despacholegal.com')}."
+
+def on_appointment_stage(user_id: str, state: AppointmentState):
+    if state.stage == "reason":
+        # El siguiente turno muestra las fechas: se recargan para que estén frescas
+        prefetch_available_dates(user_id)
+
+def confirm_appointment(user_id: str, state: AppointmentState) -> str:
+    """Envía la cita confirmada al outbox (una sola vez por sesión y datos)"""
+    if user_id in dry_run_sessions:
+        # Reproducción de prueba: se contesta como si se hubiera registrado, sin enviarla ni ocupar el horario
+        state.stage = COMPLETED
+        return appointment_summary(state.data, "¡Perfecto! Hemos registrado tu solicitud de cita.")
+    # La clave sale de la sesión y los datos: la misma cita no se envía dos veces
+    key = idempotency_key(user_id, state.data)
+    status = appointment_status(key)
+    if status is not None:
+        return replay_appointment(user_id, state, key, status)
+    submitted = False
+    try:
+        print(f"[DEBUG] Guardando cita en el outbox: {state.data}")
+        # Antes de enviarla: el resultado puede llegar antes de que termine este turno
+        state.stage = "submitting"
+        state.key = key
+        submissions.record(key, PENDING)
+        # Queda en disco y se entrega al backend en segundo plano (ver outbox.py)
+        outbox.submit("appointment", {"user_id": user_id, "data": state.data}, key=key)
+        submitted = True
+        # El horario queda ocupado ya, sin esperar a que el backend confirme
+        availability.book(key, parse_backend_datetime(state.data['preferredDate']))
+        slot_holds.release(user_id)
+        prefetcher.discard(user_id)
+        if APPOINTMENT_ASYNC_CONFIRMATION:
+            # El resultado final se envía al usuario cuando el backend responda
+            return APPOINTMENT_PROCESSING_MESSAGE
+        state.stage = COMPLETED
+        return appointment_summary(state.data, "¡Perfecto! Hemos registrado tu solicitud de cita.")
+    except Exception as e:
+        print(f"[DEBUG] Error saving appointment: {e}")
+        if not submitted:
+            # No llegó al outbox: se puede volver a confirmar sin duplicarla
+            submissions.discard(key)
+            state.stage = "confirmation"
+        return f"Lo siento, hubo un problema al agendar tu cita (Error: {str(e)}). Por favor, contacta directamente al despacho por teléfono o email."
+
+def replay_appointment(user_id: str, state: AppointmentState, key: str, status: str) -> str:
+    """Repetición de una cita ya enviada: se contesta con su resultado sin reenviarla"""
+    print(f"[Idempotency] Cita {key[:12]} ya enviada ({status}), no se reenvía")
+    slot_holds.release(user_id)
+    if status == PENDING and APPOINTMENT_ASYNC_CONFIRMATION:
+        state.stage = "submitting"
+        state.key = key
+        return APPOINTMENT_PENDING_MESSAGE
+    state.stage = COMPLETED
+    if status == FAILED:
+        return APPOINTMENT_FAILED_MESSAGE
+    if status == DELIVERED:
+        return appointment_summary(state.data, "✅ Esta cita ya está registrada.")
+    return appointment_summary(state.data, "¡Perfecto! Hemos registrado tu solicitud de cita.")
+
+# Confirmación asíncrona (opcional): el turno responde al momento y el resultado llega
+# después por WebSocket/SSE o en la siguiente respuesta de /chat (ver notices.py)
+APPOINTMENT_ASYNC_CONFIRMATION = os.getenv("APPOINTMENT_ASYNC_CONFIRMATION", "false").lower() == "true"
+APPOINTMENT_PROCESSING_MESSAGE = "⏳ Procesando tu cita… Te avisaré por aquí en cuanto quede registrada."
+APPOINTMENT_PENDING_MESSAGE = "⏳ Tu cita se sigue procesando. Te avisaré por aquí en cuanto quede registrada."
+
+# Flujo de citas como tabla de estados (ver appointment_flow.py)
+appointment_flow = AppointmentFlow(
+    available_dates=offer_available_dates,
+    hold=hold_slot,
+    release=slot_holds.release,
+    submit=confirm_appointment,
+    no_dates=no_dates_message,
+    on_enter=on_appointment_stage,
+    pending_message=APPOINTMENT_PENDING_MESSAGE,
+)
 
-¿Está todo correcto? Responde 'sí' para confirmar o 'no' para empezar de nuevo."""
+def handle_appointment_conversation(user_id: str, message: str) -> Optional[str]:
+    """Maneja la conversación de agendar citas"""
+    state = active_conversations[user_id]
+    print(f"[DEBUG] Appointment conversation - Stage: {state.stage}, Message: '{message}', Data: {state.data}")
+    response = appointment_flow.handle(user_id, state, message)
+    if state.stage == COMPLETED:
+        active_conversations.pop(user_id, None)
+        prefetcher.discard(user_id)
+    return response
 
 # Base de conocimientos mejorada
 def get_knowledge_base():
@@ -869,21 +813,22 @@ def get_semantic_similarity_response(user_message: str, knowledge_base: dict) ->
 
 def get_cloud_service_response(user_message: str, service: str = "openai") -> Optional[str]:
     """Obtiene respuesta de servicios en la nube."""
-    
     if service == "openai" and CLOUD_SERVICES_AVAILABLE["openai"]:
         try:
             import openai
-            client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+            # Reintentos y plazo los gestiona la capa de resiliencia, no el SDK
+            client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
             
-            response = client.chat.completions.create(
+            response = dependencies["openai"].call(lambda timeout: client.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
                     {"role": "system", "content": "Eres un asistente legal profesional. Responde de manera clara y concisa."},
                     {"role": "user", "content": user_message}
                 ],
                 max_tokens=100,
-                temperature=0.7
-            )
+                temperature=0.7,
+                timeout=timeout
+            ))
             
             response_text = response.choices[0].message.content
             print("[OpenAI] Respuesta generada por OpenAI")
@@ -896,14 +841,14 @@ def get_cloud_service_response(user_message: str, service: str = "openai") -> Op
     elif service == "cohere" and CLOUD_SERVICES_AVAILABLE["cohere"]:
         try:
             import cohere
-            co = cohere.Client(os.getenv("COHERE_API_KEY"))
+            co = cohere.Client(os.getenv("COHERE_API_KEY"), timeout=LLM_TIMEOUT_SECONDS)
             
-            response = co.generate(
+            response = dependencies["cohere"].call(lambda timeout: co.generate(
                 model="command",
                 prompt=f"Eres un asistente legal. Usuario: {user_message}",
                 max_tokens=100,
                 temperature=0.7
-            )
+            ))
             
             response_text = response.generations[0].text
             print("[Cohere] Respuesta generada por Cohere")
@@ -916,15 +861,16 @@ def get_cloud_service_response(user_message: str, service: str = "openai") -> Op
     elif service == "anthropic" and CLOUD_SERVICES_AVAILABLE["anthropic"]:
         try:
             import anthropic
-            client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+            client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0)
             
-            response = client.messages.create(
+            response = dependencies["anthropic"].call(lambda timeout: client.messages.create(
                 model="claude-3-haiku-20240307",
                 max_tokens=100,
                 messages=[
                     {"role": "user", "content": f"Eres un asistente legal. {user_message}"}
-                ]
-            )
+                ],
+                timeout=timeout
+            ))
             
             response_text = response.content[0].text
             print("[Anthropic] Respuesta generada por Anthropic")
@@ -936,7 +882,7 @@ def get_cloud_service_response(user_message: str, service: str = "openai") -> Op
     
     return None
 
-def get_hf_response(user_message: str, conversation_history: list = []) -> Optional[str]:
+def get_hf_response(user_message: str, conversation_history: Optional[ConversationHistory] = None) -> Optional[str]:
     """Obtiene respuesta de Hugging Face"""
     if not HF_API_TOKEN:
         return None
@@ -947,11 +893,12 @@ def get_hf_response(user_message: str, conversation_history: list = []) -> Optio
         # Construir prompt
         prompt = build_prompt(conversation_history, user_message)
         
-        response = requests.post(
+        response = dependencies["huggingface"].call(lambda timeout: requests.post(
             HF_API_URL,
             headers=headers,
-            json={"inputs": prompt, "parameters": {"max_new_tokens": 150, "temperature": 0.7}}
-        )
+            json={"inputs": prompt, "parameters": {"max_new_tokens": 150, "temperature": 0.7}},
+            timeout=timeout
+        ))
         
         if response.status_code == 200:
             result = response.json()
@@ -1001,7 +948,7 @@ CONTEXTO DE LA CONVERSACIÓN:"""
 
     conversation_context = ""
     if conversation_history:
-        recent_messages = conversation_history[-3:]
+        recent_messages = conversation_history.recent(3)
         for msg in recent_messages:
             role = "Usuario" if msg.get("isUser") else "Asistente"
             conversation_context += f"{role}: {msg['text']}\n"
@@ -1009,7 +956,7 @@ CONTEXTO DE LA CONVERSACIÓN:"""
     full_prompt = f"{system_prompt}\n{conversation_context}Usuario: {user_message}\nAsistente:"
     return full_prompt
 
-def process_message_fallback(text: str, language: str = "es", conversation_history: list = []) -> str:
+def process_message_fallback(text: str, language: str = "es", conversation_history: Optional[ConversationHistory] = None) -> str:
     """Procesa mensaje usando base de conocimientos local con mejor contexto"""
     knowledge_base = get_knowledge_base()
     text_lower = text.lower().strip()
@@ -1024,17 +971,16 @@ def process_message_fallback(text: str, language: str = "es", conversation_histo
     
     # Analizar el contexto de la conversación para respuestas más naturales
     if conversation_history:
-        recent_messages = conversation_history[-3:]
-        user_messages = [msg.get("text", "").lower() for msg in recent_messages if msg.get("isUser")]
+        features = conversation_history.features
         
         # Si el usuario ha estado preguntando sobre temas específicos
-        if any("precio" in msg or "costo" in msg or "honorarios" in msg for msg in user_messages):
+        if features.mentioned("pricing"):
             return "Entiendo tu interés en los costos. Para darte una estimación precisa, necesitaría conocer más detalles de tu caso. ¿Te gustaría agendar una consulta gratuita para discutir los honorarios específicos?"
         
-        if any("servicio" in msg or "especialidad" in msg or "área" in msg for msg in user_messages):
+        if features.mentioned("services"):
             return "Me alegra tu interés en nuestros servicios. ¿En qué área específica del derecho necesitas ayuda o tienes alguna pregunta concreta sobre nuestros servicios?"
         
-        if any("contacto" in msg or "teléfono" in msg or "email" in msg for msg in user_messages):
+        if features.mentioned("contact"):
             return "¿Hay algo más en lo que pueda ayudarte o te gustaría agendar una cita para discutir tu caso en detalle?"
     
     # Respuestas genéricas más naturales y variadas
@@ -1051,9 +997,9 @@ def process_message_fallback(text: str, language: str = "es", conversation_histo
     
     return random.choice(generic_responses)
 
-def process_message(text: str, language: str = "es", conversation_history: list | None = None, user_id: Optional[str] = None) -> str:
+def process_message(text: str, language: str = "es", conversation_history: Optional[ConversationHistory] = None, user_id: Optional[str] = None) -> str:
     if conversation_history is None:
-        conversation_history = []
+        conversation_history = ConversationHistory(CHAT_HISTORY_CAPACITY, CHAT_HISTORY_MAX_BYTES)
     
     # Generar user_id si no se proporciona
     if not user_id:
@@ -1074,6 +1020,8 @@ def process_message(text: str, language: str = "es", conversation_history: list
     if text.lower().strip() in ["reset", "reiniciar", "limpiar", "nuevo", "empezar de nuevo"]:
         if user_id in active_conversations:
             del active_conversations[user_id]
+            slot_holds.release(user_id)
+            prefetcher.discard(user_id)
         conversation_contexts.pop(user_id, None)
         return "🔄 Conversación reiniciada. ¿En qué puedo ayudarte?"
     
@@ -1085,8 +1033,8 @@ def process_message(text: str, language: str = "es", conversation_history: list
     
     # Manejar opciones numéricas del menú (solo si NO hay conversación activa)
     if text.strip() in ["1", "1️⃣", "uno", "primero"]:
-        active_conversations[user_id] = AppointmentConversation()
-        return "¡Perfecto! Te ayudo a agendar tu cita. Para comenzar, necesito algunos datos:\n\n¿Cuál es tu nombre completo?"
+        start_appointment(user_id, "name")
+        return START_PROMPT
     
     if text.strip() in ["2", "2️⃣", "dos", "segundo"]:
         return """📋 **Información General del Despacho:**
@@ -1143,28 +1091,17 @@ def process_message(text: str, language: str = "es", conversation_history: list
     
     # Detectar intención de agendar cita (umbral ajustado)
     if intents.get("appointment", 0) > 0.6:
-        active_conversations[user_id] = AppointmentConversation()
+        start_appointment(user_id)
         appointment_response = handle_appointment_conversation(user_id, text)
         if appointment_response:
             return appointment_response
     
     # Verificar respuestas afirmativas que podrían ser sobre citas (contexto más específico)
     if is_affirmative_response(text):
-        if conversation_history:
-            last_assistant_message = None
-            for msg in reversed(conversation_history):
-                if not msg.get("isUser"):
-                    last_assistant_message = msg.get("text", "").lower()
-                    break
-            
-            # Verificar que el último mensaje del asistente sea específicamente sobre agendar citas
-            if last_assistant_message and any(phrase in last_assistant_message for phrase in [
-                "agendar tu cita", "programar tu cita", "ayudarte a agendar", "empezar a agendar",
-                "¿te gustaría que te ayude a programar una cita?", "¿te gustaría agendar una cita?",
-                "te recomiendo programar una cita", "brindarte la mejor asesoría"
-            ]):
-                active_conversations[user_id] = AppointmentConversation()
-                return "¡Perfecto! Te ayudo a agendar tu cita. Para comenzar, necesito algunos datos:\n\n¿Cuál es tu nombre completo?"
+        # Verificar que el último mensaje del asistente sea específicamente sobre agendar citas
+        if conversation_history and conversation_history.features.last_prompt == APPOINTMENT_OFFER:
+            start_appointment(user_id, "name")
+            return START_PROMPT
     
     # Manejar emergencias
     if intents.get("emergency", 0) > 0.6:
@@ -1252,6 +1189,17 @@ def process_message(text: str, language: str = "es", conversation_history: list
 
 Responde con el número de la opción que prefieras o escribe tu consulta directamente."""
 
+BACKEND_WRITE_TIMEOUT_SECONDS = float(os.getenv("BACKEND_WRITE_TIMEOUT_SECONDS", "10"))
+
+def backend_auth_headers() -> Dict[str, str]:
+    """/api/chatbot/* está protegido con JWT: sin BACKEND_API_TOKEN el backend responde 401"""
+    return {"Authorization": f"Bearer {BACKEND_API_TOKEN}"} if BACKEND_API_TOKEN else {}
+
+def reject_client_error(response):
+    """Un 4xx (salvo 408/429) no se arregla reintentando: se marca como fallo definitivo"""
+    if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+        raise PermanentDeliveryError(f"{response.status_code} - {response.text}")
+
 # Función para crear conversación en el backend
 def create_backend_conversation(session_id: str, user_email: str = None, user_phone: str = None, conversation_type: str = "appointment"):
     """Crea una nueva conversación en el backend"""
@@ -1269,12 +1217,15 @@ def create_backend_conversation(session_id: str, user_email: str = None, user_ph
             }
         }
         
-        response = requests.post(f"{BACKEND_URL}/api/chatbot/conversations", json=conversation_data, timeout=10)
+        response = backend_dependency.call(lambda timeout: requests.post(f"{BACKEND_URL}/api/chatbot/conversations", json=conversation_data, headers=backend_auth_headers(), timeout=timeout), timeout=BACKEND_WRITE_TIMEOUT_SECONDS)
         if response.status_code == 201:
             return response.json()
         else:
             print(f"[DEBUG] Error creando conversación: {response.status_code} - {response.text}")
+            reject_client_error(response)
             return None
+    except PermanentDeliveryError:
+        raise
     except Exception as e:
         print(f"[DEBUG] Error creando conversación: {e}")
         return None
@@ -1294,12 +1245,15 @@ def add_backend_message(conversation_id: str, message_type: str, content: str, i
             "error": error
         }
         
-        response = requests.post(f"{BACKEND_URL}/api/chatbot/conversations/{conversation_id}/messages", json=message_data, timeout=10)
+        response = backend_dependency.call(lambda timeout: requests.post(f"{BACKEND_URL}/api/chatbot/conversations/{conversation_id}/messages", json=message_data, headers=backend_auth_headers(), timeout=timeout), timeout=BACKEND_WRITE_TIMEOUT_SECONDS)
         if response.status_code == 201:
             return response.json()
         else:
             print(f"[DEBUG] Error agregando mensaje: {response.status_code} - {response.text}")
+            reject_client_error(response)
             return None
+    except PermanentDeliveryError:
+        raise
     except Exception as e:
         print(f"[DEBUG] Error agregando mensaje: {e}")
         return None
@@ -1312,12 +1266,15 @@ def complete_backend_conversation(conversation_id: str, appointment_id: str = No
         if appointment_id:
             data["appointmentId"] = appointment_id
             
-        response = requests.put(f"{BACKEND_URL}/api/chatbot/conversations/{conversation_id}/complete", json=data, timeout=10)
+        response = backend_dependency.call(lambda timeout: requests.put(f"{BACKEND_URL}/api/chatbot/conversations/{conversation_id}/complete", json=data, headers=backend_auth_headers(), timeout=timeout), timeout=BACKEND_WRITE_TIMEOUT_SECONDS)
         if response.status_code == 200:
             return response.json()
         else:
             print(f"[DEBUG] Error completando conversación: {response.status_code} - {response.text}")
+            reject_client_error(response)
             return None
+    except PermanentDeliveryError:
+        raise
     except Exception as e:
         print(f"[DEBUG] Error completando conversación: {e}")
         return None
@@ -1335,139 +1292,748 @@ def log_backend_email(recipient: str, subject: str, template: str, appointment_i
             "metadata": metadata or {}
         }
         
-        response = requests.post(f"{BACKEND_URL}/api/chatbot/email-logs", json=email_data, timeout=10)
+        response = backend_dependency.call(lambda timeout: requests.post(f"{BACKEND_URL}/api/chatbot/email-logs", json=email_data, headers=backend_auth_headers(), timeout=timeout), timeout=BACKEND_WRITE_TIMEOUT_SECONDS)
         if response.status_code == 201:
             return response.json()
         else:
             print(f"[DEBUG] Error registrando email: {response.status_code} - {response.text}")
+            reject_client_error(response)
             return None
+    except PermanentDeliveryError:
+        raise
     except Exception as e:
         print(f"[DEBUG] Error registrando email: {e}")
         return None
 
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    conversation_history = []
-    user_id = None
-    try:
-        while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            user_id = message.get("user_id", "anonymous")
-            # REGISTRA el websocket activo
-            active_websockets[user_id] = websocket
+def send_backend_log_batch(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Envía de una vez un lote de eventos de registro (ver backend_writes.py)"""
+    response = backend_dependency.call(lambda timeout: requests.post(f"{BACKEND_URL}/api/chatbot/batch", json=payload, headers=backend_auth_headers(), timeout=timeout), timeout=BACKEND_WRITE_TIMEOUT_SECONDS)
+    if response.status_code in (404, 405, 501):
+        raise BatchUnsupported(response.status_code)
+    reject_client_error(response)
+    response.raise_for_status()
+    return response.json()
+
+def backend_unavailable() -> bool:
+    """Backend desactivado por carga o con el circuito abierto: los envíos de fondo esperan"""
+    return not load_shedder.allows("backend") or backend_dependency.breaker.retry_in() > 0
+
+# Registro de conversaciones en el backend sin bloquear los turnos.
+# Desactivado por defecto: requiere BACKEND_API_TOKEN (ver backend_auth_headers)
+BACKEND_LOGGING_ENABLED = os.getenv("BACKEND_LOGGING_ENABLED", "false").lower() == "true"
+backend_writes = BackendWriteBehind(
+    create=create_backend_conversation,
+    add_message=add_backend_message,
+    complete=complete_backend_conversation,
+    log_email=log_backend_email,
+    send_batch=send_backend_log_batch,
+    batch_size=int(os.getenv("BACKEND_WRITE_BATCH_SIZE", "50")),
+    flush_interval=float(os.getenv("BACKEND_WRITE_FLUSH_SECONDS", "2")),
+    max_pending=int(os.getenv("BACKEND_WRITE_MAX_PENDING", "5000")),
+    # Con el backend degradado el registro espera (la cola está acotada)
+    paused=backend_unavailable,
+)
+
+def worker_path(path: str) -> str:
+    """Fichero propio del worker. El lanzador fija CHATBOT_WORKER_SLOT después de importar
+    la aplicación, así que se consulta al arrancar cada worker y no al importar."""
+    slot = os.getenv("CHATBOT_WORKER_SLOT")
+    return f"{path}.{slot}" if path and slot else path
+
+# Outbox en disco: citas y registros pendientes sobreviven a reinicios y caídas del backend.
+# Con varios workers cada uno usa su propio fichero (ver use_worker_paths)
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.db")
+APPOINTMENT_FAILED_MESSAGE = "⚠️ No hemos podido registrar tu cita en el sistema. Por favor, contacta directamente al despacho por teléfono o email."
+
+def submit_appointment(payload: Dict[str, Any], key: str) -> Dict[str, Any]:
+    """Envía una cita del outbox; la clave evita duplicarla si se reintenta"""
+    # Sin reintentos aquí: los hace el outbox con su propia espera
+    response = backend_dependency.call(
+        lambda timeout: requests.post(
+            f"{BACKEND_URL}/api/appointments/visitor",
+            json=payload["data"],
+            headers={"Idempotency-Key": key},
+            timeout=timeout,
+        ),
+        timeout=BACKEND_WRITE_TIMEOUT_SECONDS,
+        retries=0,
+    )
+    print(f"[Outbox] Respuesta del backend a la cita {key}: {response.status_code}")
+    if response.status_code == 201:
+        return response.json()
+    reject_client_error(response)
+    raise RuntimeError(f"respuesta {response.status_code}")
+
+async def finish_submission(entry: OutboxEntry, message: str):
+    """Cierra la conversación que esperaba esta cita y avisa al usuario.
+
+    Toma el lock de la sesión: un turno en el pool NLP puede estar usando la conversación.
+    """
+    user_id = entry.payload["user_id"]
+    async with session_locks.hold(user_id):
+        conv = active_conversations.get(user_id)
+        if conv is not None and conv.stage == "submitting" and conv.key == entry.key:
+            del active_conversations[user_id]
+        timestamp = datetime.now().isoformat()
+        if user_id in conversation_histories:
+            conversation_histories[user_id].append({"text": message, "isUser": False, "timestamp": timestamp})
+        notify(user_id, {"type": "message", "response": message, "timestamp": timestamp})
+        mark_session_dirty(user_id)
+
+# Avisos de citas en curso (referencias para que no los recoja el GC antes de terminar)
+submission_tasks: Set[asyncio.Task] = set()
+
+def schedule_finish_submission(entry: OutboxEntry, message: str):
+    """Los callbacks del outbox no esperan: el aviso se completa cuando se libere la sesión"""
+    task = asyncio.get_running_loop().create_task(finish_submission(entry, message))
+    submission_tasks.add(task)
+    task.add_done_callback(submission_tasks.discard)
+
+# Resultados recientes por clave de idempotencia (ver idempotency.py)
+submissions = IdempotencyCache(ttl=float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400")))
+
+def appointment_status(key: str) -> Optional[str]:
+    """Estado de una cita ya enviada con esta clave: de la caché o, tras un reinicio, del outbox"""
+    outcome = submissions.get(key)
+    if outcome is None:
+        stored = outbox.store.get(key)
+        if stored is None:
+            return None
+        outcome = submissions.record(key, stored["status"])
+    return outcome["status"]
+
+def appointment_delivered(entry: OutboxEntry, result: Any):
+    if entry.kind != "appointment":
+        return
+    submissions.record(entry.key, DELIVERED, result)
+    availability.confirm(entry.key, result or {})
+    user_id, data = entry.payload["user_id"], entry.payload["data"]
+    if APPOINTMENT_ASYNC_CONFIRMATION:
+        schedule_finish_submission(entry, appointment_summary(data, "✅ ¡Tu cita ha quedado registrada!"))
+    if not BACKEND_LOGGING_ENABLED:
+        return
+    appointment_id = (result or {}).get("id")
+    backend_writes.complete_conversation(user_id, appointment_id)
+    backend_writes.log_email(
+        recipient=data["email"],
+        subject="Confirmación de cita",
+        template="appointment_confirmation",
+        appointment_id=appointment_id,
+        metadata={"source": "chatbot"},
+    )
+
+def appointment_failed(entry: OutboxEntry, error: str):
+    if entry.kind != "appointment":
+        return
+    submissions.record(entry.key, FAILED, error)
+    availability.release(entry.key)
+    schedule_finish_submission(entry, APPOINTMENT_FAILED_MESSAGE)
+
+outbox = OutboxDispatcher(
+    OutboxStore(worker_path(OUTBOX_PATH)),
+    handlers={"appointment": submit_appointment, "conversation_log": lambda record, key: backend_writes.replay(record)},
+    on_delivered=appointment_delivered,
+    on_failed=appointment_failed,
+    max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8")),
+    # Un registro que no se pudo entregar no hace falta revisarlo: se purga con las entregas
+    discard_failed=("conversation_log",),
+    paused=backend_unavailable,
+)
+backend_writes.spill = lambda record: outbox.submit("conversation_log", record)
+
+def log_turn(user_id: str, text: str, response: str):
+    if BACKEND_LOGGING_ENABLED and user_id not in dry_run_sessions:
+        backend_writes.add_message(user_id, message_type="user_input", content=text)
+        backend_writes.add_message(user_id, message_type="bot_response", content=response)
+
+# Locks por usuario: un turno a la vez por user_id, usuarios distintos en paralelo
+session_locks = SessionLocks()
+
+# Pool acotado para los turnos fuera del event loop. Cada turno hace también llamadas
+# HTTP bloqueantes (backend, LLM), así que por defecto hay NLP_THREADS_PER_CPU hilos por CPU
+nlp_pool = BoundedWorkerPool(
+    max_workers=int(os.getenv("NLP_WORKERS", "0")) or io_bound_workers(int(os.getenv("NLP_THREADS_PER_CPU", "8"))),
+    max_queue=int(os.getenv("NLP_MAX_QUEUE")) if os.getenv("NLP_MAX_QUEUE") else None,
+)
+BUSY_MESSAGE = "⏳ Estamos atendiendo muchas consultas en este momento. Por favor, inténtalo de nuevo en unos segundos."
+
+# Agrupación de mensajes seguidos en un solo turno (ver debounce.py).
+# Ventana en ms por transporte; /chat sin "transport" usa la de "chat".
+COALESCE_WINDOWS_MS = os.getenv("COALESCE_WINDOWS_MS", "telegram=800,sse=800,chat=0")
+coalescer = MessageCoalescer(
+    windows={
+        name.strip(): float(ms) / 1000
+        for name, ms in (item.split("=") for item in COALESCE_WINDOWS_MS.split(",") if "=" in item)
+    },
+    max_wait=float(os.getenv("COALESCE_MAX_WAIT_MS", "3000")) / 1000,
+)
+
+# Limitación de frecuencia por usuario, IP y global (mensajes por segundo y ráfaga)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "10000"))
+rate_limits = ChatRateLimits(
+    user=RateLimiter(
+        rate=float(os.getenv("RATE_LIMIT_USER_RATE", "1")),
+        burst=float(os.getenv("RATE_LIMIT_USER_BURST", "5")),
+        max_keys=RATE_LIMIT_MAX_KEYS,
+    ),
+    ip=RateLimiter(
+        rate=float(os.getenv("RATE_LIMIT_IP_RATE", "3")),
+        burst=float(os.getenv("RATE_LIMIT_IP_BURST", "15")),
+        max_keys=RATE_LIMIT_MAX_KEYS,
+    ),
+    global_limiter=RateLimiter(
+        rate=float(os.getenv("RATE_LIMIT_GLOBAL_RATE", "50")),
+        burst=float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "100")),
+    ),
+)
+RATE_LIMITED_MESSAGE = "🚦 Estás enviando mensajes demasiado rápido. Espera un momento antes de continuar."
+
+# Proxies propios delante del servicio (Railway/Vercel: 1). 0 si el servicio está expuesto directamente
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
+def client_ip(headers, client) -> Optional[str]:
+    """IP real del cliente: la que añadió a X-Forwarded-For nuestro proxy, no la primera"""
+    return forwarded_client_ip(headers.get("x-forwarded-for"), client.host if client else None, TRUSTED_PROXY_HOPS)
+
+def check_rate_limit(user_id: str, ip: Optional[str]):
+    """Devuelve (permitido, segundos de espera)"""
+    if not RATE_LIMIT_ENABLED:
+        return True, 0.0
+    allowed, scope, retry_after = rate_limits.check(user_id, ip)
+    if not allowed:
+        print(f"[RateLimit] Mensaje rechazado para {user_id} ({ip}) por límite {scope}")
+    return allowed, retry_after
+
+# Parada ordenada: drena los turnos en curso antes de cerrar (ver shutdown.py)
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+SHUTDOWN_RECONNECT_SECONDS = int(os.getenv("SHUTDOWN_RECONNECT_SECONDS", "5"))
+shutdown_coordinator = ShutdownCoordinator(timeout=SHUTDOWN_DRAIN_SECONDS)
+app.state.shutdown_coordinator = shutdown_coordinator
+
+async def run_turn(user_id: str, text: str, language: str = "es") -> Tuple[str, str]:
+    """Ejecuta un turno completo de conversación de forma serializada por usuario.
+
+    Devuelve la respuesta y la marca de tiempo del turno (una sola por turno).
+    """
+    # Durante la parada no se admiten turnos nuevos (ShuttingDownError -> 503)
+    shutdown_coordinator.check_accepting()
+    # Registrar última actividad
+    last_activity[user_id] = time.time()
+    warned_inactive[user_id] = False
+    with shutdown_coordinator.track():
+        async with session_locks.hold(user_id):
+            # Rechazar antes de tocar el historial si el pool está saturado
+            nlp_pool.check_admission()
+            timestamp = datetime.now().isoformat()
+            conversation_history = conversation_histories.get(user_id)
             conversation_history.append({
-                "text": message["text"],
+                "text": text,
                 "isUser": True,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": timestamp
             })
-            response = process_message(
-                message["text"],
-                message.get("language", "es"),
-                conversation_history,
-                user_id
-            )
+            # process_message es CPU-bound: se ejecuta en el pool acotado
+            response = await nlp_pool.run(process_message, text, language, conversation_history, user_id)
             conversation_history.append({
                 "text": response,
                 "isUser": False,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": timestamp
             })
-            await websocket.send_text(json.dumps({
+    log_turn(user_id, text, response)
+    mark_session_dirty(user_id)
+    return response, timestamp
+
+class StreamMessage(Message):
+    session_token: Optional[str] = None
+    seq: Optional[int] = None
+
+def attach_stream(connection, stream: SessionStream, missed=(), resumed: bool = False, complete: bool = True):
+    """Asocia la conexión (WebSocket o SSE) al flujo de la sesión y le envía el token y lo perdido"""
+    stream.attach(connection.send)
+    connection.send({
+        "type": "session",
+        "session_token": stream.token,
+        "user_id": stream.user_id,
+        "resumed": resumed,
+        "complete": complete,
+        "last_seq": stream.last_seq
+    })
+    for frame in missed:
+        connection.send(frame)
+    # Resultados que llegaron sin conexión abierta
+    for notice in notices.take(stream.user_id):
+        stream.publish(notice)
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    # Sub-protocolo binario msgpack opcional; JSON (orjson) por defecto
+    subprotocol = negotiate(websocket.scope.get("subprotocols"))
+    await websocket.accept(subprotocol=subprotocol)
+    # Los envíos pasan por una cola acotada con escritor propio
+    connection = WebSocketConnection(
+        websocket,
+        codec_for(subprotocol),
+        max_queue=WS_MAX_QUEUE,
+        overflow=WS_OVERFLOW_POLICY,
+        ping_interval=WS_PING_INTERVAL,
+        ping_timeout=WS_PING_TIMEOUT,
+        send_timeout=WS_SEND_TIMEOUT,
+    ).start()
+    stream: Optional[SessionStream] = None
+    try:
+        while True:
+            message = await connection.receive()
+            kind = message.get("type")
+            if kind == "resume":
+                # Reconexión: {"type": "resume", "session_token": ..., "last_seq": n}
+                stream, missed, complete = session_streams.resume(message.get("session_token"), int(message.get("last_seq") or 0))
+                resumed = stream is not None
+                if not resumed:
+                    # Token desconocido o caducado: el cliente debe empezar de nuevo
+                    stream = session_streams.open(message.get("user_id", "anonymous"))
+                attach_stream(connection, stream, missed, resumed=resumed, complete=complete)
+                active_websockets[stream.user_id] = connection
+                continue
+            if kind == "ack":
+                if stream:
+                    stream.ack(int(message.get("seq") or 0))
+                continue
+            user_id = message.get("user_id") or (stream.user_id if stream else "anonymous")
+            if stream is None or stream.user_id != user_id:
+                # REGISTRA la conexión activa con un flujo de sesión nuevo. Conocer el user_id
+                # no basta para heredar un flujo existente (su búfer): eso exige el token ("resume")
+                stream = session_streams.open(user_id)
+                attach_stream(connection, stream)
+                active_websockets[user_id] = connection
+            seq = message.get("seq")
+            if stream.is_duplicate(seq):
+                # Reenvío de un mensaje ya procesado: su respuesta está en el búfer
+                continue
+            allowed, retry_after = check_rate_limit(user_id, client_ip(websocket.headers, websocket.client))
+            if not allowed:
+                stream.publish({
+                    "type": "error",
+                    "code": 429,
+                    "message": RATE_LIMITED_MESSAGE,
+                    "retry_after": round(retry_after, 1),
+                    "timestamp": datetime.now().isoformat()
+                })
+                continue
+            try:
+                response, timestamp = await run_turn(user_id, message["text"], message.get("language", "es"))
+            except PoolBusyError:
+                stream.publish({
+                    "type": "error",
+                    "code": 503,
+                    "message": BUSY_MESSAGE,
+                    "timestamp": datetime.now().isoformat()
+                })
+                continue
+            # Solo ahora cuenta como procesado: tras un 429 o 503 el cliente reenvía el mismo seq
+            stream.commit_client_seq(seq)
+            stream.publish({
                 "response": response,
-                "timestamp": datetime.now().isoformat()
-            }))
+                "timestamp": timestamp
+            })
     except WebSocketDisconnect:
-        if user_id and user_id in active_websockets:
-            del active_websockets[user_id]
         pass
+    finally:
+        # El flujo se conserva para poder reanudar; solo se desconecta esta conexión
+        if stream:
+            stream.detach(connection.send)
+            if active_websockets.get(stream.user_id) is connection:
+                del active_websockets[stream.user_id]
+        await connection.aclose()
+
+@app.get("/sse")
+async def sse_stream(request: Request, user_id: Optional[str] = None, session_token: Optional[str] = None, last_seq: Optional[int] = None):
+    """Flujo Server-Sent Events de la sesión; los mensajes se envían con POST /sse/message"""
+    stream, missed, complete = None, [], True
+    if session_token:
+        # EventSource reenvía el último id recibido en Last-Event-ID al reconectar
+        if last_seq is None:
+            last_seq = parse_last_event_id(request.headers.get("last-event-id"))
+        stream, missed, complete = session_streams.resume(session_token, last_seq)
+    resumed = stream is not None
+    if not resumed:
+        # Sin token válido siempre se abre un flujo nuevo (el anterior queda invalidado)
+        stream = session_streams.open(user_id or "anonymous")
+    connection = SSEConnection(max_queue=WS_MAX_QUEUE, keepalive=SSE_KEEPALIVE_SECONDS, retry_ms=SSE_RETRY_MS)
+    attach_stream(connection, stream, missed, resumed=resumed, complete=complete)
+    active_event_streams[stream.user_id] = connection
+
+    async def event_source():
+        try:
+            async for event in connection.events(request.is_disconnected):
+                yield event
+        finally:
+            stream.detach(connection.send)
+            if active_event_streams.get(stream.user_id) is connection:
+                del active_event_streams[stream.user_id]
+
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/sse/message")
+async def sse_message(message: StreamMessage, request: Request):
+    """Mensaje del usuario para un cliente SSE; la respuesta llega por el flujo de eventos"""
+    stream = session_streams.by_token(message.session_token)
+    if stream is None:
+        # Sin token válido: flujo nuevo, y el cliente lo abre después con el token devuelto.
+        # Nunca se devuelve el token de un flujo existente a quien solo conoce el user_id
+        stream = session_streams.open(message.user_id or "anonymous")
+    user_id = stream.user_id
+    if stream.is_duplicate(message.seq):
+        return ChatJSONResponse(status_code=202, content={"accepted": False, "duplicate": True, "session_token": stream.token})
+    allowed, retry_after = check_rate_limit(user_id, client_ip(request.headers, request.client))
+    if not allowed:
+        return ChatJSONResponse(
+            status_code=429,
+            content={"response": RATE_LIMITED_MESSAGE, "error": "rate_limited", "timestamp": datetime.now().isoformat()},
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+    text = await coalescer.submit(user_id, message.text, message.transport or "sse")
+    if text is None:
+        # Unido al turno del siguiente mensaje: su respuesta llega por el flujo
+        stream.commit_client_seq(message.seq)
+        return ChatJSONResponse(status_code=202, content={"accepted": True, "coalesced": True, "session_token": stream.token})
+    try:
+        response, timestamp = await run_turn(user_id, text, message.language)
+    except PoolBusyError:
+        return ChatJSONResponse(
+            status_code=503,
+            content={"response": BUSY_MESSAGE, "error": "busy", "timestamp": datetime.now().isoformat()},
+            headers={"Retry-After": "2"}
+        )
+    # Tras un 429 o 503 el seq no se marca: el cliente puede reenviar el mismo mensaje
+    stream.commit_client_seq(message.seq)
+    frame = stream.publish({
+        "response": response,
+        "timestamp": timestamp
+    })
+    return ChatJSONResponse(status_code=202, content={"accepted": True, "seq": frame["seq"], "session_token": stream.token})
+
+# Lotes de turnos para QA y analítica (ver batch.py). Desactivado si no hay token.
+BATCH_API_TOKEN = os.getenv("BATCH_API_TOKEN")
+BATCH_MAX_TURNS = int(os.getenv("BATCH_MAX_TURNS", "10000"))
+# Siempre por debajo del tamaño del pool para dejar hilos al tráfico en vivo
+BATCH_CONCURRENCY = max(1, min(
+    int(os.getenv("BATCH_CONCURRENCY", str(nlp_pool.max_workers // 4))),
+    nlp_pool.max_workers - 1,
+))
+
+class BatchTurn(BaseModel):
+    user_id: str
+    text: str
+    language: str = "es"
+
+class BatchRequest(BaseModel):
+    turns: List[BatchTurn]
+    # Libera el estado de cada usuario al terminar sus turnos
+    release_sessions: bool = True
+    # Sin efectos fuera de la sesión: ni citas en el outbox, ni retenciones, ni registro en el backend
+    dry_run: bool = True
+
+async def process_batch(turns, release_sessions: bool = True, dry_run: bool = True):
+    """Procesa un lote con el mismo pipeline que /chat; genera resultados según terminan.
+
+    Las sesiones del lote llevan un prefijo propio y no se mezclan con las de los usuarios."""
+
+    async def handler(session_id: str, text: str, language: str):
+        if dry_run:
+            dry_run_sessions.add(session_id)
+        return await run_turn(session_id, text, language)
+
+    async for result in run_batch(
+        turns,
+        handler,
+        concurrency=BATCH_CONCURRENCY,
+        give_up_on=(ShuttingDownError,),
+        on_user_done=release_session if release_sessions else None,
+        namespace=new_namespace(),
+    ):
+        yield result
+
+@app.post("/chat/batch")
+async def chat_batch(batch: BatchRequest, request: Request):
+    """Turnos (user_id, text) en lote; responde NDJSON, una línea por turno"""
+    if not BATCH_API_TOKEN:
+        return ChatJSONResponse(status_code=404, content={"error": "batch_disabled"})
+    if not secrets.compare_digest(request.headers.get("authorization", ""), f"Bearer {BATCH_API_TOKEN}"):
+        return ChatJSONResponse(status_code=401, content={"error": "unauthorized"})
+    if len(batch.turns) > BATCH_MAX_TURNS:
+        return ChatJSONResponse(status_code=413, content={"error": "too_many_turns", "max_turns": BATCH_MAX_TURNS})
+
+    async def lines():
+        async for result in process_batch(batch.turns, batch.release_sessions, batch.dry_run):
+            yield dumps(result) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 @app.post("/end_chat")
 async def end_chat(request: Request):
     data = await request.json()
     user_id = data.get("user_id", "anonymous")
-    active_conversations.pop(user_id, None)
-    conversation_histories.pop(user_id, None)
-    conversation_contexts.pop(user_id, None)  # Limpiar contexto de conversación
-    last_activity.pop(user_id, None)
-    warned_inactive.pop(user_id, None)
+    release_session(user_id)
     return {"status": "ended"}
 
 # Modificar el endpoint /chat para registrar actividad
 @app.post("/chat")
-async def chat(message: Message):
+async def chat(message: Message, request: Request):
     user_id = message.user_id or "anonymous"
-    # Registrar última actividad
-    last_activity[user_id] = time.time()
-    warned_inactive[user_id] = False
-    # Obtener o crear historial de conversación
-    if user_id not in conversation_histories:
-        conversation_histories[user_id] = []
-    conversation_history = conversation_histories[user_id]
-    conversation_history.append({
-        "text": message.text,
-        "isUser": True,
-        "timestamp": datetime.now().isoformat()
-    })
-    response = process_message(message.text, message.language, conversation_history, user_id)
-    conversation_history.append({
-        "text": response,
-        "isUser": False,
-        "timestamp": datetime.now().isoformat()
-    })
-    if len(conversation_history) > 10:
-        conversation_history = conversation_history[-10:]
-        conversation_histories[user_id] = conversation_history
-    return {
+    allowed, retry_after = check_rate_limit(user_id, client_ip(request.headers, request.client))
+    if not allowed:
+        return ChatJSONResponse(
+            status_code=429,
+            content={"response": RATE_LIMITED_MESSAGE, "error": "rate_limited", "timestamp": datetime.now().isoformat()},
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+    text = await coalescer.submit(user_id, message.text, message.transport)
+    if text is None:
+        # Unido al turno del siguiente mensaje, que devuelve la respuesta de todos
+        return {"response": None, "coalesced": True, "timestamp": datetime.now().isoformat()}
+    try:
+        response, timestamp = await run_turn(user_id, text, message.language)
+    except PoolBusyError:
+        return ChatJSONResponse(
+            status_code=503,
+            content={"response": BUSY_MESSAGE, "error": "busy", "timestamp": datetime.now().isoformat()},
+            headers={"Retry-After": "2"}
+        )
+    body = {
         "response": response,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": timestamp
+    }
+    pending = notices.take(user_id)
+    if pending:
+        body["notifications"] = pending
+    return body
+
+@app.get("/chat/updates")
+async def chat_updates(user_id: str = "anonymous"):
+    """Resultados diferidos (p. ej. la confirmación de una cita) para clientes de /chat"""
+    return {"notifications": notices.take(user_id)}
+
+# Gestión de inactividad dentro del event loop del servidor
+
+INACTIVITY_WARNING_SECONDS = float(os.getenv("INACTIVITY_WARNING_SECONDS", "50"))
+INACTIVITY_TIMEOUT_SECONDS = float(os.getenv("INACTIVITY_TIMEOUT_SECONDS", "60"))
+
+def release_session(user_id: str):
+    """Libera todo el estado en memoria de un usuario"""
+    active_conversations.pop(user_id, None)
+    conversation_histories.pop(user_id, None)
+    conversation_contexts.pop(user_id, None)
+    last_activity.pop(user_id, None)
+    warned_inactive.pop(user_id, None)
+    session_streams.release(user_id)
+    backend_writes.end_session(user_id)
+    slot_holds.release(user_id)
+    prefetcher.discard(user_id)
+    coalescer.discard(user_id)
+    mark_session_dirty(user_id)
+    dry_run_sessions.discard(user_id)
+
+def deliver(user_id: str, payload: Dict[str, Any]) -> bool:
+    """Publica un mensaje en el flujo de la sesión (se repite al reanudar si no llega)"""
+    stream = session_streams.for_user(user_id)
+    if stream is None:
+        return False
+    stream.publish(payload)
+    return True
+
+# Resultados diferidos para clientes sin WebSocket/SSE conectado
+notices = NoticeBox(ttl=float(os.getenv("NOTICE_TTL_SECONDS", "3600")))
+
+def notify(user_id: str, payload: Dict[str, Any]):
+    """Entrega un resultado diferido una sola vez: por la conexión abierta o en el buzón"""
+    stream = session_streams.for_user(user_id)
+    if stream is not None and stream.sink is not None:
+        stream.publish(payload)
+    else:
+        notices.push(user_id, payload)
+
+inactivity_handlers = InactivitySessionHandlers(
+    conversation_histories,
+    deliver,
+    release_session,
+    active_websockets,
+    active_event_streams,
+    warning_after=INACTIVITY_WARNING_SECONDS,
+    close_after=INACTIVITY_TIMEOUT_SECONDS,
+)
+warn_inactive_session = inactivity_handlers.warn
+close_inactive_session = inactivity_handlers.close
+
+inactivity_monitor = InactivityMonitor(
+    last_activity,
+    warned_inactive,
+    on_warning=warn_inactive_session,
+    on_timeout=close_inactive_session,
+    warning_after=INACTIVITY_WARNING_SECONDS,
+    close_after=INACTIVITY_TIMEOUT_SECONDS,
+)
+
+# Instantáneas de sesiones para reiniciar sin perder citas a medias (ver session_snapshot.py).
+# Con varios workers cada uno usa su propio fichero. Vacío = desactivado.
+SESSION_SNAPSHOT_PATH = os.getenv("SESSION_SNAPSHOT_PATH", "session_snapshot.bin")
+SESSION_SNAPSHOT_INTERVAL = float(os.getenv("SESSION_SNAPSHOT_INTERVAL", "30"))
+SESSION_SNAPSHOT_MAX_AGE = float(os.getenv("SESSION_SNAPSHOT_MAX_AGE", "3600"))
+
+def capture_session(user_id: str) -> Optional[Dict[str, Any]]:
+    """Copia serializable del estado de un usuario (None si ya no tiene sesión)"""
+    appointment = active_conversations.get(user_id)
+    context = conversation_contexts.get(user_id)
+    history = conversation_histories[user_id] if user_id in conversation_histories else None
+    stream = session_streams.for_user(user_id)
+    if user_id not in last_activity and appointment is None and context is None and history is None:
+        return None
+    return {
+        "last_activity": last_activity.get(user_id, time.time()),
+        "appointment": appointment.to_dict() if appointment else None,
+        "context": copy.deepcopy(vars(context)) if context else None,
+        "history": list(history) if history is not None else [],
+        "stream": {
+            "token": stream.token,
+            "next_seq": stream.next_seq,
+            "last_client_seq": stream.last_client_seq,
+            "buffer": list(stream.buffer)
+        } if stream else None
     }
 
-# Tarea background para limpiar sesiones inactivas y advertir
-
-def cleanup_inactive_sessions():
-    import asyncio
-    while True:
-        now = time.time()
-        for user_id in list(last_activity.keys()):
-            inactivity = now - last_activity[user_id]
-            if inactivity > 50 and not warned_inactive.get(user_id, False):
-                # Enviar advertencia por inactividad (se guarda en historial)
-                warning_msg = "⚠️ No hay actividad. El chat se cerrará automáticamente en 10 segundos si no respondes."
-                if user_id in conversation_histories:
-                    conversation_histories[user_id].append({
-                        "text": warning_msg,
-                        "isUser": False,
-                        "timestamp": datetime.now().isoformat()
-                    })
-                warned_inactive[user_id] = True
-            if inactivity > 60:
-                # ENVÍA mensaje de cierre si el websocket está activo
-                ws = active_websockets.get(user_id)
-                if ws:
-                    try:
-                        # Mensaje especial para el frontend
-                        asyncio.run_coroutine_threadsafe(
-                            ws.send_text('{"type": "close", "message": "El chat se ha cerrado por inactividad."}'),
-                            asyncio.get_event_loop()
-                        )
-                    except Exception as e:
-                        pass
-                    # Elimina la referencia al websocket
-                    del active_websockets[user_id]
-                # Limpia la sesión como antes
-                active_conversations.pop(user_id, None)
-                conversation_histories.pop(user_id, None)
-                conversation_contexts.pop(user_id, None)
-                last_activity.pop(user_id, None)
-                warned_inactive.pop(user_id, None)
-        time.sleep(5)
-
-threading.Thread(target=cleanup_inactive_sessions, daemon=True).start()
+def restore_session(user_id: str, state: Dict[str, Any], saved_at: float):
+    """Reconstruye la sesión; el tiempo de parada no cuenta como inactividad"""
+    last_activity[user_id] = state["last_activity"] + max(0.0, time.time() - saved_at)
+    warned_inactive[user_id] = False
+    if state.get("appointment"):
+        active_conversations[user_id] = AppointmentState.from_dict(state["appointment"])
+    if state.get("context"):
+        context = ConversationContext()
+        context.__dict__.update(state["context"])
+        conversation_contexts[user_id] = context
+    history = conversation_histories.get(user_id)
+    for message in state.get("history", []):
+        history.append(message)
+    if state.get("stream"):
+        session_streams.restore(user_id, **state["stream"])
+
+def snapshot_is_current(state: Dict[str, Any], saved_at: float) -> bool:
+    """La sesión no había caducado al guardarse y la instantánea no es demasiado antigua"""
+    return saved_at - state["last_activity"] < INACTIVITY_TIMEOUT_SECONDS and time.time() - saved_at < SESSION_SNAPSHOT_MAX_AGE
+
+session_snapshotter = SessionSnapshotter(
+    SnapshotStore(worker_path(SESSION_SNAPSHOT_PATH)),
+    capture_session,
+    is_busy=session_locks.is_busy,
+    keep=snapshot_is_current,
+    interval=SESSION_SNAPSHOT_INTERVAL,
+) if SESSION_SNAPSHOT_PATH else None
+
+def mark_session_dirty(user_id: str):
+    if session_snapshotter is not None and user_id not in dry_run_sessions:
+        session_snapshotter.mark_dirty(user_id)
+
+async def restore_sessions():
+    """Carga las sesiones vigentes de la última instantánea (fuera del event loop)"""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    saved = await loop.run_in_executor(None, session_snapshotter.load)
+    for user_id, (state, saved_at) in saved.items():
+        try:
+            restore_session(user_id, state, saved_at)
+        except Exception as e:
+            print(f"[Snapshot] No se pudo restaurar la sesión {user_id}: {e}")
+    # Se descartan del fichero las sesiones caducadas
+    await loop.run_in_executor(None, session_snapshotter.store.compact, snapshot_is_current)
+    print(f"[Snapshot] {len(saved)} sesiones restauradas de {session_snapshotter.store.path} en {time.perf_counter() - start:.2f} s")
+
+def notify_clients_restarting():
+    """Pide a los clientes conectados que reconecten en unos segundos"""
+    notice = {
+        "type": "reconnect",
+        "message": "🔄 El asistente se está reiniciando. Reconectando en unos segundos...",
+        "retry_after": SHUTDOWN_RECONNECT_SECONDS
+    }
+    connections = list(active_websockets.values()) + list(active_event_streams.values())
+    for connection in connections:
+        connection.send(notice)
+    return {"clients_notified": len(connections)}
+
+def close_client_connections():
+    """Cierra las conexiones tras entregar las respuestas pendientes"""
+    closed = 0
+    for connection in list(active_websockets.values()):
+        connection.close(1012, "service restart")
+        closed += 1
+    for event_stream in list(active_event_streams.values()):
+        event_stream.close()
+        closed += 1
+    return {"connections_closed": closed}
+
+async def flush_nlp_pool():
+    """Espera a los hilos del pool (pueden estar a mitad de un POST al backend)"""
+    await asyncio.get_running_loop().run_in_executor(None, nlp_pool.shutdown)
+
+shutdown_coordinator.add_hook("notify", "reconnect_hint", notify_clients_restarting)
+shutdown_coordinator.add_hook("close", "client_connections", close_client_connections)
+shutdown_coordinator.add_hook("flush", "nlp_pool", flush_nlp_pool)
+shutdown_coordinator.add_hook("flush", "backend_writes", backend_writes.flush)
+shutdown_coordinator.add_hook("flush", "backend_writes_spill", backend_writes.spill_pending)
+if session_snapshotter is not None:
+    shutdown_coordinator.add_hook("snapshot", "sessions", session_snapshotter.flush)
+
+def use_worker_paths():
+    """Apunta el outbox y las instantáneas a los ficheros de este worker.
+
+    Las conexiones SQLite se abren al primer uso en cada proceso, así que
+    ningún worker usa la del padre ni el fichero de otro worker."""
+    outbox.store.path = worker_path(OUTBOX_PATH)
+    if session_snapshotter is not None:
+        session_snapshotter.store.path = worker_path(SESSION_SNAPSHOT_PATH)
+
+@app.on_event("startup")
+async def start_inactivity_monitor():
+    use_worker_paths()
+    if session_snapshotter is not None:
+        await restore_sessions()
+        session_snapshotter.start()
+    inactivity_monitor.start()
+    load_shedder.start()
+    backend_writes.start()
+    outbox.start()
+    availability.start()
+
+@app.on_event("shutdown")
+async def stop_inactivity_monitor():
+    # Respaldo si se arrancó con el CLI de uvicorn (DrainingServer ya lo habrá hecho)
+    await shutdown_coordinator.drain()
+    if session_snapshotter is not None:
+        await session_snapshotter.stop()
+    await inactivity_monitor.stop()
+    await load_shedder.stop()
+    await backend_writes.stop()
+    await outbox.stop()
+    await availability.stop()
+    prefetcher.shutdown()
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "chatbot", "timestamp": datetime.now().isoformat()}
+    if shutdown_coordinator.draining:
+        # El balanceador deja de enviar tráfico a esta instancia
+        return ChatJSONResponse(status_code=503, content={"status": "draining", "service": "chatbot", "worker_pid": os.getpid()})
+    shedding = load_shedder.status()
+    return {
+        "status": "healthy" if shedding["level"] == 0 else "degraded",
+        "service": "chatbot",
+        "worker_pid": os.getpid(),
+        "load_shedding": shedding,
+        "dependencies": dependencies.status(),
+        "coalescing": coalescer.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    return {"service": "chatbot", "timestamp": datetime.now().isoformat(), "metrics": metrics.snapshot()}
 
 @app.get("/test-cors")
 async def test_cors():
@@ -1500,5 +2066,9 @@ async def debug_cors():
     }
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    serve(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        timeout_graceful_shutdown=float(os.getenv("SHUTDOWN_GRACE_SECONDS", "10"))
+    ) 
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""
+Métricas en memoria del chatbot (contadores, gauges e histogramas).
+
+Se publican en JSON a través del endpoint /metrics.
+"""
+
+import threading
+from bisect import bisect_left
+from typing import Dict, Optional, Sequence
+
+# Buckets por defecto en segundos (de 1 ms a 30 s)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Gauge:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        self._value = value
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self._count
+        return {
+            "count": self._count,
+            "sum": round(self._sum, 6),
+            "avg": round(self._sum / self._count, 6) if self._count else 0.0,
+            "buckets": buckets,
+        }
+
+
+class MetricsRegistry:
+    """Registro de métricas por nombre"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name: str, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, factory())
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get_or_create(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get_or_create(name, Gauge)
+
+    def histogram(self, name: str, buckets: Optional[Sequence[float]] = None) -> Histogram:
+        return self._get_or_create(name, lambda: Histogram(buckets or DEFAULT_BUCKETS))
+
+    def snapshot(self) -> Dict[str, object]:
+        return {name: metric.snapshot() for name, metric in sorted(self._metrics.items())}
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,75 @@
+"""
+Avisos pendientes para clientes sin conexión abierta.
+
+Algunos resultados llegan después del turno que los originó (por ejemplo,
+la confirmación de una cita enviada en segundo plano). Si el usuario tiene un
+WebSocket o un flujo SSE conectado se le envían por ahí; si no, se guardan
+aquí y se entregan una sola vez: en la siguiente respuesta de /chat, al
+consultar /chat/updates o al conectar un WebSocket/SSE.
+
+Cada usuario guarda como mucho `max_per_user` avisos, durante `ttl` segundos.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+
+class NoticeBox:
+    """Buzón de avisos por usuario; leerlos los retira"""
+
+    def __init__(
+        self,
+        ttl: float = 3600.0,
+        max_per_user: int = 8,
+        max_users: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.ttl = ttl
+        self.max_per_user = max_per_user
+        self.max_users = max_users
+        self.clock = clock
+        self._boxes: "OrderedDict[str, Deque[Tuple[float, Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Avisos guardados entre todos los buzones, sin recorrerlos en cada push/take
+        self._pending = 0
+        self.registry = registry
+        self.pending_gauge = registry.gauge("notices_pending")
+
+    def push(self, user_id: str, payload: Dict[str, Any]):
+        with self._lock:
+            box = self._boxes.setdefault(user_id, deque(maxlen=self.max_per_user))
+            if len(box) == self.max_per_user:
+                # La deque descarta el más antiguo al añadir
+                self.registry.counter("notices_dropped_total").inc()
+            else:
+                self._pending += 1
+            box.append((self.clock(), payload))
+            self._boxes.move_to_end(user_id)
+            while len(self._boxes) > self.max_users:
+                _, dropped = self._boxes.popitem(last=False)
+                self._pending -= len(dropped)
+                self.registry.counter("notices_dropped_total").inc(len(dropped))
+            self.pending_gauge.set(self._pending)
+
+    def take(self, user_id: str) -> List[Dict[str, Any]]:
+        """Retira y devuelve los avisos vigentes del usuario, en orden de llegada"""
+        with self._lock:
+            box = self._boxes.pop(user_id, None)
+            if not box:
+                return []
+            self._pending -= len(box)
+            cutoff = self.clock() - self.ttl
+            notices = [payload for created, payload in box if created > cutoff]
+            if len(notices) < len(box):
+                self.registry.counter("notices_expired_total").inc(len(box) - len(notices))
+            self.pending_gauge.set(self._pending)
+        self.registry.counter("notices_delivered_total").inc(len(notices))
+        return notices
+
+    def __len__(self) -> int:
+        return self._pending
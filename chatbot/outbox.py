@@ -0,0 +1,298 @@
+"""
+Outbox local y duradero para los envíos al backend.
+
+Las citas confirmadas y los eventos de registro se guardan primero en una
+base SQLite en modo WAL (una inserción, sin esperar a la red) y el usuario
+recibe la respuesta al momento. Un despachador de fondo los entrega con
+reintentos y espera exponencial con jitter; cada entrada lleva una clave de
+idempotencia que se envía al backend para que un reintento no duplique la
+cita. Lo que queda pendiente al parar se entrega al arrancar de nuevo.
+
+Los handlers se ejecutan en un hilo aparte; los avisos de resultado
+(`on_delivered`, `on_failed`) se llaman en el event loop.
+"""
+
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+PENDING = "pending"
+DELIVERED = "delivered"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+"""
+
+
+class PermanentDeliveryError(Exception):
+    """El backend rechazó la entrega (p. ej. 400/409): reintentar no servirá"""
+
+
+class OutboxEntry:
+    __slots__ = ("id", "kind", "key", "payload", "attempts", "created_at")
+
+    def __init__(self, id: int, kind: str, key: str, payload: Dict[str, Any], attempts: int, created_at: float):
+        self.id = id
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+        self.created_at = created_at
+
+
+class OutboxStore:
+    """Tabla de envíos pendientes en SQLite (WAL: las escrituras no bloquean lecturas)"""
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        # Se abre al primer uso en cada proceso: una conexión heredada por fork no es segura
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            # Con WAL, NORMAL solo puede perder la última transacción ante un corte de luz, no corromper
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(_SCHEMA)
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def append(self, kind: str, payload: Dict[str, Any], key: Optional[str] = None) -> Tuple[str, bool]:
+        """Guarda un envío; devuelve su clave y si es nuevo (una clave repetida no se duplica)"""
+        key = key or uuid.uuid4().hex
+        now = self.clock()
+        with self._lock:
+            cursor = self._conn().execute(
+                "INSERT OR IGNORE INTO outbox (kind, idempotency_key, payload, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(payload, default=str), now, now),
+            )
+        return key, cursor.rowcount == 1
+
+    def due(self, limit: int = 50) -> List[OutboxEntry]:
+        with self._lock:
+            rows = self._conn().execute(
+                "SELECT id, kind, idempotency_key, payload, attempts, created_at FROM outbox "
+                "WHERE status = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (PENDING, self.clock(), limit),
+            ).fetchall()
+        return [OutboxEntry(row[0], row[1], row[2], json.loads(row[3]), row[4], row[5]) for row in rows]
+
+    def next_due_in(self) -> Optional[float]:
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = ?", (PENDING,)
+            ).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - self.clock())
+
+    def mark_delivered(self, entry: OutboxEntry):
+        with self._lock:
+            self._conn().execute(
+                "UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?",
+                (DELIVERED, entry.id),
+            )
+
+    def mark_retry(self, entry: OutboxEntry, delay: float, error: str):
+        # Se guarda también el payload: los handlers pueden anotar su progreso en él
+        with self._lock:
+            self._conn().execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?, payload = ? WHERE id = ?",
+                (self.clock() + delay, error, json.dumps(entry.payload, default=str), entry.id),
+            )
+
+    def mark_failed(self, entry: OutboxEntry, error: str):
+        with self._lock:
+            self._conn().execute(
+                "UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (FAILED, error, entry.id),
+            )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT kind, status, attempts, last_error FROM outbox WHERE idempotency_key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"kind": row[0], "status": row[1], "attempts": row[2], "last_error": row[3]}
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {PENDING: 0, DELIVERED: 0, FAILED: 0, **dict(rows)}
+
+    def purge(self, older_than: float, failed_kinds: Sequence[str] = ()) -> int:
+        """Borra las entregadas hace más de `older_than` segundos.
+
+        Las fallidas se conservan para revisarlas, salvo las de `failed_kinds`."""
+        placeholders = ",".join("?" * len(failed_kinds)) or "NULL"
+        with self._lock:
+            cursor = self._conn().execute(
+                "DELETE FROM outbox WHERE created_at < ? AND (status = ? OR (status = ? AND kind IN (%s)))"
+                % placeholders,
+                (self.clock() - older_than, DELIVERED, FAILED, *failed_kinds),
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
+
+
+class OutboxDispatcher:
+    """Entrega en segundo plano las entradas pendientes del outbox"""
+
+    def __init__(
+        self,
+        store: OutboxStore,
+        handlers: Dict[str, Callable[[Dict[str, Any], str], Any]],
+        on_delivered: Callable[[OutboxEntry, Any], None] = lambda entry, result: None,
+        on_failed: Callable[[OutboxEntry, str], None] = lambda entry, error: None,
+        max_attempts: int = 8,
+        base_delay: float = 1.0,
+        max_delay: float = 300.0,
+        batch: int = 50,
+        interval: float = 5.0,
+        retention: float = 7 * 24 * 3600,
+        discard_failed: Sequence[str] = (),
+        paused: Callable[[], bool] = lambda: False,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.store = store
+        self.handlers = handlers
+        self.on_delivered = on_delivered
+        self.on_failed = on_failed
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch = batch
+        self.interval = interval
+        self.retention = retention
+        # Tipos cuyas entregas fallidas no hace falta revisar: se purgan como las entregadas
+        self.discard_failed = tuple(discard_failed)
+        self.paused = paused
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Un solo hilo: una entrada nunca se entrega dos veces en paralelo
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        self.registry = registry
+        self.pending_gauge = registry.gauge("outbox_pending")
+        self.delivery_seconds = registry.histogram("outbox_delivery_seconds")
+
+    def submit(self, kind: str, payload: Dict[str, Any], key: Optional[str] = None) -> str:
+        """Guarda el envío y despierta al despachador; se puede llamar desde cualquier hilo"""
+        key, created = self.store.append(kind, payload, key)
+        if created:
+            self.registry.counter("outbox_enqueued_total").inc()
+            self.pending_gauge.inc()
+            if self._loop is not None and self._wake is not None:
+                self._loop.call_soon_threadsafe(self._wake.set)
+        return key
+
+    def backoff(self, attempts: int) -> float:
+        """Espera exponencial con jitter completo"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts))
+
+    def _deliver(self, entry: OutboxEntry) -> Tuple[str, Any]:
+        handler = self.handlers.get(entry.kind)
+        start = time.perf_counter()
+        try:
+            if handler is None:
+                raise PermanentDeliveryError(f"sin handler para '{entry.kind}'")
+            result = handler(entry.payload, entry.key)
+        except PermanentDeliveryError as e:
+            self.store.mark_failed(entry, str(e))
+            return FAILED, str(e)
+        except Exception as e:
+            if entry.attempts + 1 >= self.max_attempts:
+                self.store.mark_failed(entry, str(e))
+                return FAILED, str(e)
+            self.store.mark_retry(entry, self.backoff(entry.attempts), str(e))
+            self.registry.counter("outbox_retries_total").inc()
+            return PENDING, str(e)
+        finally:
+            self.delivery_seconds.observe(time.perf_counter() - start)
+        self.store.mark_delivered(entry)
+        return DELIVERED, result
+
+    def dispatch_sync(self) -> List[Tuple[OutboxEntry, str, Any]]:
+        """Intenta entregar las entradas vencidas (en el hilo del despachador)"""
+        outcomes = [(entry, *self._deliver(entry)) for entry in self.store.due(self.batch)]
+        self.pending_gauge.set(self.store.counts()[PENDING])
+        return outcomes
+
+    async def dispatch(self) -> Dict[str, int]:
+        outcomes = await asyncio.get_running_loop().run_in_executor(self._executor, self.dispatch_sync)
+        delivered = failed = 0
+        for entry, status, detail in outcomes:
+            if status == DELIVERED:
+                delivered += 1
+                self.registry.counter("outbox_delivered_total").inc()
+                self.on_delivered(entry, detail)
+            elif status == FAILED:
+                failed += 1
+                self.registry.counter("outbox_failed_total").inc()
+                print(f"[Outbox] Entrega de '{entry.kind}' abandonada ({entry.key}): {detail}")
+                self.on_failed(entry, detail)
+        return {"outbox_delivered": delivered, "outbox_failed": failed}
+
+    async def run(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.store.purge, self.retention, self.discard_failed)
+        while True:
+            if not self.paused():
+                try:
+                    await self.dispatch()
+                except Exception as e:
+                    print(f"[Outbox] Error en el despachador: {e}")
+            due_in = self.store.next_due_in()
+            timeout = self.interval if due_in is None else min(self.interval, max(due_in, 0.05))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self.pending_gauge.set(self.store.counts()[PENDING])
+            self._task = self._loop.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
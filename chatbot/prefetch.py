@@ -0,0 +1,126 @@
+"""
+Precarga especulativa de datos por sesión.
+
+Al entrar en el flujo de citas todavía quedan varios turnos (nombre, edad,
+teléfono, email, motivo) antes de mostrar las fechas. Mientras el usuario
+escribe, los datos que hará falta enseñar (huecos libres, contacto del
+despacho) se cargan en segundo plano y el turno que los usa los toma de
+memoria.
+
+Cada carga es un futuro por (sesión, nombre). Al pedirla:
+- si terminó y no está caducada, se usa (acierto);
+- si sigue en curso, se espera como mucho `wait` segundos;
+- si falló, caducó o no hay precarga, se calcula en el momento (fallo).
+La precarga es solo una optimización: nunca cambia el resultado.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+
+class SessionPrefetcher:
+    """Futuros de precarga por sesión, con caducidad y tope de cargas en curso"""
+
+    def __init__(
+        self,
+        max_age: float = 120.0,
+        wait: float = 0.5,
+        workers: int = 2,
+        max_inflight: int = 64,
+        max_sessions: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.max_age = max_age
+        self.wait = wait
+        self.max_inflight = max_inflight
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self._entries: "OrderedDict[str, Dict[str, Tuple[Future, float]]]" = OrderedDict()
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.registry = registry
+        self.inflight_gauge = registry.gauge("prefetch_inflight")
+
+    def start(self, session_id: str, loaders: Dict[str, Callable[[], Any]]):
+        """Lanza las cargas de la sesión (sustituye a las anteriores con el mismo nombre)"""
+        for name, load in loaders.items():
+            with self._lock:
+                if self._inflight >= self.max_inflight:
+                    # Sin hueco: ese turno lo calculará en el momento
+                    self.registry.counter("prefetch_skipped_total").inc()
+                    continue
+                self._inflight += 1
+                self.inflight_gauge.set(self._inflight)
+            future = self._executor.submit(load)
+            future.add_done_callback(self._finished)
+            with self._lock:
+                stale = [self._entries.setdefault(session_id, {}).get(name)]
+                self._entries[session_id][name] = (future, self.clock())
+                self._entries.move_to_end(session_id)
+                while len(self._entries) > self.max_sessions:
+                    stale.extend(self._entries.popitem(last=False)[1].values())
+            # Fuera del cerrojo: cancelar ejecuta _finished en este mismo hilo
+            for entry in stale:
+                if entry is not None:
+                    entry[0].cancel()
+            self.registry.counter("prefetch_started_total").inc()
+
+    def _finished(self, future: Future):
+        with self._lock:
+            self._inflight -= 1
+            self.inflight_gauge.set(self._inflight)
+        if not future.cancelled() and future.exception() is not None:
+            self.registry.counter("prefetch_errors_total").inc()
+            print(f"[Prefetch] Error en precarga: {future.exception()}")
+
+    @staticmethod
+    def _cancel(entries: Dict[str, Tuple[Future, float]]):
+        for future, _ in entries.values():
+            future.cancel()
+
+    def get(self, session_id: str, name: str, load: Callable[[], Any]) -> Any:
+        """Resultado precargado si está listo y vigente; si no, `load()` en el momento"""
+        with self._lock:
+            entry = self._entries.get(session_id, {}).get(name)
+        if entry is not None and self.clock() - entry[1] <= self.max_age:
+            future = entry[0]
+            try:
+                result = future.result(timeout=0 if future.done() else self.wait)
+            except FutureTimeout:
+                self.registry.counter("prefetch_late_total").inc()
+            except Exception:
+                pass
+            else:
+                self.registry.counter("prefetch_hits_total").inc()
+                return result
+        self.registry.counter("prefetch_misses_total").inc()
+        return load()
+
+    def discard(self, session_id: str, name: str = None):
+        """Olvida las precargas de la sesión (o solo una) para que no se reutilicen"""
+        with self._lock:
+            if name is None:
+                entries = self._entries.pop(session_id, {})
+            else:
+                entry = self._entries.get(session_id, {}).pop(name, None)
+                entries = {name: entry} if entry else {}
+        self._cancel(entries)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def shutdown(self):
+        with self._lock:
+            sessions = list(self._entries.values())
+            self._entries.clear()
+        for entries in sessions:
+            self._cancel(entries)
+        self._executor.shutdown(wait=False)
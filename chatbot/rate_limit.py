@@ -0,0 +1,131 @@
+"""
+Limitación de frecuencia con token buckets para /chat y /ws.
+
+Se aplican tres niveles: por user_id, por IP y un bucket global. Cada clave
+ocupa un objeto de tamaño fijo y las claves inactivas se descartan (un bucket
+que lleva inactivo lo suficiente está lleno y equivale a uno nuevo), con un
+máximo de claves en memoria en orden LRU.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """Token buckets por clave con desalojo de claves inactivas"""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        max_keys: int = 10000,
+        idle_ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # Por defecto: el tiempo que tarda un bucket vacío en llenarse
+        self.idle_ttl = idle_ttl if idle_ttl is not None else burst / rate
+        self.clock = clock
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def _bucket(self, key: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self._buckets[key] = bucket
+            self._evict(now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self, now: float):
+        # Los más antiguos están al principio (orden LRU)
+        while self._buckets:
+            key, oldest = next(iter(self._buckets.items()))
+            if len(self._buckets) > self.max_keys or now - oldest.updated > self.idle_ttl:
+                del self._buckets[key]
+            else:
+                break
+
+    def available(self, key: str) -> float:
+        return self._bucket(key, self.clock()).tokens
+
+    def consume(self, key: str, cost: float = 1.0) -> bool:
+        bucket = self._bucket(key, self.clock())
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            return True
+        return False
+
+    def retry_after(self, key: str, cost: float = 1.0) -> float:
+        """Segundos hasta que haya tokens suficientes"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return 0.0
+        return max(0.0, (cost - bucket.tokens) / self.rate)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+def forwarded_client_ip(forwarded_for: Optional[str], peer: Optional[str], trusted_proxies: int = 1) -> Optional[str]:
+    """IP del cliente según X-Forwarded-For, sin fiarse de lo que escribe el cliente.
+
+    Cada proxy añade al final la IP desde la que le llegó la petición; las
+    entradas anteriores las puede inventar el cliente. Con `trusted_proxies`
+    proxies propios delante se toma la que añadió el más externo (la n-ésima
+    empezando por el final). Con 0, o si faltan entradas, se usa la del socket.
+    """
+    if trusted_proxies <= 0 or not forwarded_for:
+        return peer
+    hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+    if len(hops) < trusted_proxies:
+        return peer
+    return hops[-trusted_proxies]
+
+
+class ChatRateLimits:
+    """Combina los límites por usuario, por IP y global"""
+
+    GLOBAL_KEY = "__global__"
+
+    def __init__(
+        self,
+        user: RateLimiter,
+        ip: RateLimiter,
+        global_limiter: RateLimiter,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.limiters: Dict[str, RateLimiter] = {"user": user, "ip": ip, "global": global_limiter}
+        self.registry = registry
+
+    def check(self, user_id: str, ip: Optional[str]) -> Tuple[bool, Optional[str], float]:
+        """Devuelve (permitido, ámbito que limita, segundos de espera)"""
+        keys = {"user": user_id, "ip": ip or "unknown", "global": self.GLOBAL_KEY}
+        # Comprobar todos antes de consumir para no gastar tokens de un ámbito si otro rechaza
+        for scope, key in keys.items():
+            limiter = self.limiters[scope]
+            if limiter.available(key) < 1:
+                self.registry.counter(f"rate_limited_{scope}_total").inc()
+                return False, scope, limiter.retry_after(key)
+        for scope, key in keys.items():
+            self.limiters[scope].consume(key)
+        return True, None, 0.0
+
+    def tracked_keys(self) -> Dict[str, int]:
+        return {scope: len(limiter) for scope, limiter in self.limiters.items()}
@@ -0,0 +1,227 @@
+"""
+Protección común para las llamadas a dependencias externas.
+
+Cada dependencia (backend, Hugging Face, proveedores de LLM) tiene:
+
+    - un plazo total por llamada, que incluye los reintentos
+    - reintentos acotados con espera exponencial y jitter completo
+    - un circuit breaker: tras `failure_threshold` fallos seguidos se abre y
+      las llamadas fallan al instante con CircuitOpenError durante
+      `reset_timeout` segundos; después deja pasar una llamada de prueba
+      (semiabierto) y se cierra si sale bien
+
+Se considera fallo una excepción o una respuesta HTTP 5xx/429. Las llamadas
+se hacen desde los hilos del pool NLP, así que todo es thread-safe.
+"""
+
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple, Type
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """La dependencia está caída: se falla sin llamarla"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} no disponible (circuito abierto, reintento en {retry_in:.0f} s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def is_retryable_response(result: Any) -> bool:
+    """Respuestas HTTP que cuentan como fallo de la dependencia"""
+    status = getattr(result, "status_code", None)
+    return status is not None and (status >= 500 or status == 429)
+
+
+class CircuitBreaker:
+    """Circuit breaker por fallos consecutivos"""
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.registry = registry
+        self.state_gauge = registry.gauge(f"dependency_{name}_circuit_state")
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            print(f"[Resilience] Circuito '{self.name}': {self.state} -> {state}")
+            self.state = state
+            self.state_gauge.set(_STATE_VALUES[state])
+            if state == OPEN:
+                self.registry.counter(f"dependency_{self.name}_circuit_opened_total").inc()
+
+    def retry_in(self) -> float:
+        if self.state != OPEN or self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - self.clock())
+
+    def allow(self) -> bool:
+        """¿Se puede llamar ahora? En semiabierto solo pasa una llamada de prueba"""
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._probing = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+                self._set_state(OPEN)
+            self._probing = False
+
+
+class Dependency:
+    """Dependencia externa con plazo, reintentos y circuit breaker"""
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float = 5.0,
+        retries: int = 1,
+        base_delay: float = 0.2,
+        max_delay: float = 2.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+        on_latency: Callable[[str, float], None] = lambda name, seconds: None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.on_latency = on_latency
+        self.clock = clock
+        self.sleep = sleep
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout, clock=clock, registry=registry)
+        self.registry = registry
+
+    def _count(self, what: str):
+        self.registry.counter(f"dependency_{self.name}_{what}_total").inc()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, fn: Callable[[float], Any], timeout: Optional[float] = None, retries: Optional[int] = None) -> Any:
+        """Llama a `fn(timeout)` respetando el plazo total.
+
+        `fn` recibe los segundos que le quedan y debe pasarlos a su cliente
+        HTTP/SDK. Devuelve el resultado del último intento (aunque sea una
+        respuesta 5xx) o relanza su excepción; con el circuito abierto lanza
+        CircuitOpenError sin llamar.
+        """
+        deadline = self.clock() + (timeout if timeout is not None else self.timeout)
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._count("rejected")
+                raise CircuitOpenError(self.name, self.breaker.retry_in())
+            self._count("calls")
+            remaining = deadline - self.clock()
+            start = time.perf_counter()
+            try:
+                result = fn(remaining)
+            except self.retry_on as e:
+                self.on_latency(self.name, time.perf_counter() - start)
+                self._count("failures")
+                if "timeout" in type(e).__name__.lower() or "timed out" in str(e).lower():
+                    self._count("timeouts")
+                self.breaker.record_failure()
+                if not self._retry(attempt, retries, deadline):
+                    raise
+            else:
+                self.on_latency(self.name, time.perf_counter() - start)
+                if not is_retryable_response(result):
+                    self.breaker.record_success()
+                    return result
+                self._count("failures")
+                self.breaker.record_failure()
+                if not self._retry(attempt, retries, deadline):
+                    return result
+            attempt += 1
+
+    def _retry(self, attempt: int, retries: int, deadline: float) -> bool:
+        """Espera antes del siguiente intento si quedan intentos y plazo"""
+        if attempt >= retries:
+            return False
+        delay = self.backoff(attempt)
+        # Sin plazo para esperar y volver a llamar con margen: no se reintenta
+        if self.clock() + delay >= deadline - 0.05:
+            return False
+        self._count("retries")
+        self.sleep(delay)
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        counter = lambda what: int(self.registry.counter(f"dependency_{self.name}_{what}_total").value)
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "retry_in_seconds": round(self.breaker.retry_in(), 1),
+            "calls": counter("calls"),
+            "failures": counter("failures"),
+            "timeouts": counter("timeouts"),
+            "retries": counter("retries"),
+            "rejected": counter("rejected"),
+        }
+
+
+class Dependencies:
+    """Conjunto de dependencias con nombre"""
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self._dependencies: Dict[str, Dependency] = {}
+
+    def add(self, name: str, **options) -> Dependency:
+        dependency = Dependency(name, **{**self.defaults, **options})
+        self._dependencies[name] = dependency
+        return dependency
+
+    def __getitem__(self, name: str) -> Dependency:
+        return self._dependencies[name]
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        return {name: dependency.status() for name, dependency in self._dependencies.items()}
@@ -0,0 +1,90 @@
+"""
+Rasgos de la conversación que se mantienen al añadir cada mensaje.
+
+En lugar de recorrer el historial en cada turno buscando palabras clave, cada
+mensaje se clasifica una sola vez al entrar en el historial:
+
+- temas de los mensajes del usuario (cita, precios, servicios, contacto),
+  contados en una ventana deslizante de los últimos `window` mensajes;
+- tipo del último mensaje del asistente (si ofrecía agendar una cita).
+
+Consultarlos en un turno cuesta O(1), sin depender de la longitud del historial.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+
+# Palabras que marcan cada tema en un mensaje del usuario
+TOPIC_WORDS: Dict[str, Tuple[str, ...]] = {
+    "appointment": ("agendar cita", "programar cita", "cita con abogado", "quiero agendar", "necesito agendar",
+                    "cita", "quiero cita", "necesito una cita"),
+    "pricing": ("costo", "precio", "honorarios"),
+    "services": ("servicio", "especialidad", "área"),
+    "contact": ("contacto", "teléfono", "email"),
+}
+TOPICS = tuple(TOPIC_WORDS)
+_TOPIC_BITS = {topic: 1 << index for index, topic in enumerate(TOPICS)}
+
+# Frases con las que el asistente ofrece agendar una cita
+APPOINTMENT_OFFER_PHRASES = (
+    "agendar tu cita", "programar tu cita", "ayudarte a agendar", "empezar a agendar",
+    "¿te gustaría que te ayude a programar una cita?", "¿te gustaría agendar una cita?",
+    "te recomiendo programar una cita", "brindarte la mejor asesoría",
+)
+APPOINTMENT_OFFER = "appointment_offer"
+OTHER_PROMPT = "other"
+
+
+def message_topics(message: Dict[str, Any]) -> int:
+    """Temas del mensaje como máscara de bits; 0 para los del asistente"""
+    if not message.get("isUser"):
+        return 0
+    text = str(message.get("text", "")).lower()
+    topics = 0
+    for topic, words in TOPIC_WORDS.items():
+        if any(word in text for word in words):
+            topics |= _TOPIC_BITS[topic]
+    return topics
+
+
+def prompt_type(message: Dict[str, Any]) -> str:
+    """Qué pedía un mensaje del asistente"""
+    text = str(message.get("text", "")).lower()
+    if any(phrase in text for phrase in APPOINTMENT_OFFER_PHRASES):
+        return APPOINTMENT_OFFER
+    return OTHER_PROMPT
+
+
+class SessionFeatures:
+    """Contadores de temas en la ventana y tipo del último mensaje del asistente"""
+
+    __slots__ = ("window", "last_prompt", "_counts")
+
+    def __init__(self, window: int = 3):
+        self.window = window
+        self.last_prompt: Optional[str] = None
+        self._counts = dict.fromkeys(TOPICS, 0)
+
+    def enter(self, topics: int):
+        """Un mensaje con estos temas entra en la ventana"""
+        if topics:
+            for topic, bit in _TOPIC_BITS.items():
+                if topics & bit:
+                    self._counts[topic] += 1
+
+    def leave(self, topics: int):
+        """Un mensaje con estos temas sale de la ventana"""
+        if topics:
+            for topic, bit in _TOPIC_BITS.items():
+                if topics & bit:
+                    self._counts[topic] -= 1
+
+    def count(self, topic: str) -> int:
+        """Mensajes del usuario en la ventana que tocan el tema"""
+        return self._counts[topic]
+
+    def mentioned(self, topic: str) -> bool:
+        return self._counts[topic] > 0
+
+    def reset(self):
+        self.last_prompt = None
+        self._counts = dict.fromkeys(TOPICS, 0)
@@ -0,0 +1,68 @@
+"""
+Locks asíncronos por sesión.
+
+Los mensajes de un mismo user_id se procesan en orden, uno detrás de otro,
+mientras que usuarios distintos se atienden en paralelo. Los locks se crean
+bajo demanda y se eliminan cuando nadie los usa.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+
+class _SessionLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class SessionLocks:
+    """Serializa la ejecución por user_id"""
+
+    def __init__(self, registry: MetricsRegistry = default_metrics, clock: Callable[[], float] = time.perf_counter):
+        self._locks: Dict[str, _SessionLock] = {}
+        self.clock = clock
+        self.wait_time = registry.histogram("session_lock_wait_seconds")
+        self.contended = registry.counter("session_lock_contended_total")
+        self.active = registry.gauge("session_locks_active")
+
+    @asynccontextmanager
+    async def hold(self, user_id: str):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = _SessionLock()
+            self.active.set(len(self._locks))
+        entry.users += 1
+        if entry.lock.locked():
+            self.contended.inc()
+        start = self.clock()
+        try:
+            await entry.lock.acquire()
+        except BaseException:
+            self._release_entry(user_id, entry)
+            raise
+        self.wait_time.observe(self.clock() - start)
+        try:
+            yield
+        finally:
+            entry.lock.release()
+            self._release_entry(user_id, entry)
+
+    def _release_entry(self, user_id: str, entry: _SessionLock):
+        entry.users -= 1
+        if entry.users == 0 and self._locks.get(user_id) is entry:
+            del self._locks[user_id]
+            self.active.set(len(self._locks))
+
+    def is_busy(self, user_id: str) -> bool:
+        """True si hay un turno en curso o esperando para este usuario"""
+        return user_id in self._locks
+
+    def __len__(self) -> int:
+        return len(self._locks)
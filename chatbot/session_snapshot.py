@@ -0,0 +1,215 @@
+"""
+Instantáneas de sesiones en disco para reiniciar sin perder conversaciones.
+
+El fichero es un registro binario de solo-añadir: cada escritura es un lote
+con las sesiones modificadas desde la anterior (o una marca de borrado si la
+sesión se cerró), comprimido con zlib y precedido de su longitud y CRC32. Al
+leer gana el último lote de cada sesión; un lote cortado por un cierre brusco
+se detecta por el CRC y se ignora. Cuando el fichero crece demasiado respecto
+al estado vivo se reescribe compactado con un rename atómico.
+
+Solo se capturan en el event loop las sesiones marcadas como modificadas; la
+serialización, compresión, escritura y fsync se hacen en un hilo aparte.
+"""
+
+import asyncio
+import io
+import os
+import pickle
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+HEADER = struct.Struct("!II")  # longitud, crc32
+MAGIC = b"CBSNAP1\n"
+
+# Los estados solo contienen tipos básicos y fechas
+_ALLOWED_CLASSES = {("datetime", "datetime"): datetime, ("datetime", "date"): date, ("datetime", "timedelta"): timedelta}
+
+
+class _StateUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        cls = _ALLOWED_CLASSES.get((module, name))
+        if cls is None:
+            raise pickle.UnpicklingError(f"Tipo no permitido en la instantánea: {module}.{name}")
+        return cls
+
+
+def _encode_batch(sessions: Dict[str, Optional[Dict[str, Any]]], saved_at: float) -> bytes:
+    payload = zlib.compress(pickle.dumps({"saved_at": saved_at, "sessions": sessions}, protocol=pickle.HIGHEST_PROTOCOL))
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _decode_batch(payload: bytes) -> Dict[str, Any]:
+    return _StateUnpickler(io.BytesIO(zlib.decompress(payload))).load()
+
+
+class SnapshotStore:
+    """Fichero de instantáneas: añadir lotes, leer el último estado y compactar"""
+
+    def __init__(self, path: str, compact_ratio: float = 4.0, compact_min_bytes: int = 256 * 1024):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self._compacted_size = 0
+
+    def append(self, sessions: Dict[str, Optional[Dict[str, Any]]], saved_at: Optional[float] = None) -> int:
+        """Añade un lote y lo sincroniza a disco; devuelve los bytes escritos"""
+        record = _encode_batch(sessions, saved_at if saved_at is not None else time.time())
+        new_file = not os.path.exists(self.path)
+        with open(self.path, "ab") as f:
+            if new_file:
+                f.write(MAGIC)
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        return len(record)
+
+    def load(self) -> Dict[str, Tuple[Dict[str, Any], float]]:
+        """Último estado de cada sesión viva con la hora en que se guardó"""
+        sessions: Dict[str, Tuple[Dict[str, Any], float]] = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return sessions
+        if not data.startswith(MAGIC):
+            print(f"[Snapshot] Formato desconocido en {self.path}, se ignora")
+            return sessions
+        offset = len(MAGIC)
+        while offset + HEADER.size <= len(data):
+            length, crc = HEADER.unpack_from(data, offset)
+            payload = data[offset + HEADER.size:offset + HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                print("[Snapshot] Lote final incompleto (cierre brusco), se descarta")
+                break
+            offset += HEADER.size + length
+            try:
+                batch = _decode_batch(payload)
+            except Exception as e:
+                print(f"[Snapshot] Lote ilegible, se descarta: {e}")
+                continue
+            for user_id, state in batch["sessions"].items():
+                if state is None:
+                    sessions.pop(user_id, None)
+                else:
+                    sessions[user_id] = (state, batch["saved_at"])
+        return sessions
+
+    def needs_compaction(self) -> bool:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return False
+        return size >= self.compact_min_bytes and size >= self._compacted_size * self.compact_ratio
+
+    def compact(self, keep: Callable[[Dict[str, Any], float], bool] = lambda state, saved_at: True) -> int:
+        """Reescribe el fichero con una sola entrada por sesión viva"""
+        live = {user_id: entry for user_id, entry in self.load().items() if keep(*entry)}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            # Se agrupan por hora de guardado para conservarla
+            by_saved_at: Dict[float, Dict[str, Optional[Dict[str, Any]]]] = {}
+            for user_id, (state, saved_at) in live.items():
+                by_saved_at.setdefault(saved_at, {})[user_id] = state
+            for saved_at in sorted(by_saved_at):
+                f.write(_encode_batch(by_saved_at[saved_at], saved_at))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._compacted_size = os.path.getsize(self.path)
+        return len(live)
+
+
+class SessionSnapshotter:
+    """Sigue las sesiones modificadas y las guarda periódicamente fuera del event loop"""
+
+    def __init__(
+        self,
+        store: SnapshotStore,
+        capture: Callable[[str], Optional[Dict[str, Any]]],
+        is_busy: Callable[[str], bool] = lambda user_id: False,
+        keep: Callable[[Dict[str, Any], float], bool] = lambda state, saved_at: True,
+        interval: float = 30.0,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.store = store
+        self.capture = capture
+        self.is_busy = is_busy
+        self.keep = keep
+        self.interval = interval
+        self._dirty: Set[str] = set()
+        # Un único hilo: las escrituras y compactaciones nunca se solapan
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+        self._task: Optional[asyncio.Task] = None
+        self.registry = registry
+        self.write_seconds = registry.histogram("session_snapshot_write_seconds")
+        self.dirty_gauge = registry.gauge("session_snapshot_dirty")
+
+    def mark_dirty(self, user_id: str):
+        self._dirty.add(user_id)
+        self.dirty_gauge.set(len(self._dirty))
+
+    def _write(self, sessions: Dict[str, Optional[Dict[str, Any]]]) -> int:
+        start = time.perf_counter()
+        written = self.store.append(sessions)
+        if self.store.needs_compaction():
+            kept = self.store.compact(self.keep)
+            print(f"[Snapshot] Fichero compactado: {kept} sesiones")
+        self.write_seconds.observe(time.perf_counter() - start)
+        return written
+
+    async def flush(self) -> Dict[str, int]:
+        """Guarda las sesiones modificadas; las que están en mitad de un turno esperan a la siguiente"""
+        if not self._dirty:
+            return {"sessions_snapshotted": 0}
+        sessions: Dict[str, Optional[Dict[str, Any]]] = {}
+        for user_id in list(self._dirty):
+            if self.is_busy(user_id):
+                continue
+            # None marca una sesión cerrada
+            sessions[user_id] = self.capture(user_id)
+            self._dirty.discard(user_id)
+        self.dirty_gauge.set(len(self._dirty))
+        if not sessions:
+            return {"sessions_snapshotted": 0}
+        try:
+            written = await asyncio.get_running_loop().run_in_executor(self._executor, self._write, sessions)
+        except Exception as e:
+            # Se reintentan en la próxima ronda
+            self._dirty.update(sessions)
+            self.registry.counter("session_snapshot_errors_total").inc()
+            print(f"[Snapshot] Error guardando sesiones: {e}")
+            return {"sessions_snapshotted": 0}
+        self.registry.counter("session_snapshot_sessions_total").inc(len(sessions))
+        self.registry.counter("session_snapshot_bytes_total").inc(written)
+        return {"sessions_snapshotted": len(sessions)}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def load(self) -> Dict[str, Tuple[Dict[str, Any], float]]:
+        """Sesiones guardadas que siguen vigentes según `keep`"""
+        return {user_id: entry for user_id, entry in self.store.load().items() if self.keep(*entry)}
@@ -0,0 +1,158 @@
+"""
+Flujo de mensajes reanudable por sesión.
+
+Cada mensaje que el servidor envía a un usuario (respuestas, errores, avisos
+de inactividad) recibe un número de secuencia y se guarda en un búfer de
+repetición pequeño. Si la conexión se cae, el cliente se reconecta con su
+token de sesión y el último número recibido y solo se le reenvía lo que no
+llegó. Los mensajes publicados mientras no hay conexión se quedan en el búfer.
+
+Los clientes pueden numerar también sus propios mensajes (`seq`): un mensaje
+ya procesado que se reenvía tras reconectar se ignora, y su respuesta llega
+por la repetición. Uno rechazado (límite de peticiones, pool ocupado) no
+cuenta como procesado y se puede reenviar con el mismo `seq`.
+"""
+
+import secrets
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+Sink = Callable[[Dict[str, Any]], Any]
+
+
+class SessionStream:
+    """Secuencia de mensajes salientes de una sesión con búfer de repetición"""
+
+    def __init__(self, user_id: str, token: str, capacity: int = 64, clock: Callable[[], float] = time.monotonic):
+        self.user_id = user_id
+        self.token = token
+        self.clock = clock
+        self.next_seq = 1
+        self.last_client_seq = 0
+        self.buffer: Deque[Dict[str, Any]] = deque(maxlen=capacity)
+        self.sink: Optional[Sink] = None
+        self.last_used = clock()
+
+    @property
+    def last_seq(self) -> int:
+        return self.next_seq - 1
+
+    def publish(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Numera el mensaje, lo guarda y lo entrega si hay una conexión"""
+        frame = dict(payload, seq=self.next_seq)
+        self.next_seq += 1
+        self.buffer.append(frame)
+        self.last_used = self.clock()
+        if self.sink is not None:
+            self.sink(frame)
+        return frame
+
+    def ack(self, seq: int):
+        """El cliente confirma haber recibido hasta `seq`"""
+        while self.buffer and self.buffer[0]["seq"] <= seq:
+            self.buffer.popleft()
+
+    def replay_after(self, last_seq: int) -> Tuple[List[Dict[str, Any]], bool]:
+        """Mensajes posteriores a `last_seq` y si la repetición está completa"""
+        self.ack(last_seq)
+        if last_seq >= self.last_seq:
+            return [], True
+        complete = bool(self.buffer) and self.buffer[0]["seq"] <= last_seq + 1
+        return list(self.buffer), complete
+
+    def is_duplicate(self, seq: Optional[int]) -> bool:
+        """True si el mensaje del cliente ya se procesó (reenvío tras reconectar); no registra nada"""
+        return seq is not None and seq <= self.last_client_seq
+
+    def commit_client_seq(self, seq: Optional[int]):
+        """Marca el mensaje del cliente como procesado, solo cuando su turno se ha ejecutado.
+
+        Un mensaje rechazado (429, 503) no se marca y el cliente puede reenviarlo.
+        """
+        if seq is not None and seq > self.last_client_seq:
+            self.last_client_seq = seq
+
+    def attach(self, sink: Sink):
+        self.sink = sink
+        self.last_used = self.clock()
+
+    def detach(self, sink: Sink):
+        # Solo si sigue siendo la misma conexión (pudo reconectar antes)
+        if self.sink == sink:
+            self.sink = None
+
+
+class SessionStreamRegistry:
+    """Flujos de sesión por token y por usuario, acotados en número"""
+
+    def __init__(
+        self,
+        capacity: int = 64,
+        max_sessions: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.capacity = capacity
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self._by_user: "OrderedDict[str, SessionStream]" = OrderedDict()
+        self._by_token: Dict[str, SessionStream] = {}
+        self.registry = registry
+        self.active = registry.gauge("session_streams")
+
+    def __len__(self) -> int:
+        return len(self._by_user)
+
+    def open(self, user_id: str) -> SessionStream:
+        """Crea un flujo nuevo para el usuario (invalida el token anterior)"""
+        self.release(user_id)
+        stream = SessionStream(user_id, secrets.token_urlsafe(16), self.capacity, self.clock)
+        self._by_user[user_id] = stream
+        self._by_token[stream.token] = stream
+        while len(self._by_user) > self.max_sessions:
+            _, oldest = self._by_user.popitem(last=False)
+            self._by_token.pop(oldest.token, None)
+            self.registry.counter("session_streams_evicted_total").inc()
+        self.active.set(len(self._by_user))
+        return stream
+
+    def restore(self, user_id: str, token: str, next_seq: int, last_client_seq: int = 0, buffer=()) -> SessionStream:
+        """Recrea un flujo guardado en una instantánea (mismo token y numeración)"""
+        self.release(user_id)
+        stream = SessionStream(user_id, token, self.capacity, self.clock)
+        stream.next_seq = next_seq
+        stream.last_client_seq = last_client_seq
+        stream.buffer.extend(buffer)
+        self._by_user[user_id] = stream
+        self._by_token[token] = stream
+        self.active.set(len(self._by_user))
+        return stream
+
+    def resume(self, token: Optional[str], last_seq: int = 0) -> Tuple[Optional[SessionStream], List[Dict[str, Any]], bool]:
+        """Devuelve el flujo del token, los mensajes perdidos y si están todos"""
+        stream = self.by_token(token)
+        if stream is None:
+            self.registry.counter("session_resume_failed_total").inc()
+            return None, [], False
+        self._by_user.move_to_end(stream.user_id)
+        missed, complete = stream.replay_after(last_seq)
+        self.registry.counter("session_resumes_total").inc()
+        self.registry.counter("session_replayed_messages_total").inc(len(missed))
+        if not complete:
+            self.registry.counter("session_resume_gaps_total").inc()
+        return stream, missed, complete
+
+    def by_token(self, token: Optional[str]) -> Optional[SessionStream]:
+        return self._by_token.get(token) if token else None
+
+    def for_user(self, user_id: str) -> Optional[SessionStream]:
+        return self._by_user.get(user_id)
+
+    def release(self, user_id: str):
+        stream = self._by_user.pop(user_id, None)
+        if stream is not None:
+            self._by_token.pop(stream.token, None)
+            self.active.set(len(self._by_user))
@@ -0,0 +1,159 @@
+"""
+Parada ordenada del chatbot.
+
+Al recibir SIGTERM (redeploy en Railway) el servidor deja de aceptar trabajo
+nuevo y, antes de que uvicorn cierre las conexiones, ejecuta por fases:
+
+    notify    avisa a los clientes WebSocket/SSE de que deben reconectar
+    (espera)  deja terminar los turnos en curso, con un tiempo máximo
+    close     cierra las conexiones una vez entregadas las respuestas
+    flush     vacía las escrituras pendientes hacia el backend
+    snapshot  guarda el estado de las sesiones (opcional)
+
+Cada fase es una lista de hooks que registra la aplicación; un hook puede
+ser síncrono o asíncrono y devolver un dict de contadores que se añade al
+informe final. Todo el proceso comparte un único presupuesto de tiempo.
+
+`DrainingServer` es un uvicorn.Server que lanza el drenado antes de su propio
+shutdown; la parada por el evento de lifespan sirve de respaldo cuando se
+arranca con el CLI de uvicorn.
+"""
+
+import asyncio
+import inspect
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import uvicorn
+
+from metrics import MetricsRegistry, metrics as default_metrics
+from worker_pool import PoolBusyError
+
+PHASES = ("notify", "close", "flush", "snapshot")
+
+
+class ShuttingDownError(PoolBusyError):
+    """El servidor se está deteniendo y no acepta turnos nuevos"""
+
+
+class ShutdownCoordinator:
+    """Registra los hooks de parada y cuenta los turnos en curso"""
+
+    def __init__(self, timeout: float = 20.0, registry: MetricsRegistry = default_metrics):
+        self.timeout = timeout
+        self.draining = False
+        self.in_flight = 0
+        self.completed_while_draining = 0
+        self.report: Optional[Dict[str, Any]] = None
+        self._hooks: Dict[str, List[Tuple[str, Callable[[], Any]]]] = {phase: [] for phase in PHASES}
+        self._idle: Optional[asyncio.Event] = None
+        self._drain_task: Optional[asyncio.Task] = None
+        self.registry = registry
+        self.in_flight_gauge = registry.gauge("turns_in_flight")
+
+    def add_hook(self, phase: str, name: str, hook: Callable[[], Any]):
+        if phase not in self._hooks:
+            raise ValueError(f"Fase de parada desconocida: {phase}")
+        self._hooks[phase].append((name, hook))
+
+    # ------------------------------------------------------------------
+    # Turnos en curso
+    # ------------------------------------------------------------------
+
+    def check_accepting(self):
+        if self.draining:
+            self.registry.counter("turns_rejected_draining_total").inc()
+            raise ShuttingDownError("El servidor se está reiniciando")
+
+    @contextmanager
+    def track(self):
+        """Marca un turno como en curso (llamar desde el event loop)"""
+        self.in_flight += 1
+        self.in_flight_gauge.set(self.in_flight)
+        if self._idle is not None:
+            self._idle.clear()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.in_flight_gauge.set(self.in_flight)
+            if self.draining:
+                self.completed_while_draining += 1
+            if self.in_flight == 0 and self._idle is not None:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        if self.in_flight == 0:
+            return True
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    # ------------------------------------------------------------------
+    # Drenado
+    # ------------------------------------------------------------------
+
+    async def drain(self) -> Dict[str, Any]:
+        """Ejecuta la parada una sola vez; las llamadas siguientes esperan al mismo resultado"""
+        if self._drain_task is None:
+            self._drain_task = asyncio.get_running_loop().create_task(self._drain())
+        return await asyncio.shield(self._drain_task)
+
+    async def _run_hooks(self, phase: str, deadline: float, report: Dict[str, Any]):
+        for name, hook in self._hooks[phase]:
+            remaining = max(0.1, deadline - time.monotonic())
+            try:
+                result = hook()
+                if inspect.isawaitable(result):
+                    result = await asyncio.wait_for(result, remaining)
+                if isinstance(result, dict):
+                    for key, value in result.items():
+                        report[key] = report.get(key, 0) + value
+            except asyncio.TimeoutError:
+                report.setdefault("timed_out", []).append(name)
+                print(f"[Shutdown] '{name}' no terminó a tiempo")
+            except Exception as e:
+                report.setdefault("failed", []).append(name)
+                print(f"[Shutdown] Error en '{name}': {e}")
+
+    async def _drain(self) -> Dict[str, Any]:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        self.draining = True
+        in_flight_at_start = self.in_flight
+        print(f"[Shutdown] Iniciando parada ordenada ({in_flight_at_start} turnos en curso, máximo {self.timeout:.0f} s)")
+        report: Dict[str, Any] = {}
+        await self._run_hooks("notify", deadline, report)
+        drained = await self.wait_idle(max(0.0, deadline - time.monotonic()))
+        report["turns_in_flight_at_start"] = in_flight_at_start
+        report["turns_completed"] = self.completed_while_draining
+        report["turns_abandoned"] = 0 if drained else self.in_flight
+        for phase in ("close", "flush", "snapshot"):
+            await self._run_hooks(phase, deadline, report)
+        report["duration_seconds"] = round(time.monotonic() - start, 3)
+        self.registry.histogram("shutdown_drain_seconds").observe(report["duration_seconds"])
+        summary = ", ".join(f"{key}={value}" for key, value in report.items())
+        print(f"[Shutdown] Parada ordenada completada: {summary}")
+        self.report = report
+        return report
+
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn.Server que drena la aplicación antes de cerrar las conexiones"""
+
+    async def shutdown(self, sockets=None):
+        coordinator = getattr(getattr(self.config.app, "state", None), "shutdown_coordinator", None)
+        if coordinator is not None and not self.force_exit:
+            await coordinator.drain()
+        await super().shutdown(sockets=sockets)
+
+
+def serve(app, **config_kwargs):
+    """Equivalente a uvicorn.run usando DrainingServer"""
+    server = DrainingServer(uvicorn.Config(app, **config_kwargs))
+    server.run()
@@ -0,0 +1,135 @@
+"""
+Reservas temporales de horario mientras el usuario termina de confirmar.
+
+Al elegir una fecha, la sesión retiene ese horario durante `ttl` segundos y
+deja de ofrecerse a las demás; se libera al confirmar, al reiniciar o
+cancelar y al cerrar la sesión por inactividad. Si un worker muere, sus
+retenciones caducan solas.
+
+Las retenciones se guardan en un fichero SQLite compartido por todos los
+workers. La comprobación y la inserción van en una transacción
+`BEGIN IMMEDIATE`, así que dos sesiones no pueden retener a la vez el último
+hueco de un horario aunque estén en procesos distintos.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slot_holds (
+    slot TEXT NOT NULL,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (slot, holder)
+);
+CREATE INDEX IF NOT EXISTS slot_holds_holder ON slot_holds (holder);
+"""
+
+
+class SlotHoldRegistry:
+    """Retenciones de horario con caducidad, compartidas entre procesos"""
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 600.0,
+        clock: Callable[[], float] = time.time,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid = 0
+        self.registry = registry
+
+    def _conn(self) -> sqlite3.Connection:
+        # Cada worker abre su propia conexión al primer uso; no se reutiliza la del padre tras fork
+        if self._db is None or self._pid != os.getpid():
+            # Espera hasta 5 s si otro worker tiene la base bloqueada
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def acquire(self, slot: datetime, holder: str, capacity: int = 1) -> bool:
+        """Retiene el horario para `holder` si quedan menos de `capacity` retenciones ajenas.
+
+        Cada sesión retiene un solo horario: el anterior se libera. Si la base
+        falla se permite seguir (la reserva final la decide el backend).
+        """
+        now = self.clock()
+        key = slot.isoformat()
+        with self._lock:
+            try:
+                self._conn().execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn().execute("DELETE FROM slot_holds WHERE expires_at <= ?", (now,))
+                    (others,) = self._conn().execute(
+                        "SELECT COUNT(*) FROM slot_holds WHERE slot = ? AND holder != ?", (key, holder)
+                    ).fetchone()
+                    if others >= capacity:
+                        self._conn().execute("ROLLBACK")
+                        self.registry.counter("slot_holds_conflicts_total").inc()
+                        return False
+                    self._conn().execute("DELETE FROM slot_holds WHERE holder = ?", (holder,))
+                    self._conn().execute(
+                        "INSERT INTO slot_holds (slot, holder, expires_at) VALUES (?, ?, ?)",
+                        (key, holder, now + self.ttl),
+                    )
+                    self._conn().execute("COMMIT")
+                except Exception:
+                    self._conn().execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                self.registry.counter("slot_holds_errors_total").inc()
+                print(f"[SlotHolds] Error reteniendo {key} para {holder}: {e}")
+                return True
+        self.registry.counter("slot_holds_acquired_total").inc()
+        return True
+
+    def release(self, holder: str) -> int:
+        """Libera las retenciones de una sesión"""
+        with self._lock:
+            try:
+                cursor = self._conn().execute("DELETE FROM slot_holds WHERE holder = ?", (holder,))
+            except sqlite3.Error as e:
+                print(f"[SlotHolds] Error liberando retenciones de {holder}: {e}")
+                return 0
+        if cursor.rowcount:
+            self.registry.counter("slot_holds_released_total").inc(cursor.rowcount)
+        return cursor.rowcount
+
+    def held(self, exclude_holder: Optional[str] = None) -> Dict[datetime, int]:
+        """Retenciones vigentes por horario (sin contar las de `exclude_holder`)"""
+        with self._lock:
+            try:
+                rows = self._conn().execute(
+                    "SELECT slot, COUNT(*) FROM slot_holds WHERE expires_at > ? AND holder != ? GROUP BY slot",
+                    (self.clock(), exclude_holder or ""),
+                ).fetchall()
+            except sqlite3.Error as e:
+                print(f"[SlotHolds] Error leyendo retenciones: {e}")
+                return {}
+        return {datetime.fromisoformat(slot): count for slot, count in rows}
+
+    def held_by(self, holder: str) -> Optional[datetime]:
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT slot FROM slot_holds WHERE holder = ? AND expires_at > ?", (holder, self.clock())
+            ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def close(self):
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
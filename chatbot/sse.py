@@ -0,0 +1,107 @@
+"""
+Conexión Server-Sent Events con cola de salida acotada.
+
+Alternativa ligera al WebSocket para clientes detrás de proxies que no
+mantienen bien los sockets abiertos: el servidor envía los mensajes de la
+sesión como eventos `text/event-stream` (uno por flush) y el cliente manda
+sus mensajes con un POST aparte. Cada evento lleva como `id` el número de
+secuencia del flujo de sesión, de modo que EventSource reanuda solo con la
+cabecera `Last-Event-ID` que envía al reconectar.
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from metrics import MetricsRegistry, metrics as default_metrics
+from ws_codec import dumps
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    # Evita que nginx/Railway acumulen los eventos en su búfer
+    "X-Accel-Buffering": "no",
+}
+
+KEEPALIVE_COMMENT = ": keepalive\n\n"
+
+_CLOSE = object()
+
+
+def format_event(payload: Dict[str, Any], retry_ms: Optional[int] = None) -> str:
+    """Codifica un mensaje como evento SSE (una sola línea de datos JSON)"""
+    lines = []
+    if retry_ms is not None:
+        lines.append(f"retry: {retry_ms}")
+    if payload.get("seq") is not None:
+        lines.append(f"id: {payload['seq']}")
+    lines.append(f"data: {dumps(payload)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def parse_last_event_id(value: Optional[str]) -> int:
+    if value and value.strip().isdigit():
+        return int(value.strip())
+    return 0
+
+
+class SSEConnection:
+    """Cola de eventos de un cliente SSE; `send` nunca bloquea"""
+
+    def __init__(
+        self,
+        max_queue: int = 32,
+        keepalive: float = 15.0,
+        retry_ms: Optional[int] = None,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.keepalive = keepalive
+        # Intervalo de reconexión para EventSource, se indica en el primer evento
+        self.retry_ms = retry_ms
+        self.closed = False
+        self.registry = registry
+
+    def send(self, payload: Dict[str, Any]) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(format_event(payload, self.retry_ms))
+            self.retry_ms = None
+            return True
+        except asyncio.QueueFull:
+            pass
+        self.registry.counter("sse_outbound_overflow_total").inc()
+        print("[SSE] Cola de salida llena, cerrando flujo de cliente lento")
+        # El cliente reconectará y recibirá lo pendiente desde el búfer de repetición
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.close()
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(_CLOSE)
+
+    async def events(self, is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None) -> AsyncIterator[str]:
+        """Genera los eventos codificados hasta el cierre o la desconexión del cliente"""
+        gauge = self.registry.gauge("sse_connections")
+        gauge.inc()
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    if is_disconnected is not None and await is_disconnected():
+                        return
+                    yield KEEPALIVE_COMMENT
+                    continue
+                if item is _CLOSE:
+                    return
+                yield item
+        finally:
+            self.closed = True
+            gauge.dec()
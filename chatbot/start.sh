@@ -68,7 +68,14 @@ except Exception as e:
 
 echo ""
 echo "🎯 Iniciando servidor del chatbot..."
-echo "Comando: uvicorn main_improved_fixed:app --host 0.0.0.0 --port ${PORT:-8000}"
 
-# Iniciar el servidor
-exec uvicorn main_improved_fixed:app --host 0.0.0.0 --port ${PORT:-8000} 
\ No newline at end of file
+# Con CHATBOT_WORKERS > 1 se usa el lanzador multi-proceso (modelos precargados)
+if [ "${CHATBOT_WORKERS:-1}" -gt 1 ]; then
+    echo "Comando: python launcher.py --workers ${CHATBOT_WORKERS} --port ${PORT:-8000}"
+    exec python launcher.py --workers ${CHATBOT_WORKERS} --host 0.0.0.0 --port ${PORT:-8000}
+fi
+
+echo "Comando: python main_improved_fixed.py (puerto ${PORT:-8000})"
+
+# Iniciar el servidor (con parada ordenada en SIGTERM, ver shutdown.py)
+exec python main_improved_fixed.py
@@ -25,6 +25,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# El chatbot unió el mensaje al turno de uno posterior: no hay que responderlo
+COALESCED = object()
+
 class LegalTelegramBot:
     def __init__(self):
         # Configuración del bot
@@ -343,6 +346,8 @@ Para agendar una cita, puedes:
         try:
             # Enviar mensaje al chatbot
             chatbot_response = self.send_to_chatbot(user_text, f"telegram_{user_id}")
+            if chatbot_response is COALESCED:
+                return
             
             # Procesar respuesta
             if chatbot_response:
@@ -391,13 +396,16 @@ Intentaré resolver el problema pronto.
                 json={
                     "text": message,
                     "language": "es",
-                    "user_id": user_id
+                    "user_id": user_id,
+                    "transport": "telegram"
                 },
                 timeout=10
             )
             
             if response.status_code == 200:
                 data = response.json()
+                if data.get('coalesced'):
+                    return COALESCED
                 return data.get('response', '')
             else:
                 logger.error(f"Error del chatbot: {response.status_code}")
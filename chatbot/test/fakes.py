@@ -0,0 +1,32 @@
+"""
+Utilidades compartidas por las pruebas: reloj controlable y componentes con
+métricas propias, para que las pruebas no compartan contadores entre sí.
+
+Las pruebas lo importan directamente (`from fakes import FakeClock, isolated`):
+funcionan tanto con pytest como ejecutando cada fichero con python.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+
+
+class FakeClock:
+    """Reloj que solo avanza cuando la prueba lo pide"""
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+def isolated(factory, *args, **kwargs):
+    """Crea el componente con su propio MetricsRegistry"""
+    return factory(*args, registry=MetricsRegistry(), **kwargs)
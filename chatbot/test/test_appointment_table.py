@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Prueba exhaustiva de la tabla de estados del flujo de citas: todas las etapas
+con respuestas válidas y no válidas, serialización del estado y velocidad.
+"""
+
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from appointment_flow import COMPLETED, FIELDS, FLOW_TABLE, AppointmentFlow, AppointmentState
+
+DATES = [datetime(2026, 1, 6, 9), datetime(2026, 1, 6, 11), datetime(2026, 1, 7, 9)]
+FILLED = {
+    "fullName": "Ana García", "age": 34, "phone": "612345678", "email": "ana@example.com",
+    "consultationReason": "despido improcedente", "consultationType": "Derecho Laboral",
+    "preferredDate": "2026-01-06T09:00:00Z",
+}
+
+# (etapa, mensaje, etapa siguiente, inicio de la respuesta)
+CASES = [
+    ("initial", "quiero una cita", "name", "¡Perfecto! Te ayudo a agendar tu cita."),
+    ("initial", "sí", "name", "¡Perfecto! Te ayudo a agendar tu cita."),
+    ("initial", "hola", "initial", "Entiendo. ¿Te gustaría agendar una cita"),
+    ("name", "Ana García", "age", "Gracias Ana García. ¿Cuál es tu edad?"),
+    ("name", "An", "name", "Por favor, proporciona tu nombre completo."),
+    ("age", "34", "phone", "Perfecto. ¿Cuál es tu número de teléfono"),
+    ("age", "tengo 34 años", "phone", "Perfecto. ¿Cuál es tu número de teléfono"),
+    ("age", "15", "age", "Debes ser mayor de edad"),
+    ("age", "150", "age", "Por favor, proporciona una edad válida"),
+    ("age", "treinta", "age", "Por favor, proporciona tu edad (solo el número"),
+    ("phone", "612345678", "email", "Excelente. ¿Cuál es tu correo electrónico?"),
+    ("phone", "+34 612 345 678", "email", "Excelente. ¿Cuál es tu correo electrónico?"),
+    ("phone", "123", "phone", "Por favor, proporciona un número de teléfono válido"),
+    ("email", "mi correo es ana@example.com", "reason", "Muy bien. ¿Cuál es el motivo de tu consulta?"),
+    ("email", "ana@", "email", "Por favor, proporciona un email válido."),
+    ("reason", "despido improcedente", "date", "Perfecto. ¿Qué fecha prefieres para tu consulta?"),
+    ("reason", "no", "reason", "Por favor, describe el motivo de tu consulta"),
+    ("date", "2", "confirmation", "📋 **Resumen de tu cita:**"),
+    ("date", "9", "date", "Por favor, selecciona una opción válida (1-3)"),
+    ("date", "el lunes", "date", "Por favor, responde con el número de la opción (1-3)"),
+    ("confirmation", "sí", COMPLETED, "¡Perfecto! Hemos registrado tu solicitud de cita."),
+    ("confirmation", "no", "name", "Entiendo. Empecemos de nuevo."),
+    ("confirmation", "quizás", "confirmation", "Por favor, responde 'sí' para confirmar"),
+    ("submitting", "sí", "submitting", "⏳ Tu cita se sigue procesando."),
+    ("submitting", "¿y mi cita?", "submitting", "⏳ Tu cita se sigue procesando."),
+    ("submitting", "¿cuánto cuesta?", "submitting", None),
+]
+
+
+def make_flow(**kwargs):
+    return AppointmentFlow(available_dates=lambda user_id: list(DATES), **kwargs)
+
+
+def state_at(stage):
+    """Estado con los campos de las etapas anteriores ya rellenos"""
+    state = AppointmentState(stage)
+    order = [step for step in FLOW_TABLE if FLOW_TABLE[step].field]
+    if stage in order:
+        for step in order[:order.index(stage)]:
+            state.data[FLOW_TABLE[step].field] = FILLED[FLOW_TABLE[step].field]
+    elif stage != "initial":
+        state.data.update(FILLED)
+    if stage == "date":
+        state.data["preferredDate"] = None
+        state.offered = [date.isoformat() for date in DATES]
+    return state
+
+
+def test_every_stage_and_branch():
+    flow = make_flow()
+    for stage, text, expected_stage, expected_reply in CASES:
+        state = state_at(stage)
+        reply = flow.handle("ana", state, text)
+        assert state.stage == expected_stage, (stage, text, state.stage)
+        if expected_reply is None:
+            assert reply is None, (stage, text, reply)
+        else:
+            assert reply.startswith(expected_reply), (stage, text, reply)
+    # Todas las filas de la tabla tienen casos
+    assert {case[0] for case in CASES} == set(FLOW_TABLE)
+
+
+def test_field_steps_store_the_extracted_value():
+    flow = make_flow()
+    state = state_at("phone")
+    flow.handle("ana", state, "+34 612 345 678")
+    assert state.data["phone"] == "+34612345678"
+    state = state_at("reason")
+    flow.handle("ana", state, "divorcio y custodia")
+    assert state.data["consultationType"] == "Derecho Familiar"
+    assert state.offered == [date.isoformat() for date in DATES]
+    state = state_at("date")
+    flow.handle("ana", state, "3")
+    assert state.data["preferredDate"] == "2026-01-07T09:00:00Z"
+
+
+def test_negative_confirmation_starts_over_and_releases_hold():
+    released = []
+    flow = make_flow(release=released.append)
+    state = state_at("confirmation")
+    flow.handle("ana", state, "no")
+    assert released == ["ana"]
+    assert state.to_dict() == {"stage": "name"}
+
+
+def test_taken_slot_is_reoffered():
+    offers = [list(DATES), DATES[1:]]
+    flow = AppointmentFlow(available_dates=lambda user_id: offers.pop(0), hold=lambda user_id, slot: False)
+    state = state_at("date")
+    reply = flow.handle("ana", state, "1")
+    assert reply.startswith("Lo siento, ese horario acaba de ser reservado.")
+    assert state.stage == "date" and state.offered == [date.isoformat() for date in DATES]
+
+
+def test_no_dates_closes_the_flow():
+    flow = AppointmentFlow(available_dates=lambda user_id: [], no_dates=lambda user_id: "sin huecos")
+    state = state_at("reason")
+    assert flow.handle("ana", state, "despido improcedente") == "sin huecos"
+    assert state.stage == COMPLETED
+
+
+def test_last_slot_taken_closes_the_flow():
+    # El horario elegido era el último libre
+    flow = AppointmentFlow(available_dates=lambda user_id: [], hold=lambda user_id, slot: False,
+                           no_dates=lambda user_id: "sin huecos")
+    state = state_at("date")
+    assert flow.handle("ana", state, "1") == "sin huecos"
+    assert state.stage == COMPLETED
+
+
+def test_hooks_see_stage_changes_and_submit():
+    entered, submitted = [], []
+
+    def submit(user_id, state):
+        submitted.append(dict(state.data))
+        state.stage = "submitting"
+        return "procesando"
+
+    flow = make_flow(on_enter=lambda user_id, state: entered.append(state.stage), submit=submit)
+    state = AppointmentState("name")
+    for text in ("Ana García", "34", "612345678", "ana@example.com", "despido improcedente", "1", "sí"):
+        reply = flow.handle("ana", state, text)
+    assert reply == "procesando" and state.stage == "submitting"
+    assert entered == ["age", "phone", "email", "reason", "date", "confirmation"]
+    assert submitted[0]["preferredDate"] == "2026-01-06T09:00:00Z"
+
+
+def test_state_is_compact_and_round_trips():
+    state = state_at("date")
+    state.key = "clave"
+    encoded = json.dumps(state.to_dict())
+    assert "null" not in encoded
+    restored = AppointmentState.from_dict(json.loads(encoded))
+    assert restored == state
+    assert restored.offered_dates == DATES
+    assert set(restored.data) == set(FIELDS)
+    assert AppointmentState.from_dict(AppointmentState().to_dict()).to_dict() == {"stage": "initial"}
+
+
+def test_legacy_snapshot_is_mapped_to_a_stage():
+    legacy = {"stage": "collecting_info", "data": {"fullName": "Ana", "age": 30, "phone": None},
+              "current_question": None, "context": {"available_dates": DATES, "outbox_key": "k1"}}
+    state = AppointmentState.from_dict(legacy)
+    assert state.stage == "phone"
+    assert state.offered_dates == DATES and state.key == "k1"
+    assert AppointmentState.from_dict(dict(legacy, data=FILLED)).stage == "confirmation"
+
+
+def run_benchmark(conversations=5000):
+    """Conversaciones completas con el estado serializado entre turnos (como en un almacén compartido)"""
+    flow = make_flow()
+    turns = ("quiero una cita", "Ana García", "34", "612345678", "ana@example.com", "despido improcedente",
+             "uno", "2", "sí")
+    start = time.perf_counter()
+    for _ in range(conversations):
+        stored = AppointmentState().to_dict()
+        for text in turns:
+            state = AppointmentState.from_dict(stored)
+            flow.handle("ana", state, text)
+            stored = state.to_dict()
+        assert stored["stage"] == COMPLETED
+    return (time.perf_counter() - start) / (conversations * len(turns))
+
+
+def test_benchmark_full_conversations():
+    per_turn = run_benchmark(2000)
+    # Holgado para máquinas lentas de CI
+    assert per_turn < 0.001
+
+
+if __name__ == "__main__":
+    for test in (test_every_stage_and_branch, test_field_steps_store_the_extracted_value,
+                 test_negative_confirmation_starts_over_and_releases_hold, test_taken_slot_is_reoffered,
+                 test_no_dates_closes_the_flow, test_last_slot_taken_closes_the_flow,
+                 test_hooks_see_stage_changes_and_submit,
+                 test_state_is_compact_and_round_trips, test_legacy_snapshot_is_mapped_to_a_stage):
+        test()
+        print(f"✅ {test.__name__}")
+    print(f"✅ benchmark: {run_benchmark() * 1e6:.1f} µs por turno con el estado serializado")
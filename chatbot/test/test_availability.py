@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Prueba del motor de disponibilidad (índice de intervalos, recarga incremental,
+caché por día) y benchmark con miles de citas reservadas.
+"""
+
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from availability import AvailabilityEngine, DayIndex
+from metrics import MetricsRegistry
+
+# Lunes
+NOW = datetime(2026, 1, 5, 8, 0)
+
+
+def make_engine(**kwargs):
+    return AvailabilityEngine(now=lambda: NOW, registry=MetricsRegistry(), **kwargs)
+
+
+def booking(booking_id, when, status="PENDIENTE", updated="1"):
+    return {"id": booking_id, "preferredDate": when.isoformat() + ".000Z", "status": status, "updatedAt": updated}
+
+
+def test_day_index_overlaps():
+    index = DayIndex()
+    index.add(9 * 60, 10 * 60, "a")
+    index.add(10 * 60 + 30, 11 * 60 + 30, "b")
+    assert index.overlapping(9 * 60, 10 * 60) == 1
+    assert index.overlapping(10 * 60, 10 * 60 + 30) == 0
+    assert index.overlapping(11 * 60, 12 * 60) == 1
+    assert index.overlapping(8 * 60, 9 * 60) == 0
+    assert index.remove(9 * 60, 10 * 60, "a")
+    assert not index.remove(9 * 60, 10 * 60, "a")
+    assert index.overlapping(9 * 60, 10 * 60) == 0
+
+
+def test_default_slots_without_bookings():
+    slots = make_engine().available(limit=8)
+    assert len(slots) == 8
+    # Empieza mañana, solo días laborables y en las horas configuradas
+    assert slots[0] == datetime(2026, 1, 6, 9)
+    assert all(slot.weekday() < 5 and slot.hour in (9, 11, 14, 16, 18) for slot in slots)
+
+
+def test_booked_slots_are_not_offered():
+    engine = make_engine()
+    engine.apply([booking("c1", datetime(2026, 1, 6, 9)), booking("c2", datetime(2026, 1, 6, 11))])
+    slots = engine.available(limit=3)
+    assert slots == [datetime(2026, 1, 6, 14), datetime(2026, 1, 6, 16), datetime(2026, 1, 6, 18)]
+    assert not engine.is_free(datetime(2026, 1, 6, 9))
+
+
+def test_cancelled_past_and_removed_bookings_free_the_slot():
+    engine = make_engine()
+    engine.apply([booking("c1", datetime(2026, 1, 6, 9)), booking("old", datetime(2025, 12, 1, 9))])
+    assert not engine.is_free(datetime(2026, 1, 6, 9))
+    changes = engine.apply([booking("c1", datetime(2026, 1, 6, 9), status="CANCELADA", updated="2")])
+    assert changes == {"added": 0, "removed": 1}
+    assert engine.is_free(datetime(2026, 1, 6, 9))
+
+
+def test_refresh_is_incremental_and_cache_is_per_day():
+    engine = make_engine()
+    first = [booking(f"c{i}", datetime(2026, 1, 6 + i % 4, 9)) for i in range(5)]
+    assert engine.apply(first) == {"added": 5, "removed": 0}
+    engine.available(limit=100)
+    misses = engine.registry.counter("availability_cache_misses_total").value
+    # Sin cambios: nada que tocar y todo sale de la caché
+    assert engine.apply(first) == {"added": 0, "removed": 0}
+    engine.available(limit=100)
+    assert engine.registry.counter("availability_cache_misses_total").value == misses
+
+    # Una cita movida solo invalida los días afectados
+    moved = first[:4] + [booking("c4", datetime(2026, 1, 12, 11), updated="2")]
+    assert engine.apply(moved) == {"added": 1, "removed": 1}
+    engine.available(limit=100)
+    assert engine.registry.counter("availability_cache_misses_total").value == misses + 2
+
+
+def test_provisional_bookings_until_backend_confirms():
+    engine = make_engine()
+    engine.book("clave-1", datetime(2026, 1, 6, 9))
+    assert not engine.is_free(datetime(2026, 1, 6, 9))
+    engine.confirm("clave-1", {"id": "real-1", "preferredDate": "2026-01-06T09:00:00.000Z"})
+    assert not engine.is_free(datetime(2026, 1, 6, 9))
+    engine.book("clave-2", datetime(2026, 1, 6, 11))
+    engine.release("clave-2")
+    assert engine.is_free(datetime(2026, 1, 6, 11))
+    # La recarga del backend no borra las provisionales
+    engine.book("clave-3", datetime(2026, 1, 7, 9))
+    engine.apply([])
+    assert not engine.is_free(datetime(2026, 1, 7, 9))
+
+
+def test_capacity_allows_parallel_appointments():
+    engine = make_engine(capacity=2)
+    engine.apply([booking("c1", datetime(2026, 1, 6, 9))])
+    assert engine.is_free(datetime(2026, 1, 6, 9))
+    engine.apply([booking("c1", datetime(2026, 1, 6, 9)), booking("c2", datetime(2026, 1, 6, 9))])
+    assert not engine.is_free(datetime(2026, 1, 6, 9))
+
+
+def test_exclude_hook():
+    engine = make_engine()
+    held = {datetime(2026, 1, 6, 9): 1}
+    assert engine.available(limit=1, exclude=lambda slot, remaining: held.get(slot, 0) >= remaining) == [
+        datetime(2026, 1, 6, 11)]
+    assert engine.remaining(datetime(2026, 1, 6, 9)) == 1
+
+
+def run_benchmark(bookings=5000, queries=2000):
+    """Carga miles de citas y mide la recarga completa, la incremental y las consultas"""
+    rng = random.Random(42)
+    engine = AvailabilityEngine(now=lambda: NOW, horizon_days=60, slot_hours=range(8, 20),
+                                slot_minutes=30, capacity=3, registry=MetricsRegistry())
+    appointments = []
+    for i in range(bookings):
+        day = NOW + timedelta(days=rng.randint(1, 60))
+        appointments.append(booking(f"c{i}", day.replace(hour=rng.randint(8, 19), minute=rng.choice((0, 30)))))
+
+    start = time.perf_counter()
+    engine.apply(appointments)
+    full_load = time.perf_counter() - start
+
+    appointments[0] = dict(appointments[0], status="CANCELADA", updatedAt="2")
+    start = time.perf_counter()
+    engine.apply(appointments)
+    incremental = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        engine.is_free((NOW + timedelta(days=rng.randint(1, 60))).replace(hour=rng.randint(8, 19)))
+    per_query = (time.perf_counter() - start) / queries
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        engine.available(limit=8)
+    per_listing = (time.perf_counter() - start) / queries
+    return full_load, incremental, per_query, per_listing
+
+
+def test_benchmark_thousands_of_bookings():
+    full_load, incremental, per_query, per_listing = run_benchmark()
+    # Holgado para máquinas lentas de CI; en local es un orden de magnitud menos
+    assert full_load < 2.0
+    assert per_query < 0.001
+    assert per_listing < 0.001
+
+
+if __name__ == "__main__":
+    for test in (test_day_index_overlaps, test_default_slots_without_bookings, test_booked_slots_are_not_offered,
+                 test_cancelled_past_and_removed_bookings_free_the_slot, test_refresh_is_incremental_and_cache_is_per_day,
+                 test_provisional_bookings_until_backend_confirms, test_capacity_allows_parallel_appointments,
+                 test_exclude_hook):
+        test()
+        print(f"✅ {test.__name__}")
+    full_load, incremental, per_query, per_listing = run_benchmark()
+    print(f"✅ benchmark 5000 citas: carga {full_load * 1000:.1f} ms, recarga incremental {incremental * 1000:.1f} ms, "
+          f"hueco {per_query * 1e6:.1f} µs, listado {per_listing * 1e6:.1f} µs")
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Prueba de la cola write-behind de registro en el backend (lotes, respaldo y límites)
+"""
+
+import asyncio
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from backend_writes import BackendWriteBehind, BatchUnsupported
+from metrics import MetricsRegistry
+from outbox import PermanentDeliveryError
+
+
+class FakeBackend:
+    """Registra las llamadas individuales como lo haría el backend"""
+
+    def __init__(self, batch=None, fail_creates=0):
+        self.calls = []
+        self.batches = []
+        self.batch_attempts = 0
+        self.batch = batch
+        self.fail_creates = fail_creates
+
+    def create(self, session_id, **fields):
+        if self.fail_creates:
+            self.fail_creates -= 1
+            return None
+        self.calls.append(("create", session_id))
+        return {"id": f"conv-{session_id}"}
+
+    def add_message(self, conversation_id, message_type, content):
+        self.calls.append(("message", conversation_id, content))
+        return {"id": len(self.calls)}
+
+    def complete(self, conversation_id, appointment_id=None):
+        self.calls.append(("complete", conversation_id, appointment_id))
+        return {}
+
+    def log_email(self, **fields):
+        self.calls.append(("email", fields["recipient"]))
+        return {}
+
+    def send_batch(self, payload):
+        self.batch_attempts += 1
+        if self.batch is None:
+            raise BatchUnsupported(404)
+        self.batches.append(payload)
+        return {"conversation_ids": {c["session_id"]: f"conv-{c['session_id']}" for c in payload["conversations"]}}
+
+
+def make_queue(backend, **kwargs):
+    clock = kwargs.pop("clock", lambda: 0.0)
+    return BackendWriteBehind(
+        create=backend.create, add_message=backend.add_message, complete=backend.complete,
+        log_email=backend.log_email, send_batch=backend.send_batch, clock=clock,
+        registry=MetricsRegistry(), **kwargs,
+    )
+
+
+def test_events_are_coalesced_per_conversation_in_one_batch():
+    backend = FakeBackend(batch=True)
+    queue = make_queue(backend)
+    for i in range(3):
+        queue.add_message("u1", message_type="user_input", content=f"hola {i}")
+        queue.add_message("u2", message_type="user_input", content=f"buenas {i}")
+    queue.complete_conversation("u1", "cita-1")
+    queue.log_email(recipient="ana@example.com", subject="s", template="t")
+    report = queue.flush_sync()
+
+    assert len(backend.batches) == 1 and backend.calls == []
+    conversations = {c["session_id"]: c for c in backend.batches[0]["conversations"]}
+    assert [m["content"] for m in conversations["u1"]["messages"]] == ["hola 0", "hola 1", "hola 2"]
+    assert conversations["u1"]["complete"] == {"appointment_id": "cita-1"}
+    assert conversations["u2"]["create"]["session_id"] == "u2"
+    assert report == {"backend_writes_flushed": 10, "backend_writes_dropped": 0}
+    assert queue.pending == 0
+
+    # La conversación ya existe: el siguiente lote no la vuelve a crear
+    queue.add_message("u1", message_type="bot_response", content="adiós")
+    queue.flush_sync()
+    follow_up = backend.batches[1]["conversations"][0]
+    assert follow_up["create"] is None and follow_up["conversation_id"] == "conv-u1"
+
+
+def test_falls_back_to_single_calls_without_batch_endpoint():
+    now = [0.0]
+    backend = FakeBackend(batch=None)
+    queue = make_queue(backend, batch_retry_after=60, clock=lambda: now[0])
+
+    queue.add_message("u1", message_type="user_input", content="hola")
+    queue.complete_conversation("u1")
+    queue.log_email(recipient="ana@example.com", subject="s", template="t")
+    queue.flush_sync()
+    assert backend.calls == [("create", "u1"), ("message", "conv-u1", "hola"),
+                             ("complete", "conv-u1", None), ("email", "ana@example.com")]
+
+    # No se vuelve a probar el endpoint de lotes hasta que pase batch_retry_after
+    queue.add_message("u1", message_type="user_input", content="otra")
+    queue.flush_sync()
+    assert backend.batch_attempts == 1
+    now[0] = 61
+    queue.add_message("u1", message_type="user_input", content="más")
+    queue.flush_sync()
+    assert backend.batch_attempts == 2
+
+
+def test_failed_items_are_retried_in_order_then_dropped():
+    backend = FakeBackend(fail_creates=1)
+    queue = make_queue(backend)
+    queue.add_message("u1", message_type="user_input", content="uno")
+    queue.flush_sync()
+    assert backend.calls == [] and queue.pending == 2
+
+    queue.add_message("u1", message_type="user_input", content="dos")
+    queue.flush_sync()
+    assert backend.calls == [("create", "u1"), ("message", "conv-u1", "uno"), ("message", "conv-u1", "dos")]
+    assert queue.pending == 0
+
+    broken = FakeBackend(fail_creates=10)
+    queue = make_queue(broken, max_attempts=2)
+    queue.add_message("u1", message_type="user_input", content="uno")
+    queue.flush_sync()
+    report = queue.flush_sync()
+    assert report["backend_writes_dropped"] == 2 and queue.pending == 0
+
+
+def test_undeliverable_events_are_spilled_and_replayed():
+    broken = FakeBackend(fail_creates=2)
+    broken.log_email = lambda **fields: None
+    spilled = []
+    queue = make_queue(broken, max_attempts=1, spill=spilled.append)
+    queue.add_message("u1", message_type="user_input", content="uno")
+    queue.log_email(recipient="ana@example.com", subject="s", template="t")
+    report = queue.flush_sync()
+    assert report["backend_writes_dropped"] == 0 and queue.pending == 0
+    assert len(spilled) == 2
+
+    # Más tarde (p. ej. desde el outbox) se entregan con llamadas individuales
+    recovered = FakeBackend()
+    replayer = make_queue(recovered)
+    for record in spilled:
+        replayer.replay(record)
+    assert recovered.calls == [("create", "u1"), ("message", "conv-u1", "uno"), ("email", "ana@example.com")]
+
+
+def test_rejected_events_are_not_retried_or_spilled():
+    backend = FakeBackend()
+
+    def unauthorized(*args, **fields):
+        raise PermanentDeliveryError("401 - Unauthorized")
+
+    backend.create = backend.log_email = unauthorized
+    spilled = []
+    queue = make_queue(backend, spill=spilled.append)
+    queue.add_message("u1", message_type="user_input", content="uno")
+    queue.log_email(recipient="ana@example.com", subject="s", template="t")
+    queue.flush_sync()
+    assert queue.pending == 0 and spilled == []
+    assert queue.registry.counter("backend_writes_rejected_total").value == 3
+    assert queue.flush_sync() == {"backend_writes_flushed": 0, "backend_writes_dropped": 0}
+
+
+def test_spill_pending_on_shutdown():
+    spilled = []
+    queue = make_queue(FakeBackend(), spill=spilled.append)
+    queue.add_message("u1", message_type="user_input", content="uno")
+    queue.add_message("u1", message_type="bot_response", content="dos")
+    assert queue.spill_pending() == {"backend_writes_spilled": 3}
+    assert [m["content"] for m in spilled[0]["messages"]] == ["uno", "dos"]
+    assert queue.pending == 0
+
+
+def test_memory_is_bounded():
+    backend = FakeBackend(batch=True)
+    queue = make_queue(backend, max_pending=10)
+    accepted = sum(queue.add_message(f"u{i}", message_type="user_input", content="x") for i in range(50))
+    assert queue.pending <= 11
+    assert accepted < 50
+    assert queue.registry.counter("backend_writes_dropped_total").value == 50 - accepted
+
+
+def test_end_session_starts_a_new_conversation():
+    backend = FakeBackend()
+    queue = make_queue(backend)
+    queue.add_message("u1", message_type="user_input", content="primera")
+    queue.end_session("u1")
+    queue.add_message("u1", message_type="user_input", content="segunda")
+    queue.flush_sync()
+    assert [c for c in backend.calls if c[0] == "create"] == [("create", "u1"), ("create", "u1")]
+
+
+def test_flusher_wakes_on_batch_size_from_other_threads():
+    backend = FakeBackend(batch=True)
+    queue = make_queue(backend, batch_size=10, flush_interval=60)
+
+    async def scenario():
+        queue.start()
+        await asyncio.sleep(0)
+        producers = [threading.Thread(target=lambda i=i: [
+            queue.add_message(f"u{i}", message_type="user_input", content=str(n)) for n in range(5)
+        ]) for i in range(4)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        for _ in range(100):
+            if queue.pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert queue.pending == 0
+    sent = [m["content"] for batch in backend.batches for c in batch["conversations"] if c["session_id"] == "u0"
+            for m in c["messages"]]
+    assert sent == ["0", "1", "2", "3", "4"]
+    assert queue.flush_seconds.count >= 1
+
+
+if __name__ == "__main__":
+    for test in (test_events_are_coalesced_per_conversation_in_one_batch,
+                 test_falls_back_to_single_calls_without_batch_endpoint,
+                 test_failed_items_are_retried_in_order_then_dropped,
+                 test_undeliverable_events_are_spilled_and_replayed, test_rejected_events_are_not_retried_or_spilled,
+                 test_spill_pending_on_shutdown,
+                 test_memory_is_bounded,
+                 test_end_session_starts_a_new_conversation, test_flusher_wakes_on_batch_size_from_other_threads):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Prueba del procesamiento por lotes (orden por usuario, paralelismo y reintentos)
+"""
+
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from batch import group_by_user, new_namespace, run_batch, run_batch_sync
+from metrics import MetricsRegistry
+from worker_pool import PoolBusyError
+
+
+class RecordingHandler:
+    """Simula run_turn: guarda el orden y detecta turnos simultáneos del mismo usuario"""
+
+    def __init__(self, delay=0.001):
+        self.delay = delay
+        self.seen = {}
+        self.running = set()
+        self.overlaps = 0
+        self.max_parallel = 0
+
+    async def __call__(self, user_id, text, language):
+        if user_id in self.running:
+            self.overlaps += 1
+        self.running.add(user_id)
+        self.max_parallel = max(self.max_parallel, len(self.running))
+        await asyncio.sleep(self.delay * random.random())
+        self.seen.setdefault(user_id, []).append(text)
+        self.running.discard(user_id)
+        return f"eco:{text}", "2026-01-01T00:00:00"
+
+
+def test_group_by_user_accepts_tuples_and_dicts():
+    groups = group_by_user([("a", "1"), {"user_id": "b", "text": "2", "language": "en"}, ("a", "3", "es")])
+    assert list(groups) == ["a", "b"]
+    assert groups["a"] == [(0, "1", "es"), (2, "3", "es")]
+    assert groups["b"] == [(1, "2", "en")]
+
+
+def test_per_user_order_and_parallelism():
+    turns = [(f"u{i % 20}", str(i)) for i in range(400)]
+    handler = RecordingHandler()
+    results = run_batch_sync(turns, handler, concurrency=8, registry=MetricsRegistry())
+    assert [r["index"] for r in results] == list(range(400))
+    assert all(r["response"] == f"eco:{i}" for i, r in enumerate(results))
+    for user, texts in handler.seen.items():
+        assert texts == sorted(texts, key=int)
+    assert handler.overlaps == 0
+    assert 1 < handler.max_parallel <= 8
+
+
+def test_busy_pool_is_retried():
+    attempts = {"n": 0}
+
+    async def flaky(user_id, text, language):
+        attempts["n"] += 1
+        if attempts["n"] < 3:
+            raise PoolBusyError("lleno")
+        return "ok", "ts"
+
+    results = run_batch_sync([("u", "hola")], flaky, retries=3, retry_delay=0.001, registry=MetricsRegistry())
+    assert results[0]["response"] == "ok"
+    assert attempts["n"] == 3
+
+
+def test_errors_reported_and_batch_continues():
+    async def failing(user_id, text, language):
+        if text == "mal":
+            raise ValueError("turno inválido")
+        return text, "ts"
+
+    registry = MetricsRegistry()
+    results = run_batch_sync([("u", "bien"), ("u", "mal"), ("u", "otra")], failing, registry=registry)
+    assert results[1]["error"] == "ValueError"
+    assert results[2]["response"] == "otra"
+    assert registry.snapshot()["batch_turn_errors_total"] == 1
+
+
+def test_sessions_released_per_user():
+    released = []
+    run_batch_sync([("a", "1"), ("b", "2"), ("a", "3")], RecordingHandler(), on_user_done=released.append,
+                   registry=MetricsRegistry())
+    assert sorted(released) == ["a", "b"]
+
+
+def test_sessions_are_namespaced_per_batch():
+    """El handler ve sesiones propias del lote; los resultados conservan el user_id"""
+    handler = RecordingHandler()
+    released = []
+    namespace = new_namespace()
+    results = run_batch_sync([("ana", "1"), ("ana", "2")], handler, on_user_done=released.append,
+                             namespace=namespace, registry=MetricsRegistry())
+    assert list(handler.seen) == [f"{namespace}ana"]
+    assert released == [f"{namespace}ana"]
+    assert [result["user_id"] for result in results] == ["ana", "ana"]
+    assert new_namespace() != namespace
+
+
+def test_consumer_can_stop_early():
+    handler = RecordingHandler(delay=0.01)
+
+    async def scenario():
+        results = run_batch([(f"u{i}", "x") for i in range(50)], handler, concurrency=2, registry=MetricsRegistry())
+        async for _ in results:
+            break
+        await results.aclose()
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert sum(len(texts) for texts in handler.seen.values()) < 50
+
+
+if __name__ == "__main__":
+    for test in (test_group_by_user_accepts_tuples_and_dicts, test_per_user_order_and_parallelism,
+                 test_busy_pool_is_retried, test_errors_reported_and_batch_continues,
+                 test_sessions_released_per_user, test_sessions_are_namespaced_per_batch, test_consumer_can_stop_early):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Prueba de la agrupación de mensajes seguidos de una misma sesión
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from debounce import MessageCoalescer
+from metrics import MetricsRegistry
+
+
+def make_coalescer(**kwargs):
+    kwargs.setdefault("windows", {"telegram": 0.05, "chat": 0.0})
+    return MessageCoalescer(registry=MetricsRegistry(), **kwargs)
+
+
+async def burst(coalescer, session_id, texts, transport="telegram", gap=0.01):
+    tasks = []
+    for text in texts:
+        tasks.append(asyncio.create_task(coalescer.submit(session_id, text, transport)))
+        await asyncio.sleep(gap)
+    return await asyncio.gather(*tasks)
+
+
+def test_zero_window_passes_through():
+    coalescer = make_coalescer()
+    results = asyncio.run(burst(coalescer, "ana", ["hola", "cita"], transport="chat", gap=0))
+    assert results == ["hola", "cita"]
+    assert coalescer.pending() == 0
+    assert coalescer.stats()["chat"]["ratio"] == 1.0
+
+
+def test_rapid_messages_become_one_turn():
+    coalescer = make_coalescer()
+    results = asyncio.run(burst(coalescer, "ana", ["hola", "quería", "una cita"]))
+    assert results == [None, None, "hola quería una cita"]
+    assert coalescer.pending() == 0
+    stats = coalescer.stats()["telegram"]
+    assert stats["messages"] == 3 and stats["turns"] == 1 and stats["ratio"] == 3.0
+    assert coalescer.registry.counter("coalesce_telegram_merged_total").value == 2
+
+
+def test_max_wait_bounds_the_batch():
+    coalescer = make_coalescer(windows={"telegram": 0.05}, max_wait=0.08)
+
+    async def scenario():
+        # Mensajes cada 30 ms: sin tope la ventana no cerraría nunca
+        return await burst(coalescer, "ana", [str(n) for n in range(8)], gap=0.03)
+
+    results = asyncio.run(scenario())
+    turns = [text for text in results if text is not None]
+    assert len(turns) >= 2
+    assert " ".join(turns).split() == [str(n) for n in range(8)]
+
+
+def test_sessions_are_independent():
+    coalescer = make_coalescer()
+
+    async def scenario():
+        return await asyncio.gather(
+            burst(coalescer, "ana", ["hola", "ana"]),
+            burst(coalescer, "luis", ["hola", "luis"]),
+        )
+
+    assert asyncio.run(scenario()) == [[None, "hola ana"], [None, "hola luis"]]
+
+
+def test_unknown_transport_uses_default():
+    coalescer = make_coalescer()
+    assert coalescer.transport("fax") == "chat"
+    assert coalescer.transport(None) == "chat"
+    results = asyncio.run(burst(coalescer, "ana", ["a", "b"], transport="fax", gap=0))
+    assert results == ["a", "b"]
+
+
+def test_cancelled_last_message_hands_earlier_ones_to_the_next():
+    coalescer = make_coalescer(windows={"telegram": 1.0}, max_wait=0.1)
+
+    async def scenario():
+        first = asyncio.create_task(coalescer.submit("ana", "hola", "telegram"))
+        await asyncio.sleep(0.01)
+        last = asyncio.create_task(coalescer.submit("ana", "adiós", "telegram"))
+        await asyncio.sleep(0.01)
+        last.cancel()
+        await asyncio.gather(last, return_exceptions=True)
+        assert await first is None and coalescer.pending() == 1
+        # El texto ya aceptado de "hola" va en el siguiente turno de la sesión
+        return await coalescer.submit("ana", "quería una cita", "telegram")
+
+    assert asyncio.run(scenario()) == "hola quería una cita"
+    assert coalescer.pending() == 0
+
+
+def test_cancelled_only_message_leaves_nothing_pending():
+    coalescer = make_coalescer(windows={"telegram": 1.0})
+
+    async def scenario():
+        only = asyncio.create_task(coalescer.submit("ana", "hola", "telegram"))
+        await asyncio.sleep(0.01)
+        only.cancel()
+        await asyncio.gather(only, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert coalescer.pending() == 0
+
+
+if __name__ == "__main__":
+    for test in (test_zero_window_passes_through, test_rapid_messages_become_one_turn,
+                 test_max_wait_bounds_the_batch, test_sessions_are_independent,
+                 test_unknown_transport_uses_default, test_cancelled_last_message_hands_earlier_ones_to_the_next,
+                 test_cancelled_only_message_leaves_nothing_pending):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Prueba de memoria del historial circular con WebSockets de larga duración.
+
+Simula muchas conexiones abiertas durante miles de turnos sobre el mismo
+HistoryStore y comprueba que la memoria se estabiliza en vez de crecer.
+"""
+
+import asyncio
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from conversation_history import ConversationHistory, HistoryStore
+
+
+def test_ring_buffer_capacity():
+    history = ConversationHistory(capacity=4, max_bytes=10_000)
+    for i in range(10):
+        history.append({"text": f"mensaje {i}", "isUser": i % 2 == 0})
+    assert len(history) == 4
+    assert [m["text"] for m in history] == [f"mensaje {i}" for i in range(6, 10)]
+    assert [m["text"] for m in history.recent(3)] == ["mensaje 7", "mensaje 8", "mensaje 9"]
+    assert next(reversed(history))["text"] == "mensaje 9"
+
+
+def test_ring_buffer_byte_cap():
+    history = ConversationHistory(capacity=100, max_bytes=50)
+    for _ in range(10):
+        history.append({"text": "x" * 20})
+    assert history.size_bytes <= 50
+    assert len(history) == 2
+    # Un mensaje mayor que el límite se conserva solo
+    history.append({"text": "y" * 80})
+    assert len(history) == 1
+    assert history.size_bytes == 80
+
+
+def test_shared_store_between_transports():
+    store = HistoryStore(capacity=6, max_bytes=10_000)
+    store.get("u1").append({"text": "desde /chat", "isUser": True})
+    store.get("u1").append({"text": "desde /ws", "isUser": True})
+    assert [m["text"] for m in store["u1"]] == ["desde /chat", "desde /ws"]
+    assert store.pop("u1") is not None
+    assert "u1" not in store
+
+
+def run_soak():
+    store = HistoryStore(capacity=10, max_bytes=4096)
+    connections = 100
+    turns = 1000
+
+    async def websocket_session(user_id: str, turn_range: range):
+        for turn in turn_range:
+            history = store.get(user_id)
+            history.append({"text": f"Pregunta {turn} " * 5, "isUser": True, "timestamp": datetime.now().isoformat()})
+            history.append({"text": f"Respuesta {turn} " * 10, "isUser": False, "timestamp": datetime.now().isoformat()})
+            if turn % 50 == 0:
+                await asyncio.sleep(0)
+
+    async def run(turn_range: range):
+        await asyncio.gather(*(websocket_session(f"ws-{i}", turn_range) for i in range(connections)))
+
+    tracemalloc.start()
+    asyncio.run(run(range(0, 100)))
+    warm, _ = tracemalloc.get_traced_memory()
+    asyncio.run(run(range(100, turns)))
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(store) == connections
+    assert all(len(store[f"ws-{i}"]) == 10 for i in range(connections))
+    assert store.total_bytes() <= connections * 4096
+    return warm, after
+
+
+def test_long_lived_websockets_memory_soak():
+    warm, after = run_soak()
+    # Tras 10x más turnos la memoria no debe crecer de forma apreciable
+    assert after < warm * 1.2, f"memoria creció de {warm} a {after} bytes"
+
+
+if __name__ == "__main__":
+    test_ring_buffer_capacity()
+    print("✅ test_ring_buffer_capacity")
+    test_ring_buffer_byte_cap()
+    print("✅ test_ring_buffer_byte_cap")
+    test_shared_store_between_transports()
+    print("✅ test_shared_store_between_transports")
+    warm, after = run_soak()
+    assert after < warm * 1.2
+    print(f"✅ test_long_lived_websockets_memory_soak ({warm / 1024:.0f} KB -> {after / 1024:.0f} KB)")
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Prueba de las claves de idempotencia derivadas y de la caché de resultados
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from idempotency import IdempotencyCache, idempotency_key
+from metrics import MetricsRegistry
+from outbox import DELIVERED, PENDING, OutboxDispatcher, OutboxStore
+from fakes import FakeClock, isolated
+
+FORM = {
+    "fullName": "Ana García",
+    "age": 34,
+    "phone": "612345678",
+    "email": "ana@example.com",
+    "consultationReason": "despido improcedente",
+    "preferredDate": "2026-01-06T09:00:00Z",
+    "notes": None,
+}
+
+
+def test_key_is_stable_for_the_same_session_and_form():
+    reordered = dict(reversed(list(FORM.items())))
+    assert idempotency_key("ana", FORM) == idempotency_key("ana", reordered)
+    # Mayúsculas y espacios de más no cambian la cita
+    retyped = dict(FORM, fullName="  ana   GARCÍA ", email="Ana@Example.com")
+    assert idempotency_key("ana", FORM) == idempotency_key("ana", retyped)
+    assert len(idempotency_key("ana", FORM)) == 64
+
+
+def test_key_changes_with_session_or_contents():
+    key = idempotency_key("ana", FORM)
+    assert idempotency_key("luis", FORM) != key
+    assert idempotency_key("ana", dict(FORM, preferredDate="2026-01-06T11:00:00Z")) != key
+    assert idempotency_key("ana", dict(FORM, age=35)) != key
+
+
+def test_cache_returns_recorded_outcome():
+    cache = isolated(IdempotencyCache)
+    assert cache.get("k") is None
+    cache.record("k", PENDING)
+    cache.record("k", DELIVERED, {"id": "cita-1"})
+    assert cache.get("k") == {"status": DELIVERED, "result": {"id": "cita-1"}}
+    assert cache.registry.counter("idempotency_hits_total").value == 1
+    assert cache.registry.counter("idempotency_misses_total").value == 1
+    cache.discard("k")
+    assert cache.get("k") is None
+
+
+def test_cache_expires_and_is_bounded():
+    clock = FakeClock()
+    cache = isolated(IdempotencyCache, ttl=60, max_entries=2, clock=clock)
+    cache.record("a", DELIVERED)
+    clock.advance(61)
+    assert cache.get("a") is None
+    for key in ("b", "c", "d"):
+        cache.record(key, PENDING)
+    assert len(cache) == 2 and cache.get("b") is None
+
+
+def test_replayed_submission_reaches_the_backend_once_with_the_header():
+    cache = isolated(IdempotencyCache)
+    sent = []
+    dispatcher = OutboxDispatcher(
+        OutboxStore(os.path.join(tempfile.mkdtemp(), "outbox.db")),
+        {"appointment": lambda payload, key: sent.append({"Idempotency-Key": key}) or {"id": "cita-1"}},
+        registry=MetricsRegistry(),
+    )
+
+    def confirm():
+        # Lo que hace el turno de confirmación con la clave derivada
+        key = idempotency_key("ana", FORM)
+        if cache.get(key) is not None:
+            return cache.get(key)["status"]
+        cache.record(key, PENDING)
+        dispatcher.submit("appointment", {"user_id": "ana", "data": FORM}, key=key)
+        return "enviada"
+
+    assert confirm() == "enviada"
+    assert confirm() == PENDING
+    # Aunque se pierda la caché (reinicio), el outbox no la guarda dos veces
+    cache.discard(idempotency_key("ana", FORM))
+    assert confirm() == "enviada"
+    for entry, status, result in dispatcher.dispatch_sync():
+        cache.record(entry.key, status, result)
+    assert sent == [{"Idempotency-Key": idempotency_key("ana", FORM)}]
+    assert cache.get(idempotency_key("ana", FORM)) == {"status": DELIVERED, "result": {"id": "cita-1"}}
+    assert dispatcher.dispatch_sync() == []
+
+
+if __name__ == "__main__":
+    for test in (test_key_is_stable_for_the_same_session_and_form, test_key_changes_with_session_or_contents,
+                 test_cache_returns_recorded_outcome, test_cache_expires_and_is_bounded,
+                 test_replayed_submission_reaches_the_backend_once_with_the_header):
+        test()
+        print(f"✅ {test.__name__}")
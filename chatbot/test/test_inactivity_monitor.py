@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Prueba del monitor de inactividad con un reloj inyectable (sin servidor)
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from conversation_history import HistoryStore
+from inactivity import InactivityMonitor, InactivitySessionHandlers
+from metrics import MetricsRegistry
+from session_stream import SessionStreamRegistry
+from fakes import FakeClock
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def send_text(self, text: str):
+        self.sent.append(json.loads(text))
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        self.closed_with = code
+
+
+def build_monitor(clock):
+    last_activity = {}
+    warned_inactive = {}
+    sockets = {}
+    sessions = {}
+
+    async def on_warning(user_id):
+        await sockets[user_id].send_text(json.dumps({"type": "warning"}))
+
+    async def on_timeout(user_id):
+        ws = sockets.pop(user_id)
+        sessions.pop(user_id, None)
+        await ws.send_text(json.dumps({"type": "close"}))
+        await ws.close(code=1000)
+
+    monitor = InactivityMonitor(
+        last_activity, warned_inactive, on_warning, on_timeout,
+        warning_after=50, close_after=60, clock=clock,
+    )
+    return monitor, last_activity, warned_inactive, sockets, sessions
+
+
+def test_warning_then_close():
+    """Advertencia a los 50 s y cierre con close frame a los 60 s"""
+    clock = FakeClock()
+    monitor, last_activity, warned, sockets, sessions = build_monitor(clock)
+    ws = FakeWebSocket()
+    sockets["u1"] = ws
+    sessions["u1"] = object()
+    last_activity["u1"] = clock()
+
+    async def scenario():
+        clock.advance(30)
+        await monitor.check()
+        assert ws.sent == []
+
+        clock.advance(25)
+        await monitor.check()
+        assert [m["type"] for m in ws.sent] == ["warning"]
+
+        # La advertencia solo se envía una vez
+        await monitor.check()
+        assert len(ws.sent) == 1
+
+        clock.advance(10)
+        await monitor.check()
+        assert [m["type"] for m in ws.sent] == ["warning", "close"]
+        assert ws.closed_with == 1000
+        assert "u1" not in last_activity
+        assert "u1" not in warned
+        assert "u1" not in sessions
+
+    asyncio.run(scenario())
+
+
+def test_activity_resets_timer():
+    """Un mensaje nuevo reinicia la cuenta atrás"""
+    clock = FakeClock()
+    monitor, last_activity, warned, sockets, _ = build_monitor(clock)
+    ws = FakeWebSocket()
+    sockets["u2"] = ws
+    last_activity["u2"] = clock()
+
+    async def scenario():
+        clock.advance(55)
+        await monitor.check()
+        assert warned["u2"] is True
+
+        last_activity["u2"] = clock()
+        warned["u2"] = False
+        clock.advance(55)
+        await monitor.check()
+        assert ws.closed_with is None
+        assert [m["type"] for m in ws.sent] == ["warning", "warning"]
+
+    asyncio.run(scenario())
+
+
+def test_failing_socket_still_releases():
+    """Un socket roto no impide liberar la sesión"""
+    clock = FakeClock()
+    last_activity = {"u3": clock()}
+    warned = {}
+
+    async def on_timeout(user_id):
+        raise RuntimeError("socket cerrado")
+
+    async def on_warning(user_id):
+        pass
+
+    monitor = InactivityMonitor(last_activity, warned, on_warning, on_timeout, clock=clock)
+
+    async def scenario():
+        clock.advance(61)
+        await monitor.check()
+        assert last_activity == {}
+
+    asyncio.run(scenario())
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed_with = None
+
+    def close(self, code: int = 1000, reason: str = ""):
+        self.closed_with = (code, reason)
+
+
+def test_server_handlers_warn_then_close():
+    """Los manejadores del servidor: aviso en el flujo e historial, cierre y liberación"""
+    clock = FakeClock()
+    last_activity = {"u4": clock()}
+    warned = {}
+    histories = HistoryStore(capacity=10, max_bytes=10_000)
+    histories.get("u4").append({"text": "hola", "isUser": True})
+    streams = SessionStreamRegistry(registry=MetricsRegistry())
+    received = []
+    streams.open("u4").attach(received.append)
+    websockets = {"u4": FakeConnection()}
+    event_streams = {"u4": FakeConnection()}
+    connection, event_stream = websockets["u4"], event_streams["u4"]
+
+    def deliver(user_id, payload):
+        stream = streams.for_user(user_id)
+        if stream is None:
+            return False
+        stream.publish(payload)
+        return True
+
+    def release_session(user_id):
+        histories.pop(user_id, None)
+        streams.release(user_id)
+        last_activity.pop(user_id, None)
+        warned.pop(user_id, None)
+
+    handlers = InactivitySessionHandlers(
+        histories, deliver, release_session, websockets, event_streams, warning_after=50, close_after=60,
+    )
+    monitor = InactivityMonitor(
+        last_activity, warned, handlers.warn, handlers.close, warning_after=50, close_after=60, clock=clock,
+    )
+
+    async def scenario():
+        clock.advance(55)
+        await monitor.check()
+        assert [frame["type"] for frame in received] == ["warning"]
+        assert "10 segundos" in received[0]["message"]
+        assert [m["text"] for m in histories["u4"]][-1] == received[0]["message"]
+
+        clock.advance(10)
+        await monitor.check()
+        assert [frame["type"] for frame in received] == ["warning", "close"]
+        assert connection.closed_with == (1000, "inactivity")
+        assert event_stream.closed_with is not None
+        assert websockets == {} and event_streams == {}
+        assert "u4" not in histories and streams.for_user("u4") is None
+        assert last_activity == {}
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    for test in (test_warning_then_close, test_activity_resets_timer, test_failing_socket_still_releases,
+                 test_server_handlers_warn_then_close):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Prueba de las utilidades del lanzador multi-proceso (memoria y heartbeats)
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from launcher import Heartbeats, parse_args, read_memory_usage
+
+
+def test_read_memory_usage():
+    usage = read_memory_usage(os.getpid())
+    if usage is None:
+        print("⚠️ /proc/<pid>/smaps_rollup no disponible en este sistema")
+        return
+    assert usage["rss_kb"] > 0
+    assert 0 < usage["pss_kb"] <= usage["rss_kb"]
+    assert usage["uss_kb"] <= usage["pss_kb"]
+
+
+def test_heartbeats_shared_after_fork():
+    heartbeats = Heartbeats(2)
+    heartbeats.reset(1)
+    pid = os.fork()
+    if pid == 0:
+        heartbeats.beat(1, 12345.0)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert heartbeats.last(1) == 12345.0
+    assert heartbeats.last(0) == 0.0
+
+
+def test_parse_args_workers():
+    args = parse_args(["--workers", "3", "--allow-split-sessions", "--port", "9000"])
+    assert args.workers == 3
+    assert args.port == 9000
+    assert parse_args([]).workers == 1
+
+
+def test_parse_args_refuses_split_sessions():
+    """Sin sesiones compartidas, más de un worker rompe las conversaciones de varios turnos"""
+    stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+    try:
+        parse_args(["--workers", "2"])
+        raise AssertionError("debería rechazar varios workers")
+    except SystemExit as e:
+        assert e.code == 2
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+
+if __name__ == "__main__":
+    for test in (test_read_memory_usage, test_heartbeats_shared_after_fork, test_parse_args_workers,
+                 test_parse_args_refuses_split_sessions):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Prueba del control adaptativo de carga (niveles, recuperación y métricas)
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from load_shedding import LoadShedder
+from metrics import MetricsRegistry
+from fakes import FakeClock
+
+
+def make_shedder(clock, registry=None):
+    return LoadShedder(
+        lag_thresholds=(0.5,),
+        latency_thresholds={"backend": (5.0,)},
+        recovery_seconds=10,
+        latency_horizon=60,
+        clock=clock,
+        registry=registry or MetricsRegistry(),
+    )
+
+
+def test_normal_allows_backend():
+    shedder = make_shedder(FakeClock())
+    assert shedder.allows("backend")
+    assert shedder.status()["mode"] == "normal"
+    assert shedder.status()["disabled"] == []
+
+
+def test_slow_backend_disables_backend():
+    shedder = make_shedder(FakeClock())
+    shedder.record_latency("backend", 2.0)
+    assert shedder.allows("backend")
+    for _ in range(10):
+        shedder.record_latency("backend", 8.0)
+    assert not shedder.allows("backend")
+    assert shedder.status()["disabled"] == ["backend"]
+
+
+def test_slow_llm_does_not_disable_backend():
+    """Cada dependencia se compara con sus propios umbrales; los LLM no tienen"""
+    shedder = make_shedder(FakeClock())
+    for _ in range(10):
+        shedder.record_latency("openai", 12.0)
+    assert shedder.allows("backend")
+    assert shedder.status()["downstream_latency_ms"]["openai"] == 12000.0
+
+
+def test_event_loop_lag_drives_level():
+    clock = FakeClock()
+    shedder = make_shedder(clock)
+    for _ in range(5):
+        shedder.record_lag(0.3)
+    assert shedder.level == 0
+    for _ in range(5):
+        shedder.record_lag(0.6)
+    assert shedder.level == 1
+
+
+def test_recovers_after_recovery_seconds():
+    clock = FakeClock()
+    registry = MetricsRegistry()
+    shedder = make_shedder(clock, registry)
+    for _ in range(5):
+        shedder.record_lag(0.6)
+    assert shedder.level == 1
+    for _ in range(5):
+        shedder.record_lag(0.0)
+    assert shedder.level == 1
+    clock.advance(11)
+    shedder.record_lag(0.0)
+    assert shedder.level == 0
+    assert registry.snapshot()["load_shedding_level"] == 0
+
+
+def test_stale_latency_samples_expire():
+    """Una dependencia que ya no se llama vuelve a probarse tras el horizonte"""
+    clock = FakeClock()
+    shedder = make_shedder(clock)
+    for _ in range(5):
+        shedder.record_latency("backend", 6.0)
+    assert shedder.level == 1
+    clock.advance(61)
+    for _ in range(2):
+        clock.advance(11)
+        shedder.record_lag(0.0)
+    assert shedder.level == 0
+
+
+def test_event_loop_monitor_measures_blocking():
+    shedder = LoadShedder(registry=MetricsRegistry())
+
+    async def scenario():
+        shedder.start(interval=0.05)
+        await asyncio.sleep(0.06)
+        time.sleep(0.3)  # bloquea el loop
+        await asyncio.sleep(0.1)
+        await shedder.stop()
+
+    asyncio.run(scenario())
+    assert max(shedder._lags) >= 0.2
+
+
+if __name__ == "__main__":
+    for test in (test_normal_allows_backend, test_slow_backend_disables_backend, test_slow_llm_does_not_disable_backend,
+                 test_event_loop_lag_drives_level, test_recovers_after_recovery_seconds,
+                 test_stale_latency_samples_expire, test_event_loop_monitor_measures_blocking):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Prueba del buzón de avisos diferidos (entrega única, caducidad y límites) y de
+la confirmación asíncrona de una cita a través del outbox.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from notices import NoticeBox
+from outbox import OutboxDispatcher, OutboxStore
+from fakes import FakeClock, isolated
+
+
+def test_notices_are_taken_once_in_order():
+    box = isolated(NoticeBox)
+    box.push("ana", {"response": "uno"})
+    box.push("ana", {"response": "dos"})
+    box.push("luis", {"response": "otro"})
+    assert [n["response"] for n in box.take("ana")] == ["uno", "dos"]
+    assert box.take("ana") == []
+    assert len(box) == 1
+    assert box.registry.counter("notices_delivered_total").value == 2
+
+
+def test_expired_notices_are_not_delivered():
+    clock = FakeClock()
+    box = isolated(NoticeBox, ttl=60, clock=clock)
+    box.push("ana", {"response": "viejo"})
+    clock.advance(61)
+    box.push("ana", {"response": "nuevo"})
+    assert box.take("ana") == [{"response": "nuevo"}]
+    assert box.registry.counter("notices_expired_total").value == 1
+
+
+def test_bounded_per_user_and_in_users():
+    box = isolated(NoticeBox, max_per_user=2, max_users=2)
+    for i in range(3):
+        box.push("ana", {"n": i})
+    assert box.take("ana") == [{"n": 1}, {"n": 2}]
+    for user in ("ana", "luis", "eva"):
+        box.push(user, {"user": user})
+    assert box.take("ana") == []
+    assert len(box) == 2
+    assert box.registry.counter("notices_dropped_total").value == 2
+
+
+def test_pending_count_is_kept_without_rescanning():
+    box = isolated(NoticeBox, max_per_user=2, max_users=3)
+    for i in range(200):
+        box.push(f"u{i % 5}", {"n": i})
+        if i % 7 == 0:
+            box.take(f"u{i % 3}")
+        expected = sum(len(user_box) for user_box in box._boxes.values())
+        assert len(box) == expected == box.pending_gauge.value
+
+
+def test_async_confirmation_is_submitted_and_reported_once():
+    """Un «sí» repetido no duplica la cita y el resultado llega una sola vez"""
+    box = isolated(NoticeBox)
+    store = OutboxStore(os.path.join(tempfile.mkdtemp(), "outbox.db"))
+    sent = []
+    dispatcher = OutboxDispatcher(
+        store,
+        {"appointment": lambda payload, key: sent.append(key) or {"id": "cita-1"}},
+        on_delivered=lambda entry, result: box.push(entry.payload["user_id"], {"response": f"registrada {result['id']}"}),
+        registry=MetricsRegistry(),
+    )
+    conversation = {"stage": "confirmation"}
+
+    def confirm_turn(text):
+        # Lo que hace el turno de confirmación: solo envía desde la etapa de confirmación
+        if conversation["stage"] == "confirmation" and text == "sí":
+            conversation["stage"] = "submitting"
+            conversation["key"] = dispatcher.submit("appointment", {"user_id": "ana", "data": {}})
+            return "procesando tu cita…"
+        return "se sigue procesando"
+
+    assert confirm_turn("sí") == "procesando tu cita…"
+    assert confirm_turn("sí") == "se sigue procesando"
+    assert box.take("ana") == []
+
+    async def deliver():
+        await dispatcher.dispatch()
+        await dispatcher.dispatch()
+
+    asyncio.run(deliver())
+    assert sent == [conversation["key"]]
+    assert box.take("ana") == [{"response": "registrada cita-1"}]
+    assert box.take("ana") == []
+
+
+if __name__ == "__main__":
+    for test in (test_notices_are_taken_once_in_order, test_expired_notices_are_not_delivered,
+                 test_bounded_per_user_and_in_users, test_pending_count_is_kept_without_rescanning,
+                 test_async_confirmation_is_submitted_and_reported_once):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Prueba del outbox en disco (persistencia, reintentos, idempotencia y reinicios)
+"""
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from outbox import DELIVERED, FAILED, PENDING, OutboxDispatcher, OutboxStore, PermanentDeliveryError
+from fakes import FakeClock, isolated
+
+
+def temp_path():
+    return os.path.join(tempfile.mkdtemp(), "outbox.db")
+
+
+def test_store_uses_wal_and_survives_reopen():
+    path = temp_path()
+    store = OutboxStore(path)
+    key, created = store.append("appointment", {"user_id": "u1", "data": {"fullName": "Ana"}})
+    assert created
+    store.close()
+
+    mode = sqlite3.connect(path).execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+    reopened = OutboxStore(path)
+    [entry] = reopened.due()
+    assert entry.key == key and entry.payload["data"]["fullName"] == "Ana"
+
+
+def test_same_key_is_stored_once():
+    store = OutboxStore(temp_path())
+    assert store.append("appointment", {"n": 1}, key="k1") == ("k1", True)
+    assert store.append("appointment", {"n": 2}, key="k1") == ("k1", False)
+    assert [entry.payload for entry in store.due()] == [{"n": 1}]
+
+
+def test_delivery_sends_key_and_marks_delivered():
+    store = OutboxStore(temp_path())
+    sent = []
+    dispatcher = isolated(OutboxDispatcher, store, {"appointment": lambda payload, key: sent.append(key) or {"id": "cita-1"}})
+    key = dispatcher.submit("appointment", {"user_id": "u1"})
+    [(entry, status, result)] = dispatcher.dispatch_sync()
+    assert sent == [key]
+    assert status == DELIVERED and result == {"id": "cita-1"}
+    assert store.get(key)["status"] == DELIVERED
+    assert dispatcher.dispatch_sync() == []
+
+
+def test_transient_errors_back_off_then_give_up():
+    clock = FakeClock(1000.0)
+    store = OutboxStore(temp_path(), clock=clock)
+    calls = []
+
+    def flaky(payload, key):
+        calls.append(clock.now)
+        raise ConnectionError("backend caído")
+
+    dispatcher = isolated(OutboxDispatcher, store, {"appointment": flaky}, max_attempts=3, base_delay=10, max_delay=10)
+    key = dispatcher.submit("appointment", {})
+    dispatcher.dispatch_sync()
+    assert store.get(key)["status"] == PENDING and store.get(key)["attempts"] == 1
+    for _ in range(2):
+        clock.advance(10)
+        dispatcher.dispatch_sync()
+    record = store.get(key)
+    assert record["status"] == FAILED and record["attempts"] == 3
+    assert "backend caído" in record["last_error"]
+    assert len(calls) == 3
+
+
+def test_permanent_errors_fail_immediately():
+    store = OutboxStore(temp_path())
+
+    def rejected(payload, key):
+        raise PermanentDeliveryError("409 - horario ocupado")
+
+    dispatcher = isolated(OutboxDispatcher, store, {"appointment": rejected})
+    key = dispatcher.submit("appointment", {})
+    dispatcher.dispatch_sync()
+    assert store.get(key)["status"] == FAILED and store.get(key)["attempts"] == 1
+
+
+def test_purge_keeps_failed_entries_unless_discardable():
+    clock = FakeClock(1000.0)
+    store = OutboxStore(temp_path(), clock=clock)
+
+    def rejected(payload, key):
+        raise PermanentDeliveryError("401 - sin token")
+
+    dispatcher = isolated(OutboxDispatcher, store, {"appointment": rejected, "conversation_log": rejected})
+    appointment = dispatcher.submit("appointment", {})
+    log = dispatcher.submit("conversation_log", {})
+    dispatcher.dispatch_sync()
+    clock.advance(100)
+    assert store.purge(50) == 0
+    assert store.purge(50, failed_kinds=("conversation_log",)) == 1
+    assert store.get(log) is None and store.get(appointment)["status"] == FAILED
+
+
+def test_handler_progress_is_persisted_between_attempts():
+    clock = FakeClock(1000.0)
+    store = OutboxStore(temp_path(), clock=clock)
+    sent = []
+
+    def partial(payload, key):
+        while payload["messages"]:
+            if len(sent) == 1 and payload["messages"][0] == "b" and not payload.get("retried"):
+                payload["retried"] = True
+                raise ConnectionError("timeout")
+            sent.append(payload["messages"].pop(0))
+
+    dispatcher = isolated(OutboxDispatcher, store, {"conversation_log": partial}, base_delay=0)
+    dispatcher.submit("conversation_log", {"messages": ["a", "b", "c"]})
+    dispatcher.dispatch_sync()
+    dispatcher.dispatch_sync()
+    assert sent == ["a", "b", "c"]
+
+
+def test_pending_entries_are_delivered_after_restart():
+    path = temp_path()
+    OutboxStore(path).append("appointment", {"user_id": "u1"}, key="antes-de-reiniciar")
+    delivered = []
+
+    async def scenario():
+        dispatcher = isolated(OutboxDispatcher, OutboxStore(path), {"appointment": lambda payload, key: {"id": "c1"}},
+                                     on_delivered=lambda entry, result: delivered.append(entry.key))
+        dispatcher.start()
+        for _ in range(100):
+            if delivered:
+                break
+            await asyncio.sleep(0.01)
+        await dispatcher.stop()
+
+    asyncio.run(scenario())
+    assert delivered == ["antes-de-reiniciar"]
+
+
+def test_submit_wakes_dispatcher_and_failures_are_reported_on_loop():
+    failures = []
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+
+        def on_failed(entry, error):
+            assert asyncio.get_running_loop() is loop
+            failures.append((entry.payload["user_id"], error))
+
+        def rejected(payload, key):
+            raise PermanentDeliveryError("400 - email inválido")
+
+        dispatcher = isolated(OutboxDispatcher, OutboxStore(temp_path()), {"appointment": rejected},
+                                     on_failed=on_failed, interval=60)
+        dispatcher.start()
+        await asyncio.sleep(0.01)
+        await loop.run_in_executor(None, dispatcher.submit, "appointment", {"user_id": "u1"})
+        for _ in range(100):
+            if failures:
+                break
+            await asyncio.sleep(0.01)
+        await dispatcher.stop()
+
+    asyncio.run(scenario())
+    assert failures == [("u1", "400 - email inválido")]
+
+
+def test_store_opens_a_connection_per_process():
+    """Tras un fork el hijo no reutiliza la conexión del padre; la ruta puede cambiar antes del primer uso"""
+    store = OutboxStore(temp_path())
+    store.path = temp_path()
+    store.append("appointment", {"user_id": "padre"}, key="padre")
+    parent_db = store._conn()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        own = store._conn() is not parent_db
+        _, created = store.append("appointment", {"user_id": "hijo"}, key="hijo")
+        os.write(write_fd, b"1" if own and created else b"0")
+        os._exit(0)
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 1) == b"1"
+    os.close(read_fd)
+    assert store._conn() is parent_db
+    assert store.counts()[PENDING] == 2
+    store.close()
+
+
+if __name__ == "__main__":
+    for test in (test_store_uses_wal_and_survives_reopen, test_same_key_is_stored_once,
+                 test_delivery_sends_key_and_marks_delivered, test_transient_errors_back_off_then_give_up,
+                 test_permanent_errors_fail_immediately,
+                 test_purge_keeps_failed_entries_unless_discardable, test_handler_progress_is_persisted_between_attempts,
+                 test_pending_entries_are_delivered_after_restart,
+                 test_submit_wakes_dispatcher_and_failures_are_reported_on_loop, test_store_opens_a_connection_per_process):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Prueba de la precarga especulativa por sesión (aciertos, esperas, caducidad y fallos)
+"""
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from prefetch import SessionPrefetcher
+from fakes import FakeClock, isolated
+
+
+def counts(prefetcher):
+    return {name: prefetcher.registry.counter(f"prefetch_{name}_total").value
+            for name in ("hits", "misses", "late", "errors", "skipped")}
+
+
+def test_turn_is_served_from_the_prefetch():
+    prefetcher = isolated(SessionPrefetcher)
+    calls = []
+    prefetcher.start("ana", {"dates": lambda: calls.append("bg") or ["lunes 9:00"]})
+    assert prefetcher.get("ana", "dates", lambda: calls.append("inline") or []) == ["lunes 9:00"]
+    assert calls == ["bg"]
+    assert counts(prefetcher)["hits"] == 1
+
+
+def test_missing_prefetch_loads_inline():
+    prefetcher = isolated(SessionPrefetcher)
+    assert prefetcher.get("ana", "dates", lambda: ["inline"]) == ["inline"]
+    prefetcher.start("ana", {"contact": lambda: {}})
+    assert prefetcher.get("ana", "dates", lambda: ["inline"]) == ["inline"]
+    assert counts(prefetcher)["misses"] == 2
+
+
+def test_slow_prefetch_waits_briefly_then_falls_back():
+    prefetcher = isolated(SessionPrefetcher, wait=0.05)
+    release = threading.Event()
+    prefetcher.start("ana", {"dates": lambda: release.wait(5) and ["tarde"]})
+    assert prefetcher.get("ana", "dates", lambda: ["inline"]) == ["inline"]
+    assert counts(prefetcher)["late"] == 1
+    release.set()
+    prefetcher.shutdown()
+
+
+def test_failed_prefetch_falls_back_and_is_counted():
+    prefetcher = isolated(SessionPrefetcher)
+
+    def broken():
+        raise ConnectionError("backend caído")
+
+    prefetcher.start("ana", {"contact": broken})
+    assert prefetcher.get("ana", "contact", lambda: {"CONTACT_PHONE": "1"}) == {"CONTACT_PHONE": "1"}
+    assert counts(prefetcher)["errors"] == 1
+    assert counts(prefetcher)["misses"] == 1
+
+
+def test_stale_prefetch_is_not_used():
+    clock = FakeClock()
+    prefetcher = isolated(SessionPrefetcher, max_age=60, clock=clock)
+    prefetcher.start("ana", {"dates": lambda: ["viejo"]})
+    clock.advance(61)
+    assert prefetcher.get("ana", "dates", lambda: ["nuevo"]) == ["nuevo"]
+    # Relanzarla la renueva
+    prefetcher.start("ana", {"dates": lambda: ["fresco"]})
+    assert prefetcher.get("ana", "dates", lambda: ["nuevo"]) == ["fresco"]
+
+
+def test_discard_and_session_bound():
+    prefetcher = isolated(SessionPrefetcher, max_sessions=2)
+    for user in ("ana", "luis", "eva"):
+        prefetcher.start(user, {"dates": lambda: [user], "contact": lambda: {}})
+    assert len(prefetcher) == 2
+    assert prefetcher.get("ana", "dates", lambda: ["inline"]) == ["inline"]
+    prefetcher.discard("luis", "dates")
+    assert prefetcher.get("luis", "dates", lambda: ["inline"]) == ["inline"]
+    assert prefetcher.get("luis", "contact", lambda: None) == {}
+    prefetcher.discard("luis")
+    assert len(prefetcher) == 1
+
+
+def test_inflight_cap_skips_instead_of_queueing():
+    prefetcher = isolated(SessionPrefetcher, workers=1, max_inflight=1, wait=0.01)
+    release = threading.Event()
+    prefetcher.start("ana", {"dates": lambda: release.wait(5)})
+    prefetcher.start("luis", {"dates": lambda: ["luis"]})
+    assert counts(prefetcher)["skipped"] == 1
+    assert prefetcher.get("luis", "dates", lambda: ["inline"]) == ["inline"]
+    release.set()
+    prefetcher.shutdown()
+
+
+if __name__ == "__main__":
+    for test in (test_turn_is_served_from_the_prefetch, test_missing_prefetch_loads_inline,
+                 test_slow_prefetch_waits_briefly_then_falls_back, test_failed_prefetch_falls_back_and_is_counted,
+                 test_stale_prefetch_is_not_used, test_discard_and_session_bound,
+                 test_inflight_cap_skips_instead_of_queueing):
+        test()
+        print(f"✅ {test.__name__}")
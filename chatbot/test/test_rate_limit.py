@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Prueba de la limitación de frecuencia con token buckets (reloj inyectable)
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from rate_limit import ChatRateLimits, RateLimiter, forwarded_client_ip
+from fakes import FakeClock
+
+
+def test_burst_then_refill():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1, burst=3, clock=clock)
+    assert [limiter.consume("u1") for _ in range(4)] == [True, True, True, False]
+    assert abs(limiter.retry_after("u1") - 1.0) < 1e-9
+    clock.advance(1.0)
+    assert limiter.consume("u1")
+    assert not limiter.consume("u1")
+
+
+def test_keys_are_independent():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1, burst=1, clock=clock)
+    assert limiter.consume("a")
+    assert not limiter.consume("a")
+    assert limiter.consume("b")
+
+
+def test_memory_bounded_by_max_keys():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1, burst=5, max_keys=100, idle_ttl=10_000, clock=clock)
+    for i in range(10_000):
+        limiter.consume(f"scraper-{i}")
+    assert len(limiter) == 100
+
+
+def test_idle_buckets_evicted():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1, burst=5, clock=clock)
+    for i in range(50):
+        limiter.consume(f"user-{i}")
+    # Pasado el tiempo de recarga completo, las claves antiguas sobran
+    clock.advance(10)
+    limiter.consume("new-user")
+    assert len(limiter) == 1
+
+
+def test_combined_scopes():
+    clock = FakeClock()
+    registry = MetricsRegistry()
+    limits = ChatRateLimits(
+        user=RateLimiter(rate=1, burst=2, clock=clock),
+        ip=RateLimiter(rate=1, burst=3, clock=clock),
+        global_limiter=RateLimiter(rate=10, burst=100, clock=clock),
+        registry=registry,
+    )
+    assert limits.check("u1", "1.1.1.1")[0]
+    assert limits.check("u1", "1.1.1.1")[0]
+    allowed, scope, retry_after = limits.check("u1", "1.1.1.1")
+    assert not allowed and scope == "user" and retry_after > 0
+    # Otro usuario desde la misma IP agota el límite por IP
+    assert limits.check("u2", "1.1.1.1")[0]
+    allowed, scope, _ = limits.check("u3", "1.1.1.1")
+    assert not allowed and scope == "ip"
+    # Un rechazo no consume tokens de los demás ámbitos
+    assert limits.limiters["global"].available(ChatRateLimits.GLOBAL_KEY) == 97
+    assert registry.snapshot()["rate_limited_user_total"] == 1
+    assert registry.snapshot()["rate_limited_ip_total"] == 1
+
+
+def test_forwarded_ip_ignores_client_written_hops():
+    # El cliente escribe lo que quiera al principio; el proxy añade la IP real al final
+    assert forwarded_client_ip("1.2.3.4, 203.0.113.7", "10.0.0.2") == "203.0.113.7"
+    assert forwarded_client_ip("1.2.3.4, 203.0.113.7, 10.0.0.5", "10.0.0.2", trusted_proxies=2) == "203.0.113.7"
+    assert forwarded_client_ip(None, "10.0.0.2") == "10.0.0.2"
+    assert forwarded_client_ip("1.2.3.4", "198.51.100.1", trusted_proxies=0) == "198.51.100.1"
+    assert forwarded_client_ip("203.0.113.7", "10.0.0.2", trusted_proxies=2) == "10.0.0.2"
+
+
+def test_spoofed_forwarded_for_does_not_escape_ip_limit():
+    clock = FakeClock()
+    limits = ChatRateLimits(
+        user=RateLimiter(rate=1, burst=5, clock=clock),
+        ip=RateLimiter(rate=1, burst=3, clock=clock),
+        global_limiter=RateLimiter(rate=1, burst=100, clock=clock),
+        registry=MetricsRegistry(),
+    )
+    results = []
+    for n in range(10):
+        # Cada petición cambia el user_id y la primera entrada de X-Forwarded-For
+        ip = forwarded_client_ip(f"10.9.9.{n}, 203.0.113.7", "10.0.0.2")
+        results.append(limits.check(f"u{n}", ip)[0])
+    assert results.count(True) == 3
+    assert limits.limiters["global"].available(ChatRateLimits.GLOBAL_KEY) == 97
+
+
+if __name__ == "__main__":
+    for test in (test_burst_then_refill, test_keys_are_independent, test_memory_bounded_by_max_keys,
+                 test_idle_buckets_evicted, test_combined_scopes, test_forwarded_ip_ignores_client_written_hops,
+                 test_spoofed_forwarded_for_does_not_escape_ip_limit):
+        test()
+        print(f"✅ {test.__name__}")
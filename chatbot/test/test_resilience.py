@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Prueba de la capa de resiliencia (plazos, reintentos con jitter y circuit breaker)
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitOpenError, Dependencies, Dependency
+
+
+class FakeTime:
+    """Reloj y sleep simulados: las esperas avanzan el reloj"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def make_dependency(fake, **kwargs):
+    return Dependency("backend", clock=fake.clock, sleep=fake.sleep, registry=MetricsRegistry(), **kwargs)
+
+
+def failing(exc=ConnectionError("caído")):
+    def call(timeout):
+        raise exc
+    return call
+
+
+def test_success_passes_remaining_deadline():
+    fake = FakeTime()
+    dependency = make_dependency(fake, timeout=5)
+    seen = []
+    assert dependency.call(lambda timeout: seen.append(timeout) or "ok") == "ok"
+    assert seen == [5]
+    assert dependency.status()["calls"] == 1
+
+
+def test_retries_are_bounded_jittered_and_within_deadline():
+    fake = FakeTime()
+    dependency = make_dependency(fake, timeout=5, retries=3, base_delay=0.5, max_delay=1.0, failure_threshold=10)
+    try:
+        dependency.call(failing())
+        raise AssertionError("debería relanzar el error")
+    except ConnectionError:
+        pass
+    assert dependency.status()["calls"] == 4 and dependency.status()["retries"] == 3
+    assert all(0 <= delay <= 1.0 for delay in fake.sleeps)
+    assert fake.now < 5
+
+
+def test_no_retry_past_deadline():
+    fake = FakeTime()
+    dependency = make_dependency(fake, timeout=1, retries=5, base_delay=10, max_delay=10, failure_threshold=10)
+    attempts = []
+
+    def slow(timeout):
+        attempts.append(timeout)
+        fake.now += 0.9
+        raise TimeoutError("read timed out")
+
+    try:
+        dependency.call(slow)
+    except TimeoutError:
+        pass
+    # Tras el primer intento solo queda 0.1 s: una espera de jitter no cabe salvo que sea mínima
+    assert len(attempts) <= 2
+    assert all(timeout > 0 for timeout in attempts)
+    assert dependency.status()["timeouts"] == len(attempts)
+
+
+def test_5xx_is_retried_and_returned_4xx_is_not():
+    fake = FakeTime()
+    dependency = make_dependency(fake, retries=2, failure_threshold=10)
+    responses = iter([Response(503), Response(502), Response(200)])
+    assert dependency.call(lambda timeout: next(responses)).status_code == 200
+    assert dependency.status()["failures"] == 2
+
+    calls = []
+    result = dependency.call(lambda timeout: calls.append(1) or Response(404))
+    assert result.status_code == 404 and calls == [1]
+    assert dependency.breaker.consecutive_failures == 0
+
+    exhausted = dependency.call(lambda timeout: Response(500), retries=0)
+    assert exhausted.status_code == 500
+
+
+def test_breaker_opens_fails_fast_and_recovers_through_half_open():
+    fake = FakeTime()
+    dependency = make_dependency(fake, retries=0, failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        try:
+            dependency.call(failing())
+        except ConnectionError:
+            pass
+    assert dependency.breaker.state == OPEN
+
+    called = []
+    try:
+        dependency.call(lambda timeout: called.append(1))
+        raise AssertionError("debería fallar al instante")
+    except CircuitOpenError as e:
+        assert e.retry_in == 30
+    assert called == [] and dependency.status()["rejected"] == 1
+
+    fake.now += 30
+    # Semiabierto: la prueba falla y vuelve a abrirse
+    try:
+        dependency.call(failing())
+    except ConnectionError:
+        pass
+    assert dependency.breaker.state == OPEN
+
+    fake.now += 30
+    assert dependency.call(lambda timeout: "ok") == "ok"
+    assert dependency.breaker.state == CLOSED
+
+
+def test_half_open_lets_a_single_probe_through():
+    fake = FakeTime()
+    dependency = make_dependency(fake, retries=0, failure_threshold=1, reset_timeout=10)
+    try:
+        dependency.call(failing())
+    except ConnectionError:
+        pass
+    fake.now += 10
+    assert dependency.breaker.allow()
+    assert dependency.breaker.state == HALF_OPEN
+    # Otro hilo mientras la prueba está en curso
+    assert not dependency.breaker.allow()
+
+
+def test_latency_is_reported_and_status_exposed():
+    recorded = []
+    dependencies = Dependencies(on_latency=lambda name, seconds: recorded.append(name), registry=MetricsRegistry())
+    dependencies.add("backend", retries=0)
+    dependencies.add("openai", retries=0)
+    dependencies["backend"].call(lambda timeout: "ok")
+    status = dependencies.status()
+    assert recorded == ["backend"]
+    assert set(status) == {"backend", "openai"}
+    assert status["backend"]["state"] == CLOSED and status["backend"]["calls"] == 1
+
+
+if __name__ == "__main__":
+    for test in (test_success_passes_remaining_deadline, test_retries_are_bounded_jittered_and_within_deadline,
+                 test_no_retry_past_deadline, test_5xx_is_retried_and_returned_4xx_is_not,
+                 test_breaker_opens_fails_fast_and_recovers_through_half_open,
+                 test_half_open_lets_a_single_probe_through, test_latency_is_reported_and_status_exposed):
+        test()
+        print(f"✅ {test.__name__}")
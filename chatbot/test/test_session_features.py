@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Prueba de los rasgos de conversación mantenidos al añadir mensajes.
+
+Compara los rasgos incrementales con el recorrido del historial que hacía
+cada turno (últimos 3 mensajes y último mensaje del asistente) en secuencias
+aleatorias, incluyendo los descartes por capacidad y por bytes.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from conversation_history import ConversationHistory
+from session_features import APPOINTMENT_OFFER, OTHER_PROMPT, TOPIC_WORDS, TOPICS, prompt_type
+
+USER_TEXTS = [
+    "hola", "quiero una cita", "¿cuál es el precio?", "¿qué servicios tienen?", "dame su teléfono",
+    "cita y honorarios", "gracias", "email y área laboral", "vale",
+]
+ASSISTANT_TEXTS = [
+    "¿Te gustaría agendar una cita?", "Nuestros honorarios empiezan en 50 €.",
+    "Para brindarte la mejor asesoría, cuéntame más.", "¡Hasta luego!",
+]
+
+
+def rescan(history):
+    """Lo que calculaba cada turno recorriendo el historial"""
+    counts = dict.fromkeys(TOPICS, 0)
+    for msg in history.recent(3):
+        if msg.get("isUser"):
+            text = msg.get("text", "").lower()
+            for topic, words in TOPIC_WORDS.items():
+                if any(word in text for word in words):
+                    counts[topic] += 1
+    last_prompt = None
+    for msg in reversed(history):
+        if not msg.get("isUser"):
+            last_prompt = prompt_type(msg)
+            break
+    return counts, last_prompt
+
+
+def features_of(history):
+    features = history.features
+    return {topic: features.count(topic) for topic in TOPICS}, features.last_prompt
+
+
+def test_topics_roll_out_of_the_window():
+    history = ConversationHistory(capacity=10, max_bytes=10_000)
+    history.append({"text": "¿Cuánto cuesta? Quiero saber el precio", "isUser": True})
+    assert history.features.mentioned("pricing") and history.features.count("pricing") == 1
+    for text in ("hola", "vale", "bien"):
+        history.append({"text": text, "isUser": True})
+    # El mensaje de precios ya no está entre los 3 últimos
+    assert not history.features.mentioned("pricing")
+
+
+def test_last_prompt_type():
+    history = ConversationHistory(capacity=10, max_bytes=10_000)
+    assert history.features.last_prompt is None
+    history.append({"text": "¿Te gustaría agendar una cita?", "isUser": False})
+    history.append({"text": "sí", "isUser": True})
+    assert history.features.last_prompt == APPOINTMENT_OFFER
+    history.append({"text": "Hasta luego", "isUser": False})
+    assert history.features.last_prompt == OTHER_PROMPT
+    history.clear()
+    assert history.features.last_prompt is None and not history.features.mentioned("appointment")
+
+
+def test_byte_cap_eviction_updates_features():
+    history = ConversationHistory(capacity=10, max_bytes=40)
+    history.append({"text": "¿Te gustaría agendar una cita?", "isUser": False})
+    history.append({"text": "quiero cita y precio", "isUser": True})
+    # Este mensaje expulsa a los dos anteriores
+    history.append({"text": "x" * 39, "isUser": True})
+    assert len(history) == 1
+    assert features_of(history) == rescan(history) == (dict.fromkeys(TOPICS, 0), None)
+
+
+def test_matches_rescanning_random_conversations():
+    rng = random.Random(7)
+    for capacity, max_bytes in ((2, 10_000), (3, 10_000), (4, 10_000), (10, 10_000), (10, 60), (6, 45)):
+        history = ConversationHistory(capacity=capacity, max_bytes=max_bytes)
+        for _ in range(500):
+            if rng.random() < 0.6:
+                message = {"text": rng.choice(USER_TEXTS), "isUser": True}
+            else:
+                message = {"text": rng.choice(ASSISTANT_TEXTS), "isUser": False}
+            history.append(message)
+            assert features_of(history) == rescan(history), (capacity, max_bytes, list(history))
+
+
+def benchmark_turn_cost():
+    for capacity in (10, 100, 1000):
+        history = ConversationHistory(capacity=capacity, max_bytes=10**9)
+        for n in range(capacity):
+            history.append({"text": ASSISTANT_TEXTS[0] if n == 0 else USER_TEXTS[n % len(USER_TEXTS)], "isUser": n > 0})
+        rounds = 20000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            features_of(history)
+        incremental = (time.perf_counter() - start) / rounds * 1e6
+        start = time.perf_counter()
+        for _ in range(rounds // 10):
+            rescan(history)
+        rescanned = (time.perf_counter() - start) / (rounds // 10) * 1e6
+        print(f"   historial de {capacity}: rasgos {incremental:.2f} µs/turno, recorrido {rescanned:.2f} µs/turno")
+
+
+if __name__ == "__main__":
+    for test in (test_topics_roll_out_of_the_window, test_last_prompt_type,
+                 test_byte_cap_eviction_updates_features, test_matches_rescanning_random_conversations):
+        test()
+        print(f"✅ {test.__name__}")
+    benchmark_turn_cost()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Prueba de la ejecución serializada por usuario (locks por sesión)
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from session_locks import SessionLocks
+
+
+def test_same_user_in_order():
+    """Dos mensajes rápidos del mismo usuario no se solapan y mantienen el orden"""
+    locks = SessionLocks(MetricsRegistry())
+    events = []
+
+    async def turn(name: str, delay: float):
+        async with locks.hold("u1"):
+            events.append(f"start-{name}")
+            await asyncio.sleep(delay)
+            events.append(f"end-{name}")
+
+    async def scenario():
+        first = asyncio.create_task(turn("a", 0.05))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(turn("b", 0.0))
+        await asyncio.gather(first, second)
+
+    asyncio.run(scenario())
+    assert events == ["start-a", "end-a", "start-b", "end-b"]
+    assert len(locks) == 0
+
+
+def test_different_users_in_parallel():
+    """Usuarios distintos no se bloquean entre sí"""
+    locks = SessionLocks(MetricsRegistry())
+
+    async def turn(user_id: str):
+        async with locks.hold(user_id):
+            await asyncio.sleep(0.1)
+
+    async def scenario():
+        start = time.perf_counter()
+        await asyncio.gather(*(turn(f"user-{i}") for i in range(20)))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(scenario())
+    assert elapsed < 0.5, f"los usuarios se serializaron ({elapsed:.2f}s)"
+
+
+def test_wait_time_metrics():
+    """El tiempo de espera del lock queda registrado en métricas"""
+    registry = MetricsRegistry()
+    locks = SessionLocks(registry)
+
+    async def turn():
+        async with locks.hold("u1"):
+            await asyncio.sleep(0.02)
+
+    async def scenario():
+        await asyncio.gather(turn(), turn(), turn())
+
+    asyncio.run(scenario())
+    snapshot = registry.snapshot()
+    assert snapshot["session_lock_wait_seconds"]["count"] == 3
+    assert snapshot["session_lock_wait_seconds"]["sum"] >= 0.03
+    assert snapshot["session_lock_contended_total"] == 2
+    assert snapshot["session_locks_active"] == 0
+
+
+def test_cancelled_waiter_releases_entry():
+    """Cancelar un turno en espera no deja locks huérfanos"""
+    locks = SessionLocks(MetricsRegistry())
+
+    async def scenario():
+        async def holder():
+            async with locks.hold("u1"):
+                await asyncio.sleep(0.05)
+
+        async def waiter():
+            async with locks.hold("u1"):
+                pass
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(waiter())
+        await asyncio.sleep(0.01)
+        second.cancel()
+        await first
+        try:
+            await second
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(scenario())
+    assert len(locks) == 0
+
+
+if __name__ == "__main__":
+    for test in (test_same_user_in_order, test_different_users_in_parallel,
+                 test_wait_time_metrics, test_cancelled_waiter_releases_entry):
+        test()
+        print(f"✅ {test.__name__}")
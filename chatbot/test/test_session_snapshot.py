@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Prueba de las instantáneas de sesiones (formato, incrementalidad, compactación y TTL)
+"""
+
+import asyncio
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import zlib
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from session_snapshot import HEADER, MAGIC, SessionSnapshotter, SnapshotStore
+
+
+def state(n=0, last_activity=1000.0):
+    return {
+        "last_activity": last_activity,
+        "appointment": {"stage": "collecting_info", "data": {"fullName": f"Ana {n}", "age": 30},
+                        "context": {"available_dates": [datetime(2026, 1, 5, 9)]}},
+        "history": [{"text": "hola", "isUser": True, "timestamp": "2026-01-01T00:00:00"}],
+    }
+
+
+def temp_store(**kwargs):
+    directory = tempfile.mkdtemp()
+    return SnapshotStore(os.path.join(directory, "sessions.bin"), **kwargs)
+
+
+def test_last_batch_wins_and_tombstones_remove():
+    store = temp_store()
+    store.append({"a": state(1), "b": state(2)}, saved_at=10)
+    store.append({"a": state(3)}, saved_at=20)
+    store.append({"b": None}, saved_at=30)
+    loaded = store.load()
+    assert set(loaded) == {"a"}
+    saved_state, saved_at = loaded["a"]
+    assert saved_state["appointment"]["data"]["fullName"] == "Ana 3"
+    assert saved_state["appointment"]["context"]["available_dates"][0] == datetime(2026, 1, 5, 9)
+    assert saved_at == 20
+
+
+def test_torn_tail_is_ignored():
+    store = temp_store()
+    store.append({"a": state(1)}, saved_at=10)
+    store.append({"a": state(2)}, saved_at=20)
+    with open(store.path, "r+b") as f:
+        f.truncate(os.path.getsize(store.path) - 5)
+    loaded = store.load()
+    assert loaded["a"][0]["appointment"]["data"]["fullName"] == "Ana 1"
+
+
+def test_missing_file_loads_nothing():
+    assert temp_store().load() == {}
+
+
+def test_arbitrary_classes_are_rejected():
+    store = temp_store()
+    payload = zlib.compress(pickle.dumps({"saved_at": 1, "sessions": {"a": {"x": threading.Lock}}}))
+    with open(store.path, "wb") as f:
+        f.write(MAGIC + HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+    assert store.load() == {}
+
+
+def test_compaction_keeps_only_live_sessions():
+    store = temp_store(compact_min_bytes=0)
+    for i in range(50):
+        store.append({"a": state(i), f"tmp{i}": state(i)}, saved_at=i)
+        store.append({f"tmp{i}": None}, saved_at=i)
+    store.append({"old": state(0, last_activity=0)}, saved_at=100)
+    before = os.path.getsize(store.path)
+    kept = store.compact(lambda s, saved_at: s["last_activity"] > 0)
+    assert kept == 1
+    assert os.path.getsize(store.path) < before / 10
+    loaded = store.load()
+    assert set(loaded) == {"a"} and loaded["a"][1] == 49
+
+
+def make_snapshotter(store, sessions, busy=()):
+    return SessionSnapshotter(
+        store,
+        capture=lambda user_id: sessions.get(user_id),
+        is_busy=lambda user_id: user_id in busy,
+        registry=MetricsRegistry(),
+    )
+
+
+def test_flush_writes_only_dirty_sessions_off_loop():
+    store = temp_store()
+    sessions = {f"u{i}": state(i) for i in range(100)}
+    snapshotter = make_snapshotter(store, sessions)
+    writer_threads = []
+    original_append = store.append
+
+    def recording_append(batch, saved_at=None):
+        writer_threads.append((threading.current_thread().name, set(batch)))
+        return original_append(batch, saved_at)
+
+    store.append = recording_append
+
+    async def scenario():
+        snapshotter.mark_dirty("u1")
+        snapshotter.mark_dirty("u2")
+        first = await snapshotter.flush()
+        second = await snapshotter.flush()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == {"sessions_snapshotted": 2}
+    assert second == {"sessions_snapshotted": 0}
+    assert writer_threads == [(writer_threads[0][0], {"u1", "u2"})]
+    assert writer_threads[0][0].startswith("snapshot")
+
+
+def test_busy_sessions_wait_for_next_round():
+    store = temp_store()
+    busy = {"u1"}
+    snapshotter = make_snapshotter(store, {"u1": state(1), "u2": state(2)}, busy)
+
+    async def scenario():
+        snapshotter.mark_dirty("u1")
+        snapshotter.mark_dirty("u2")
+        await snapshotter.flush()
+        busy.clear()
+        await snapshotter.flush()
+
+    asyncio.run(scenario())
+    assert set(store.load()) == {"u1", "u2"}
+
+
+def test_released_sessions_are_deleted():
+    store = temp_store()
+    sessions = {"u1": state(1)}
+    snapshotter = make_snapshotter(store, sessions)
+
+    async def scenario():
+        snapshotter.mark_dirty("u1")
+        await snapshotter.flush()
+        del sessions["u1"]
+        snapshotter.mark_dirty("u1")
+        await snapshotter.flush()
+
+    asyncio.run(scenario())
+    assert store.load() == {}
+
+
+def test_load_honors_ttl():
+    store = temp_store()
+    store.append({"fresh": state(1, last_activity=95), "stale": state(2, last_activity=10)}, saved_at=100)
+    snapshotter = SessionSnapshotter(store, capture=lambda user_id: None, registry=MetricsRegistry(),
+                                     keep=lambda s, saved_at: saved_at - s["last_activity"] < 60)
+    assert set(snapshotter.load()) == {"fresh"}
+
+
+if __name__ == "__main__":
+    for test in (test_last_batch_wins_and_tombstones_remove, test_torn_tail_is_ignored, test_missing_file_loads_nothing,
+                 test_arbitrary_classes_are_rejected, test_compaction_keeps_only_live_sessions,
+                 test_flush_writes_only_dirty_sessions_off_loop, test_busy_sessions_wait_for_next_round,
+                 test_released_sessions_are_deleted, test_load_honors_ttl):
+        test()
+        print(f"✅ {test.__name__}")
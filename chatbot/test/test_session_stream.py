@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Prueba de la numeración de mensajes y la reanudación de sesiones
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from rate_limit import RateLimiter
+from session_stream import SessionStreamRegistry
+from fakes import FakeClock
+
+
+def make_registry(**kwargs):
+    return SessionStreamRegistry(registry=MetricsRegistry(), **kwargs)
+
+
+def test_messages_are_numbered_and_delivered():
+    streams = make_registry()
+    stream = streams.open("u1")
+    received = []
+    stream.attach(received.append)
+    stream.publish({"response": "hola"})
+    stream.publish({"response": "adiós"})
+    assert [m["seq"] for m in received] == [1, 2]
+    assert stream.last_seq == 2
+
+
+def test_resume_replays_only_missed_messages():
+    streams = make_registry()
+    stream = streams.open("u1")
+    first = []
+    stream.attach(first.append)
+    for i in range(5):
+        stream.publish({"n": i})
+    stream.detach(first.append)
+    # Publicado mientras el cliente estaba desconectado
+    stream.publish({"n": 5})
+
+    resumed, missed, complete = streams.resume(stream.token, last_seq=3)
+    assert resumed is stream
+    assert complete
+    assert [m["seq"] for m in missed] == [4, 5, 6]
+    assert [m["n"] for m in missed] == [3, 4, 5]
+
+
+def test_resume_reports_gap_when_buffer_overflowed():
+    streams = make_registry(capacity=3)
+    stream = streams.open("u1")
+    for i in range(10):
+        stream.publish({"n": i})
+    _, missed, complete = streams.resume(stream.token, last_seq=2)
+    assert not complete
+    assert [m["seq"] for m in missed] == [8, 9, 10]
+
+
+def test_nothing_missed():
+    streams = make_registry()
+    stream = streams.open("u1")
+    stream.publish({"n": 1})
+    _, missed, complete = streams.resume(stream.token, last_seq=1)
+    assert missed == [] and complete
+
+
+def test_unknown_or_released_token_fails():
+    streams = make_registry()
+    stream = streams.open("u1")
+    streams.release("u1")
+    assert streams.resume(stream.token)[0] is None
+    assert streams.resume("no-existe")[0] is None
+    assert streams.resume(None)[0] is None
+
+
+def test_reopen_invalidates_previous_token():
+    streams = make_registry()
+    old = streams.open("u1")
+    new = streams.open("u1")
+    assert old.token != new.token
+    assert streams.resume(old.token)[0] is None
+    assert streams.for_user("u1") is new
+
+
+def test_ack_trims_buffer():
+    streams = make_registry()
+    stream = streams.open("u1")
+    for i in range(4):
+        stream.publish({"n": i})
+    stream.ack(3)
+    assert [m["seq"] for m in stream.buffer] == [4]
+
+
+def test_duplicate_client_messages_are_skipped():
+    stream = make_registry().open("u1")
+    for seq in (1, 2):
+        assert not stream.is_duplicate(seq)
+        stream.commit_client_seq(seq)
+    assert stream.is_duplicate(2) and stream.is_duplicate(1)
+    assert not stream.is_duplicate(None)
+    assert not stream.is_duplicate(3)
+
+
+def test_client_can_retry_a_rate_limited_message():
+    stream = make_registry().open("u1")
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1, burst=1, clock=clock)
+    processed = []
+
+    def receive(seq, text):
+        # Mismo orden que /ws y /sse/message: duplicado, límite, turno y entonces se marca
+        if stream.is_duplicate(seq):
+            return "duplicate"
+        if not limiter.consume("u1"):
+            return 429
+        processed.append(text)
+        stream.commit_client_seq(seq)
+        return "ok"
+
+    assert receive(1, "hola") == "ok"
+    assert receive(2, "una cita") == 429
+    clock.advance(5)
+    assert receive(2, "una cita") == "ok"
+    assert receive(2, "una cita") == "duplicate"
+    assert processed == ["hola", "una cita"]
+
+
+def test_detach_ignores_stale_connection():
+    stream = make_registry().open("u1")
+    old, new = [], []
+    stream.attach(old.append)
+    stream.attach(new.append)
+    stream.detach(old.append)
+    stream.publish({"n": 1})
+    assert new and not old
+
+
+def test_session_count_is_bounded():
+    streams = make_registry(max_sessions=3)
+    tokens = [streams.open(f"u{i}").token for i in range(5)]
+    assert len(streams) == 3
+    assert streams.resume(tokens[0])[0] is None
+    assert streams.resume(tokens[4])[0] is not None
+
+
+def test_restored_stream_keeps_token_and_numbering():
+    streams = make_registry()
+    stream = streams.restore("u1", "token-guardado", next_seq=5, last_client_seq=2,
+                             buffer=[{"n": 3, "seq": 3}, {"n": 4, "seq": 4}])
+    assert streams.for_user("u1") is stream
+    resumed, missed, complete = streams.resume("token-guardado", last_seq=3)
+    assert resumed is stream and complete
+    assert [m["seq"] for m in missed] == [4]
+    assert stream.publish({"n": 5})["seq"] == 5
+    assert stream.is_duplicate(2)
+
+
+if __name__ == "__main__":
+    for test in (test_messages_are_numbered_and_delivered, test_resume_replays_only_missed_messages,
+                 test_resume_reports_gap_when_buffer_overflowed, test_nothing_missed,
+                 test_unknown_or_released_token_fails, test_reopen_invalidates_previous_token,
+                 test_ack_trims_buffer, test_duplicate_client_messages_are_skipped, test_client_can_retry_a_rate_limited_message,
+                 test_detach_ignores_stale_connection, test_session_count_is_bounded,
+                 test_restored_stream_keeps_token_and_numbering):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Prueba de la parada ordenada (fases, drenado de turnos y límite de tiempo)
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from shutdown import ShutdownCoordinator, ShuttingDownError
+from worker_pool import PoolBusyError
+
+
+def make_coordinator(timeout=1.0):
+    return ShutdownCoordinator(timeout=timeout, registry=MetricsRegistry())
+
+
+async def turn(coordinator, seconds, log):
+    coordinator.check_accepting()
+    with coordinator.track():
+        await asyncio.sleep(seconds)
+        log.append("turn")
+
+
+def test_phases_run_in_order_after_in_flight_turns():
+    coordinator = make_coordinator()
+    log = []
+    coordinator.add_hook("notify", "aviso", lambda: log.append("notify"))
+    coordinator.add_hook("close", "cierre", lambda: log.append("close"))
+
+    async def flush():
+        log.append("flush")
+        return {"items_flushed": 3}
+
+    coordinator.add_hook("flush", "backend", flush)
+    coordinator.add_hook("snapshot", "sesiones", lambda: log.append("snapshot"))
+
+    async def scenario():
+        task = asyncio.ensure_future(turn(coordinator, 0.05, log))
+        await asyncio.sleep(0)
+        report = await coordinator.drain()
+        await task
+        return report
+
+    report = asyncio.run(scenario())
+    assert log == ["notify", "turn", "close", "flush", "snapshot"]
+    assert report["turns_in_flight_at_start"] == 1
+    assert report["turns_completed"] == 1
+    assert report["turns_abandoned"] == 0
+    assert report["items_flushed"] == 3
+
+
+def test_new_turns_rejected_while_draining():
+    coordinator = make_coordinator()
+
+    async def scenario():
+        await coordinator.drain()
+        try:
+            await turn(coordinator, 0, [])
+        except ShuttingDownError as e:
+            return e
+
+    error = asyncio.run(scenario())
+    # Los endpoints existentes ya responden 503 a PoolBusyError
+    assert isinstance(error, PoolBusyError)
+
+
+def test_drain_is_time_boxed():
+    coordinator = make_coordinator(timeout=0.1)
+    flushed = []
+    coordinator.add_hook("flush", "backend", lambda: flushed.append(True))
+
+    async def scenario():
+        task = asyncio.ensure_future(turn(coordinator, 5, []))
+        await asyncio.sleep(0)
+        report = await coordinator.drain()
+        task.cancel()
+        return report
+
+    report = asyncio.run(scenario())
+    assert report["turns_abandoned"] == 1
+    assert report["duration_seconds"] < 1
+    # Las fases posteriores se ejecutan aunque no haya terminado todo
+    assert flushed == [True]
+
+
+def test_slow_and_failing_hooks_are_reported():
+    coordinator = make_coordinator(timeout=0.1)
+
+    async def slow():
+        await asyncio.sleep(5)
+
+    def broken():
+        raise RuntimeError("fallo")
+
+    coordinator.add_hook("flush", "lento", slow)
+    coordinator.add_hook("snapshot", "roto", broken)
+    report = asyncio.run(coordinator.drain())
+    assert report["timed_out"] == ["lento"]
+    assert report["failed"] == ["roto"]
+
+
+def test_drain_runs_once():
+    coordinator = make_coordinator()
+    calls = []
+    coordinator.add_hook("notify", "aviso", lambda: calls.append(1))
+
+    async def scenario():
+        first, second = await asyncio.gather(coordinator.drain(), coordinator.drain())
+        third = await coordinator.drain()
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert calls == [1]
+    assert first is second is third
+
+
+def test_unknown_phase_rejected():
+    try:
+        make_coordinator().add_hook("despues", "x", lambda: None)
+        raise AssertionError("debería rechazar la fase")
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    for test in (test_phases_run_in_order_after_in_flight_turns, test_new_turns_rejected_while_draining,
+                 test_drain_is_time_boxed, test_slow_and_failing_hooks_are_reported, test_drain_runs_once,
+                 test_unknown_phase_rejected):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Prueba de las retenciones de horario (conflictos, caducidad y concurrencia entre procesos)
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from slot_holds import SlotHoldRegistry
+from fakes import FakeClock
+
+SLOT = datetime(2026, 1, 6, 9)
+OTHER = datetime(2026, 1, 6, 11)
+
+
+def temp_path():
+    return os.path.join(tempfile.mkdtemp(), "holds.db")
+
+
+def make_registry(path=None, **kwargs):
+    return SlotHoldRegistry(path or temp_path(), registry=MetricsRegistry(), **kwargs)
+
+
+def test_second_session_cannot_hold_the_same_slot():
+    holds = make_registry()
+    assert holds.acquire(SLOT, "ana")
+    assert not holds.acquire(SLOT, "luis")
+    # Volver a elegirlo la misma sesión no es un conflicto
+    assert holds.acquire(SLOT, "ana")
+    assert holds.held(exclude_holder="luis") == {SLOT: 1}
+    assert holds.held(exclude_holder="ana") == {}
+
+
+def test_capacity_counts_other_holders():
+    holds = make_registry()
+    assert holds.acquire(SLOT, "ana", capacity=2)
+    assert holds.acquire(SLOT, "luis", capacity=2)
+    assert not holds.acquire(SLOT, "eva", capacity=2)
+    # Sin hueco real (ya reservado en el backend) no se retiene
+    assert not holds.acquire(OTHER, "eva", capacity=0)
+
+
+def test_one_hold_per_session():
+    holds = make_registry()
+    holds.acquire(SLOT, "ana")
+    holds.acquire(OTHER, "ana")
+    assert holds.held_by("ana") == OTHER
+    assert holds.acquire(SLOT, "luis")
+
+
+def test_failed_acquire_keeps_previous_hold():
+    holds = make_registry()
+    holds.acquire(SLOT, "ana")
+    holds.acquire(OTHER, "luis")
+    assert not holds.acquire(OTHER, "ana")
+    assert holds.held_by("ana") == SLOT
+
+
+def test_holds_expire_and_can_be_released():
+    clock = FakeClock(1000.0)
+    holds = make_registry(ttl=60, clock=clock)
+    holds.acquire(SLOT, "ana")
+    clock.advance(61)
+    assert holds.held() == {}
+    assert holds.acquire(SLOT, "luis")
+    assert holds.release("luis") == 1
+    assert holds.release("luis") == 0
+    assert holds.acquire(SLOT, "eva")
+
+
+def test_threads_race_for_one_slot():
+    holds = make_registry()
+    results = []
+    barrier = threading.Barrier(20)
+
+    def session(i):
+        barrier.wait()
+        results.append(holds.acquire(SLOT, f"u{i}"))
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+
+
+def _worker_acquire(path, holder, start, results):
+    holds = SlotHoldRegistry(path, registry=MetricsRegistry())
+    start.wait()
+    results.put(holds.acquire(SLOT, holder))
+
+
+def test_workers_share_holds_through_the_file():
+    path = temp_path()
+    make_registry(path).held()  # crea el esquema
+    context = multiprocessing.get_context("fork")
+    start = context.Event()
+    results = context.Queue()
+    workers = [context.Process(target=_worker_acquire, args=(path, f"w{i}", start, results)) for i in range(6)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(10)
+    outcomes = [results.get(timeout=5) for _ in workers]
+    assert outcomes.count(True) == 1
+    assert len(make_registry(path).held()) == 1
+
+
+def _inherited_acquire(holds, holder, start, results):
+    start.wait()
+    results.put(holds.acquire(SLOT, holder))
+
+
+def test_workers_forked_after_first_use_open_their_own_connection():
+    """Como con el lanzador: el registro se crea y se usa en el padre antes del fork"""
+    holds = make_registry()
+    assert holds.held() == {}
+    context = multiprocessing.get_context("fork")
+    start = context.Event()
+    results = context.Queue()
+    workers = [context.Process(target=_inherited_acquire, args=(holds, f"w{i}", start, results)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(10)
+    outcomes = [results.get(timeout=5) for _ in workers]
+    assert outcomes.count(True) == 1
+    assert holds.held() == {SLOT: 1}
+
+
+if __name__ == "__main__":
+    for test in (test_second_session_cannot_hold_the_same_slot, test_capacity_counts_other_holders,
+                 test_one_hold_per_session, test_failed_acquire_keeps_previous_hold,
+                 test_holds_expire_and_can_be_released, test_threads_race_for_one_slot,
+                 test_workers_share_holds_through_the_file, test_workers_forked_after_first_use_open_their_own_connection):
+        test()
+        print(f"✅ {test.__name__}")
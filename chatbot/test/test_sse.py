@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Prueba del flujo Server-Sent Events (formato, keep-alive, cierre y reanudación)
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from session_stream import SessionStreamRegistry
+from sse import KEEPALIVE_COMMENT, SSEConnection, format_event, parse_last_event_id
+
+
+def parse(event: str):
+    fields = dict(line.split(": ", 1) for line in event.strip().split("\n"))
+    return fields, json.loads(fields["data"])
+
+
+async def collect(connection, count, is_disconnected=None):
+    events = []
+    async for event in connection.events(is_disconnected):
+        events.append(event)
+        if len(events) == count:
+            break
+    return events
+
+
+def test_format_event_uses_seq_as_id():
+    fields, data = parse(format_event({"response": "hola\nadiós", "seq": 7}, retry_ms=3000))
+    assert fields["id"] == "7" and fields["retry"] == "3000"
+    assert data["response"] == "hola\nadiós"
+    assert format_event({"type": "session"}).startswith("data: ")
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id("12") == 12
+    assert parse_last_event_id(None) == 0
+    assert parse_last_event_id("abc") == 0
+
+
+def test_stream_delivers_session_events():
+    async def scenario():
+        connection = SSEConnection(keepalive=1.0, retry_ms=2000, registry=MetricsRegistry())
+        stream = SessionStreamRegistry(registry=MetricsRegistry()).open("u1")
+        stream.attach(connection.send)
+        stream.publish({"response": "uno"})
+        stream.publish({"type": "warning", "message": "dos"})
+        return await collect(connection, 2)
+
+    events = asyncio.run(scenario())
+    first, second = (parse(e) for e in events)
+    assert first[0]["retry"] == "2000" and first[0]["id"] == "1"
+    assert "retry" not in second[0] and second[1]["type"] == "warning"
+
+
+def test_keepalive_and_disconnect():
+    async def scenario():
+        connection = SSEConnection(keepalive=0.01, registry=MetricsRegistry())
+        calls = []
+
+        async def is_disconnected():
+            calls.append(1)
+            return len(calls) > 2
+
+        return await collect(connection, 10, is_disconnected)
+
+    events = asyncio.run(scenario())
+    assert events == [KEEPALIVE_COMMENT, KEEPALIVE_COMMENT]
+
+
+def test_close_ends_stream_after_pending_events():
+    async def scenario():
+        connection = SSEConnection(registry=MetricsRegistry())
+        connection.send({"type": "close", "message": "fin"})
+        connection.close()
+        return await collect(connection, 10)
+
+    events = asyncio.run(scenario())
+    assert len(events) == 1 and parse(events[0])[1]["type"] == "close"
+
+
+def test_overflow_closes_slow_client():
+    async def scenario():
+        registry = MetricsRegistry()
+        connection = SSEConnection(max_queue=2, registry=registry)
+        results = [connection.send({"n": i}) for i in range(3)]
+        events = await collect(connection, 10)
+        return results, events, registry.snapshot()
+
+    results, events, snapshot = asyncio.run(scenario())
+    assert results == [True, True, False]
+    assert events == []
+    assert snapshot["sse_outbound_overflow_total"] == 1
+
+
+def test_reconnect_with_last_event_id_replays_missed():
+    streams = SessionStreamRegistry(registry=MetricsRegistry())
+    stream = streams.open("u1")
+    for i in range(4):
+        stream.publish({"n": i})
+
+    async def scenario():
+        _, missed, complete = streams.resume(stream.token, parse_last_event_id("2"))
+        connection = SSEConnection(registry=MetricsRegistry())
+        for frame in missed:
+            connection.send(frame)
+        return complete, await collect(connection, len(missed))
+
+    complete, events = asyncio.run(scenario())
+    assert complete
+    assert [parse(e)[0]["id"] for e in events] == ["3", "4"]
+
+
+if __name__ == "__main__":
+    for test in (test_format_event_uses_seq_as_id, test_parse_last_event_id, test_stream_delivers_session_events,
+                 test_keepalive_and_disconnect, test_close_ends_stream_after_pending_events,
+                 test_overflow_closes_slow_client, test_reconnect_with_last_event_id_replays_missed):
+        test()
+        print(f"✅ {test.__name__}")
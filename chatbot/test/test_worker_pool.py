@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Prueba del pool acotado para el pipeline NLP: paralelismo, backpressure y métricas
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import MetricsRegistry
+from worker_pool import BoundedWorkerPool, PoolBusyError, available_cpus, io_bound_workers
+
+
+def test_available_cpus():
+    assert available_cpus() >= 1
+
+
+def test_io_bound_sizing():
+    assert io_bound_workers(per_cpu=8, limit=1000) == available_cpus() * 8
+    assert io_bound_workers(per_cpu=8, limit=4) <= 4
+    # Con un turno esperando al backend no basta una CPU para llenar el pool
+    pool = BoundedWorkerPool(max_workers=io_bound_workers(), registry=MetricsRegistry())
+    assert pool.max_workers + pool.max_queue >= 40
+    pool.shutdown()
+
+
+def test_runs_off_event_loop():
+    pool = BoundedWorkerPool(max_workers=2, max_queue=2, registry=MetricsRegistry())
+    loop_thread = threading.get_ident()
+
+    async def scenario():
+        return await pool.run(threading.get_ident)
+
+    assert asyncio.run(scenario()) != loop_thread
+    pool.shutdown()
+
+
+def test_rejects_when_queue_full():
+    registry = MetricsRegistry()
+    pool = BoundedWorkerPool(max_workers=2, max_queue=3, registry=registry)
+    release = threading.Event()
+
+    def blocking_job():
+        release.wait(2)
+        return "ok"
+
+    async def scenario():
+        tasks = [asyncio.create_task(pool.run(blocking_job)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        assert pool.is_full()
+        try:
+            await pool.run(blocking_job)
+            raise AssertionError("debería haberse rechazado")
+        except PoolBusyError:
+            pass
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(scenario())
+    assert results == ["ok"] * 5
+    snapshot = registry.snapshot()
+    assert snapshot["nlp_pool_rejected_total"] == 1
+    assert snapshot["nlp_pool_wait_seconds"]["count"] == 5
+    assert snapshot["nlp_pool_service_seconds"]["count"] == 5
+    assert snapshot["nlp_pool_queue_depth"]["count"] == 5
+    assert snapshot["nlp_pool_queue_depth_current"] == 0
+    pool.shutdown()
+
+
+def test_wait_time_reflects_queueing():
+    registry = MetricsRegistry()
+    pool = BoundedWorkerPool(max_workers=1, max_queue=10, registry=registry)
+
+    async def scenario():
+        await asyncio.gather(*(pool.run(time.sleep, 0.02) for _ in range(4)))
+
+    asyncio.run(scenario())
+    snapshot = registry.snapshot()
+    # Con un único worker las tareas esperan en cola a las anteriores
+    assert snapshot["nlp_pool_wait_seconds"]["sum"] >= 0.05
+    assert snapshot["nlp_pool_service_seconds"]["sum"] >= 0.08
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    for test in (test_available_cpus, test_io_bound_sizing, test_runs_off_event_loop,
+                 test_rejects_when_queue_full, test_wait_time_reflects_queueing):
+        test()
+        print(f"✅ {test.__name__}")
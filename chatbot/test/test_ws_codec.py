@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Prueba y benchmark de la codificación de respuestas y frames WebSocket.
+
+Ejecutado como script compara el rendimiento de json estándar (codificación
+anterior) con orjson y msgpack sobre respuestas típicas del chatbot.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ws_codec
+from ws_codec import MSGPACK_SUBPROTOCOL, codec_for, json_codec, negotiate, receive_frame, send_frame
+
+SAMPLE_RESPONSE = {
+    "response": """📋 **Resumen de tu cita:**
+
+👤 **Datos personales:**
+• Nombre: María García López
+• Edad: 34 años
+• Teléfono: 612345678
+• Email: maria@example.com
+
+⚖️ **Consulta:**
+• Motivo: despido improcedente
+• Área: Derecho Laboral
+• Fecha preferida: 2025-08-12
+
+¿Está todo correcto? Responde 'sí' para confirmar o 'no' para empezar de nuevo.""",
+    "timestamp": datetime(2025, 8, 8, 10, 30).isoformat(),
+}
+SAMPLE_REQUEST = {"text": "quiero una cita para un despido", "language": "es", "user_id": "user-123"}
+
+
+class FakeWebSocket:
+    def __init__(self, incoming=None):
+        self.sent = []
+        self.incoming = list(incoming or [])
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def receive(self):
+        return self.incoming.pop(0)
+
+
+def test_json_roundtrip_keeps_unicode():
+    encoded = json_codec.encode(SAMPLE_RESPONSE)
+    assert isinstance(encoded, str)
+    assert "📋" in encoded  # sin escapes \\u
+    assert json_codec.decode(encoded) == SAMPLE_RESPONSE
+    assert json.loads(encoded) == SAMPLE_RESPONSE
+
+
+def test_negotiation():
+    assert negotiate([]) is None
+    assert negotiate(None) is None
+    expected = MSGPACK_SUBPROTOCOL if ws_codec.MSGPACK_AVAILABLE else None
+    assert negotiate(["chat", MSGPACK_SUBPROTOCOL]) == expected
+    assert codec_for(None) is json_codec
+
+
+def test_send_and_receive_frames():
+    async def scenario():
+        ws = FakeWebSocket([{"type": "websocket.receive", "text": json.dumps(SAMPLE_REQUEST)}])
+        assert await receive_frame(ws, json_codec) == SAMPLE_REQUEST
+        await send_frame(ws, json_codec, SAMPLE_RESPONSE)
+        assert json.loads(ws.sent[0]) == SAMPLE_RESPONSE
+
+        if ws_codec.MSGPACK_AVAILABLE:
+            codec = codec_for(MSGPACK_SUBPROTOCOL)
+            packed = codec.encode(SAMPLE_REQUEST)
+            ws = FakeWebSocket([{"type": "websocket.receive", "bytes": packed}])
+            assert await receive_frame(ws, codec) == SAMPLE_REQUEST
+            await send_frame(ws, codec, SAMPLE_RESPONSE)
+            assert isinstance(ws.sent[0], bytes)
+            assert codec.decode(ws.sent[0]) == SAMPLE_RESPONSE
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_frame():
+    from fastapi import WebSocketDisconnect
+
+    async def scenario():
+        ws = FakeWebSocket([{"type": "websocket.disconnect", "code": 1001}])
+        try:
+            await receive_frame(ws, json_codec)
+        except WebSocketDisconnect as e:
+            return e.code
+        return None
+
+    assert asyncio.run(scenario()) == 1001
+
+
+def benchmark(number: int = 50000):
+    """Turnos por segundo (decodificar petición + codificar respuesta)"""
+    candidates = {
+        "json (anterior)": (lambda: json.dumps(SAMPLE_RESPONSE), lambda: json.loads(json.dumps(SAMPLE_REQUEST))),
+        f"json_codec ({'orjson' if ws_codec.ORJSON_AVAILABLE else 'json'})": (
+            lambda: json_codec.encode(SAMPLE_RESPONSE),
+            lambda: json_codec.decode(json_codec.encode(SAMPLE_REQUEST)),
+        ),
+    }
+    if ws_codec.MSGPACK_AVAILABLE:
+        codec = codec_for(MSGPACK_SUBPROTOCOL)
+        candidates["msgpack"] = (
+            lambda: codec.encode(SAMPLE_RESPONSE),
+            lambda: codec.decode(codec.encode(SAMPLE_REQUEST)),
+        )
+    baseline = None
+    for name, (encode, decode) in candidates.items():
+        seconds = timeit.timeit(lambda: (decode(), encode()), number=number)
+        rate = number / seconds
+        baseline = baseline or rate
+        print(f"   {name:<22} {rate:>12,.0f} turnos/s  (x{rate / baseline:.2f})")
+
+
+if __name__ == "__main__":
+    for test in (test_json_roundtrip_keeps_unicode, test_negotiation,
+                 test_send_and_receive_frames, test_disconnect_frame):
+        test()
+        print(f"✅ {test.__name__}")
+    print("\n📊 Benchmark de codificación:")
+    benchmark()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Prueba de la cola de salida acotada y el heartbeat de las conexiones WebSocket
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi import WebSocketDisconnect
+
+from metrics import MetricsRegistry
+from ws_codec import json_codec
+from ws_connection import (CLOSE_GOING_AWAY, CLOSE_TRY_AGAIN_LATER, OVERFLOW_DROP_OLDEST,
+                           WebSocketConnection)
+
+
+class FakeWebSocket:
+    """WebSocket simulado; `blocked` frena los envíos como un cliente lento"""
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.blocked = asyncio.Event()
+        self.blocked.set()
+
+    async def send_text(self, data):
+        await self.blocked.wait()
+        self.sent.append(json.loads(data))
+
+    async def send_bytes(self, data):
+        await self.send_text(data)
+
+    async def close(self, code=1000, reason=""):
+        self.closed_with = code
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    def push(self, payload):
+        self.incoming.put_nowait({"type": "websocket.receive", "text": json.dumps(payload)})
+
+
+def connection_for(ws, **kwargs):
+    options = dict(max_queue=4, ping_interval=0, send_timeout=1.0, registry=MetricsRegistry())
+    options.update(kwargs)
+    return WebSocketConnection(ws, json_codec, **options).start()
+
+
+def test_messages_delivered_in_order():
+    async def scenario():
+        ws = FakeWebSocket()
+        conn = connection_for(ws)
+        for i in range(3):
+            assert conn.send({"n": i})
+        await conn.aclose()
+        return ws
+
+    ws = asyncio.run(scenario())
+    assert [m["n"] for m in ws.sent] == [0, 1, 2]
+    assert ws.closed_with == 1000
+
+
+def test_slow_consumer_does_not_block_and_gets_closed():
+    async def scenario():
+        ws = FakeWebSocket()
+        ws.blocked.clear()
+        conn = connection_for(ws)
+        # send() nunca bloquea aunque el cliente no lea
+        results = [conn.send({"n": i}) for i in range(10)]
+        assert conn.closed and conn.close_code == CLOSE_TRY_AGAIN_LATER
+        ws.blocked.set()
+        await conn.aclose()
+        return ws, results
+
+    ws, results = asyncio.run(scenario())
+    assert results.count(False) >= 1
+    assert ws.closed_with == CLOSE_TRY_AGAIN_LATER
+
+
+def test_drop_oldest_policy():
+    async def scenario():
+        ws = FakeWebSocket()
+        ws.blocked.clear()
+        conn = connection_for(ws, overflow=OVERFLOW_DROP_OLDEST)
+        await asyncio.sleep(0)
+        for i in range(10):
+            assert conn.send({"n": i})
+        ws.blocked.set()
+        await conn.aclose()
+        return ws
+
+    ws = asyncio.run(scenario())
+    received = [m["n"] for m in ws.sent]
+    # Se conservan los más recientes
+    assert received[-1] == 9
+    assert len(received) <= 5
+
+
+def test_stuck_send_times_out():
+    async def scenario():
+        ws = FakeWebSocket()
+        ws.blocked.clear()
+        conn = connection_for(ws, send_timeout=0.05)
+        conn.send({"n": 1})
+        await asyncio.sleep(0.1)
+        assert conn.closed
+        try:
+            await conn.receive()
+        except WebSocketDisconnect:
+            pass
+        await conn.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_dead_peer_detected_after_pong():
+    async def scenario():
+        ws = FakeWebSocket()
+        conn = connection_for(ws, ping_interval=0.02, ping_timeout=0.1)
+        ws.push({"type": "pong"})
+        ws.push({"text": "hola", "user_id": "u1"})
+        message = await conn.receive()
+        assert message["text"] == "hola"
+        assert conn.answers_pings
+        try:
+            await asyncio.wait_for(conn.receive(), 1.0)
+            raise AssertionError("debería haberse detectado el peer muerto")
+        except WebSocketDisconnect as e:
+            assert e.code == CLOSE_GOING_AWAY
+        await conn.aclose()
+        return ws
+
+    ws = asyncio.run(scenario())
+    assert {"type": "ping"} in ws.sent
+    assert ws.closed_with == CLOSE_GOING_AWAY
+
+
+def test_legacy_client_without_pong_kept_open():
+    async def scenario():
+        ws = FakeWebSocket()
+        conn = connection_for(ws, ping_interval=0.02, ping_timeout=0.05)
+        await asyncio.sleep(0.2)
+        assert not conn.closed
+        await conn.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_client_ping_answered():
+    async def scenario():
+        ws = FakeWebSocket()
+        conn = connection_for(ws)
+        ws.push({"type": "ping"})
+        ws.push({"text": "hola"})
+        assert (await conn.receive())["text"] == "hola"
+        await conn.aclose()
+        return ws
+
+    ws = asyncio.run(scenario())
+    assert ws.sent[0] == {"type": "pong"}
+
+
+if __name__ == "__main__":
+    for test in (test_messages_delivered_in_order, test_slow_consumer_does_not_block_and_gets_closed,
+                 test_drop_oldest_policy, test_stuck_send_times_out, test_dead_peer_detected_after_pong,
+                 test_legacy_client_without_pong_kept_open, test_client_ping_answered):
+        test()
+        print(f"✅ {test.__name__}")
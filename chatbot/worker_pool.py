@@ -0,0 +1,112 @@
+"""
+Pool acotado de hilos para los turnos del pipeline NLP.
+
+Un turno combina etapas CPU (regex, spaCy, embeddings) con llamadas HTTP
+bloqueantes (backend, LLM), así que el pool se dimensiona con varios hilos
+por CPU: mientras unos esperan a la red, otros usan la CPU.
+
+Las tareas se admiten mientras haya hueco en los workers o en la cola de
+admisión; si la cola está llena se rechazan con PoolBusyError para que el
+endpoint responda 503 en lugar de acumular peticiones en el event loop.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from metrics import MetricsRegistry, metrics as default_metrics
+
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class PoolBusyError(Exception):
+    """La cola de admisión está llena"""
+
+
+def available_cpus() -> int:
+    """Número de CPUs asignadas al contenedor (cuota de cgroup si existe)"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0:
+            return max(1, quota // period)
+    except (OSError, ValueError):
+        pass
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+def io_bound_workers(per_cpu: int = 8, limit: int = 64) -> int:
+    """Hilos para tareas que pasan la mayor parte del tiempo esperando E/S"""
+    return max(1, min(limit, available_cpus() * per_cpu))
+
+
+class BoundedWorkerPool:
+    """Ejecuta funciones síncronas en un pool de tamaño fijo con cola acotada"""
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        name: str = "nlp",
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.max_workers = max_workers or available_cpus()
+        self.max_queue = max_queue if max_queue is not None else self.max_workers * 4
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"{name}-worker")
+        self._pending = 0  # en cola + en ejecución; solo se modifica desde el event loop
+        self.queue_depth = registry.histogram(f"{name}_pool_queue_depth", QUEUE_DEPTH_BUCKETS)
+        self.queue_depth_current = registry.gauge(f"{name}_pool_queue_depth_current")
+        self.wait_time = registry.histogram(f"{name}_pool_wait_seconds")
+        self.service_time = registry.histogram(f"{name}_pool_service_seconds")
+        self.rejected = registry.counter(f"{name}_pool_rejected_total")
+
+    @property
+    def queued(self) -> int:
+        return max(0, self._pending - self.max_workers)
+
+    def is_full(self) -> bool:
+        return self._pending >= self.max_workers + self.max_queue
+
+    def check_admission(self):
+        """Lanza PoolBusyError si no se admitirían más tareas"""
+        if self.is_full():
+            self.rejected.inc()
+            raise PoolBusyError(f"{self.name}: cola llena ({self.max_queue})")
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        self.check_admission()
+        self._pending += 1
+        self.queue_depth.observe(self.queued)
+        self.queue_depth_current.set(self.queued)
+        submitted = time.perf_counter()
+
+        def job():
+            started = time.perf_counter()
+            self.wait_time.observe(started - submitted)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.service_time.observe(time.perf_counter() - started)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+        finally:
+            self._pending -= 1
+            self.queue_depth_current.set(self.queued)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
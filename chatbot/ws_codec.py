@@ -0,0 +1,114 @@
+"""
+Codificación rápida de respuestas y frames WebSocket.
+
+Usa orjson si está instalado (con json como alternativa) y ofrece un
+sub-protocolo binario msgpack opcional para los clientes que lo negocien
+con `Sec-WebSocket-Protocol: msgpack`.
+"""
+
+import json
+from typing import Any, Optional, Union
+
+from fastapi.responses import JSONResponse
+
+ORJSON_AVAILABLE = False
+MSGPACK_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+    print("[Codec] orjson disponible")
+except ImportError:
+    print("[Codec] orjson no disponible - usando json estándar")
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+    print("[Codec] msgpack disponible")
+except ImportError:
+    print("[Codec] msgpack no disponible - instalar con: pip install msgpack")
+
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+
+def dumps(obj: Any) -> str:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+if ORJSON_AVAILABLE:
+    from fastapi.responses import ORJSONResponse as ChatJSONResponse
+else:
+    ChatJSONResponse = JSONResponse
+
+
+class JSONCodec:
+    """Frames de texto JSON (protocolo por defecto)"""
+
+    binary = False
+    name = "json"
+
+    def encode(self, obj: Any) -> str:
+        return dumps(obj)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return loads(data)
+
+
+class MsgpackCodec:
+    """Frames binarios msgpack"""
+
+    binary = True
+    name = MSGPACK_SUBPROTOCOL
+
+    def encode(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            # Un cliente msgpack puede enviar texto JSON para mensajes de control
+            return loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+json_codec = JSONCodec()
+msgpack_codec = MsgpackCodec() if MSGPACK_AVAILABLE else None
+
+
+def negotiate(requested_subprotocols) -> Optional[str]:
+    """Devuelve el sub-protocolo a aceptar o None para JSON"""
+    if msgpack_codec and MSGPACK_SUBPROTOCOL in (requested_subprotocols or []):
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+
+def codec_for(subprotocol: Optional[str]):
+    if subprotocol == MSGPACK_SUBPROTOCOL and msgpack_codec:
+        return msgpack_codec
+    return json_codec
+
+
+async def send_frame(websocket, codec, payload: Any):
+    data = codec.encode(payload)
+    if codec.binary:
+        await websocket.send_bytes(data)
+    else:
+        await websocket.send_text(data)
+
+
+async def receive_frame(websocket, codec) -> Any:
+    """Recibe y decodifica un frame de texto o binario"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        from fastapi import WebSocketDisconnect
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return codec.decode(message["bytes"])
+    return codec.decode(message.get("text") or "")
@@ -0,0 +1,203 @@
+"""
+Conexión WebSocket con cola de salida acotada y heartbeat.
+
+Todo lo que se envía a un cliente (respuestas, avisos de inactividad, errores)
+pasa por una cola de tamaño fijo que vacía una tarea escritora dedicada, de
+modo que un cliente lento nunca bloquea el bucle de recepción ni acumula
+memoria: si la cola se llena se descarta el mensaje más antiguo o se cierra
+la conexión, según la política configurada.
+
+El servidor envía {"type": "ping"} periódicamente. Los clientes que responden
+{"type": "pong"} pasan a tener detección de peer muerto: si no llega ningún
+frame en `ping_timeout` segundos la conexión se cierra. Los clientes que nunca
+han respondido a un ping solo se cierran por inactividad o por envío lento.
+"""
+
+import asyncio
+import time
+from typing import Any, Callable, Optional
+
+from fastapi import WebSocketDisconnect
+
+from metrics import MetricsRegistry, metrics as default_metrics
+from ws_codec import receive_frame, send_frame
+
+OVERFLOW_CLOSE = "close"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+
+# Códigos de cierre (RFC 6455)
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+class _Close:
+    __slots__ = ("code", "reason")
+
+    def __init__(self, code: int, reason: str):
+        self.code = code
+        self.reason = reason
+
+
+class WebSocketConnection:
+    """Envoltorio de un WebSocket con escritor dedicado"""
+
+    def __init__(
+        self,
+        websocket,
+        codec,
+        max_queue: int = 32,
+        overflow: str = OVERFLOW_CLOSE,
+        ping_interval: float = 20.0,
+        ping_timeout: float = 45.0,
+        send_timeout: float = 10.0,
+        clock: Callable[[], float] = time.monotonic,
+        registry: MetricsRegistry = default_metrics,
+    ):
+        self.websocket = websocket
+        self.codec = codec
+        self.overflow = overflow
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.send_timeout = send_timeout
+        self.clock = clock
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.last_seen = clock()
+        self.answers_pings = False
+        self.closed = False
+        self.close_code: Optional[int] = None
+        self._closed_event = asyncio.Event()
+        self._closed_waiter: Optional[asyncio.Future] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.registry = registry
+        self.queue_depth = registry.histogram("ws_outbound_queue_depth", (0, 1, 2, 4, 8, 16, 32, 64))
+
+    # ------------------------------------------------------------------
+    # Ciclo de vida
+    # ------------------------------------------------------------------
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._closed_waiter = loop.create_task(self._closed_event.wait())
+        self._writer_task = loop.create_task(self._writer())
+        if self.ping_interval:
+            self._heartbeat_task = loop.create_task(self._heartbeat())
+        self.registry.gauge("ws_connections").inc()
+        return self
+
+    async def aclose(self, timeout: float = 2.0):
+        """Espera a que el escritor termine y libera las tareas"""
+        if not self.closed:
+            self.close(CLOSE_NORMAL)
+        if self._writer_task:
+            try:
+                await asyncio.wait_for(self._writer_task, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+        for task in (self._heartbeat_task, self._closed_waiter, self._writer_task):
+            if task and not task.done():
+                task.cancel()
+        self.registry.gauge("ws_connections").dec()
+
+    # ------------------------------------------------------------------
+    # Envío
+    # ------------------------------------------------------------------
+
+    def send(self, payload: Any) -> bool:
+        """Encola un mensaje sin bloquear. Devuelve False si no se pudo encolar"""
+        if self.closed:
+            return False
+        self.queue_depth.observe(self.queue.qsize())
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            pass
+        self.registry.counter("ws_outbound_overflow_total").inc()
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            self.queue.get_nowait()
+            self.queue.put_nowait(payload)
+            return True
+        print("[WebSocket] Cola de salida llena, cerrando conexión de cliente lento")
+        # Lo pendiente no llegaría a tiempo a un cliente que no lee
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.close(CLOSE_TRY_AGAIN_LATER, "slow consumer")
+        return False
+
+    def close(self, code: int = CLOSE_NORMAL, reason: str = ""):
+        """Envía lo pendiente y después el close frame"""
+        if self.closed:
+            return
+        self.closed = True
+        self.close_code = code
+        if self.queue.full():
+            # Se sacrifica el mensaje más antiguo para dejar sitio al cierre
+            self.queue.get_nowait()
+        self.queue.put_nowait(_Close(code, reason))
+        self._closed_event.set()
+
+    async def _writer(self):
+        while True:
+            item = await self.queue.get()
+            if isinstance(item, _Close):
+                try:
+                    await asyncio.wait_for(self.websocket.close(code=item.code, reason=item.reason), self.send_timeout)
+                except Exception:
+                    pass
+                return
+            try:
+                await asyncio.wait_for(send_frame(self.websocket, self.codec, item), self.send_timeout)
+            except asyncio.TimeoutError:
+                self.registry.counter("ws_slow_consumer_total").inc()
+                print("[WebSocket] Envío bloqueado demasiado tiempo, cerrando conexión")
+                self.closed = True
+                self.close_code = CLOSE_TRY_AGAIN_LATER
+                self._closed_event.set()
+                return
+            except Exception:
+                self.closed = True
+                self._closed_event.set()
+                return
+
+    # ------------------------------------------------------------------
+    # Heartbeat y recepción
+    # ------------------------------------------------------------------
+
+    def mark_alive(self):
+        self.last_seen = self.clock()
+
+    def is_dead(self) -> bool:
+        return self.answers_pings and self.clock() - self.last_seen > self.ping_timeout
+
+    async def _heartbeat(self):
+        while not self.closed:
+            await asyncio.sleep(self.ping_interval)
+            if self.is_dead():
+                self.registry.counter("ws_dead_peers_total").inc()
+                print("[WebSocket] Peer sin respuesta a los pings, cerrando conexión")
+                self.close(CLOSE_GOING_AWAY, "ping timeout")
+                return
+            # El ping es prescindible: si la cola está llena no se envía
+            if not self.closed and not self.queue.full():
+                self.queue.put_nowait({"type": "ping"})
+
+    async def receive(self) -> Any:
+        """Recibe el siguiente mensaje de la aplicación (pings y pongs se gestionan aquí)"""
+        while True:
+            receiving = asyncio.ensure_future(receive_frame(self.websocket, self.codec))
+            done, _ = await asyncio.wait({receiving, self._closed_waiter}, return_when=asyncio.FIRST_COMPLETED)
+            if receiving not in done:
+                receiving.cancel()
+                raise WebSocketDisconnect(self.close_code or CLOSE_NORMAL)
+            message = receiving.result()
+            self.mark_alive()
+            if isinstance(message, dict):
+                if message.get("type") == "pong":
+                    self.answers_pings = True
+                    continue
+                if message.get("type") == "ping":
+                    self.send({"type": "pong"})
+                    continue
+            return message